@@ -1,14 +1,157 @@
+import asyncio
+import logging
+import os
 import time
 import json
-import cv2
-from fastapi import APIRouter, UploadFile, File, Form
-from fastapi.responses import JSONResponse, Response
-from ..services.image_processing import SimpleSegmenter, read_image, mean_value_spine_image, visualize_selected_segments
-from ..services.ocr import ocr_from_array, ocr_text_prompt, assign_text_to_segments
-from ..services.llm_client import get_books_from_ocr, format_books_for_prompt, analyse_bookshelf, analyse_library
+from contextlib import AsyncExitStack
+from fastapi import APIRouter, UploadFile, File, Form, HTTPException
+from fastapi.responses import JSONResponse, PlainTextResponse, Response, StreamingResponse
+from ..services.image_processing import HIGHLIGHT_FORMATS, draw_highlight, encode_image, read_image
+from ..services.ocr import engine_pool
+from ..services.prompt_builder import build_indexed_spine_prompt
+from ..services.llm_client import analyse_bookshelf_async, analyse_bookshelf_stream, analyse_library_async, LLMError
+from ..services.llm_cache import llm_cache
+from ..services.catalog import book_catalog
+from ..services.executor import PipelineBusy, pipeline
+from ..services.session_store import session_store
+from ..services.single_flight import request_key, single_flight
+from ..services.stages import extract_spine_texts, segment_cached
+from ..services.telemetry import render_metrics, span
+from ..services.warmup import is_ready, warm_up_status
+
+logger = logging.getLogger(__name__)
 
 router = APIRouter()
 
+MAX_DIM = 1024
+MAX_BATCH_IMAGES = int(os.getenv("MAX_BATCH_IMAGES", "8"))
+
+
+async def decode_upload(file: UploadFile):
+    """
+    Read an upload into memory and decode it, without touching disk.
+
+    Returns:
+        (content, img): the raw bytes and the decoded RGB image
+    """
+    content = await file.read()
+    return content, await decode_content(content)
+
+
+async def decode_content(content):
+    """
+    Decode uploaded image bytes on the pipeline.
+
+    Returns:
+        the decoded RGB image
+    """
+    try:
+        with span("read_image"):
+            return await pipeline.run(read_image, content, max_dim=MAX_DIM)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Could not decode image")
+
+
+async def spine_prompt(segment_texts):
+    """
+    Build the spine text prompt off the event loop, since catalog lookups
+    take a millisecond or so per spine. It runs on a thread rather than the
+    pipeline, as its metrics and the catalog live in this process.
+
+    Returns:
+        (prompt, indices) as returned by build_indexed_spine_prompt
+    """
+    with span("build_prompt"):
+        return await asyncio.to_thread(build_indexed_spine_prompt, segment_texts)
+
+
+def check_highlight_options(format, quality, max_dim):
+    """
+    Validate the output options of the highlight endpoints.
+
+    Returns:
+        str media type of the chosen format
+    """
+    if format not in HIGHLIGHT_FORMATS:
+        raise HTTPException(status_code=400, detail=f"format must be one of {sorted(HIGHLIGHT_FORMATS)}")
+    if quality is not None and not 1 <= quality <= 100:
+        raise HTTPException(status_code=400, detail="quality must be between 1 and 100")
+    if max_dim is not None and max_dim < 1:
+        raise HTTPException(status_code=400, detail="max_dim must be positive")
+    return HIGHLIGHT_FORMATS[format][1]
+
+
+async def render_highlight(img, segments, chosen_segment, format, quality, max_dim):
+    """
+    Draw the highlight and encode it on the pipeline, timing the two as
+    separate stages so the cost of each output format shows up on its own.
+
+    Returns:
+        bytes: encoded image
+    """
+    with span("render_highlight"):
+        drawn = await pipeline.run(draw_highlight, img, segments, chosen_segment, max_dim)
+    with span("encode_image"):
+        return await pipeline.run(encode_image, drawn, format, quality)
+
+
+def ocr_pool_stats():
+    """
+    OCR engine pool stats. With a process pool, OCR runs on the workers'
+    own engine pools, so theirs are reported instead of this process's.
+    """
+    return pipeline.worker_ocr_stats() if pipeline.kind == "process" else engine_pool.stats()
+
+
+def parse_segment(segment):
+    """
+    Parse the segment form field of the highlight endpoints.
+
+    Returns:
+        [x1, y1, x2, y2] list of ints
+    """
+    try:
+        chosen_segment = json.loads(segment)
+    except ValueError:
+        chosen_segment = None
+    if (not isinstance(chosen_segment, list) or len(chosen_segment) != 4
+            or not all(type(value) is int and abs(value) < 2**31 for value in chosen_segment)):
+        raise HTTPException(status_code=400, detail="segment must be a JSON list of 4 integers [x1, y1, x2, y2]")
+    return chosen_segment
+
+
+def bookshelf_response(analysis):
+    """
+    Build the /mybookshelf response body from a BookshelfAnalysis.
+    """
+    return {
+        "recommendation": {
+            "recommended_book": analysis.recommended_book,
+            "explanation": analysis.explanation
+        },
+        "three_words": {
+            "word_one": analysis.word_one,
+            "word_two": analysis.word_two,
+            "word_three": analysis.word_three
+        },
+        "scores": {
+            "age": analysis.age,
+            "intensity": analysis.intensity,
+            "mood": analysis.mood,
+            "popularity": analysis.popularity,
+            "focus": analysis.focus,
+            "realism": analysis.realism
+        }
+    }
+
+
+def sse_event(event, data):
+    """
+    Format a server-sent event with a JSON payload.
+    """
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+
 @router.get("/ping")
 async def ping():
     """
@@ -16,79 +159,197 @@ async def ping():
     """
     return {"status": "ok", "message": "Backend is reachable!"}
 
+@router.get("/healthz")
+async def healthz():
+    """
+    Liveness check: the process is up and serving.
+    """
+    return {"status": "ok"}
+
+@router.get("/readyz")
+async def readyz():
+    """
+    Readiness check: models are loaded and warmed up.
+    """
+    status = warm_up_status()
+    return JSONResponse(status, status_code=200 if is_ready() else 503)
+
+@router.get("/stats")
+async def stats():
+    """
+    Pipeline queue depth and wait times, OCR engine pool waits (for sizing
+    replicas), LLM cache hit rates, session store use, book catalog lookups
+    and coalesced duplicate requests.
+    """
+    return {
+        "pipeline": pipeline.stats(),
+        "ocr_pool": ocr_pool_stats(),
+        "llm_cache": llm_cache.stats(),
+        "sessions": session_store.stats(),
+        "catalog": book_catalog.stats(),
+        "single_flight": single_flight.stats(),
+    }
+
+@router.get("/metrics")
+async def metrics():
+    """
+    Prometheus metrics: per-stage and per-route latency histograms, Gemini
+    call outcomes, and the current /stats values as gauges.
+    """
+    gauges = []
+    for prefix, values in (("pipeline", pipeline.stats()), ("ocr_pool", ocr_pool_stats()),
+                           ("llm_cache", llm_cache.stats()), ("sessions", session_store.stats()),
+                           ("catalog", book_catalog.stats()), ("single_flight", single_flight.stats())):
+        for key, value in values.items():
+            if isinstance(value, (int, float)) and not isinstance(value, bool):
+                gauges.append((f"bookshelf_{prefix}_{key}", f"Current {prefix} {key.replace('_', ' ')}.", value))
+    return PlainTextResponse(render_metrics(gauges), media_type="text/plain; version=0.0.4")
+
 @router.post("/mybookshelf")
 async def upload_bookshelf(file: UploadFile = File(...)):
     """
     Upload an image of a bookshelf, segment it, run OCR, prompt LLM.
+
+    Identical uploads in flight at the same time (double taps, retries) share
+    one run of the pipeline.
     """
-    # Save the image
-    image_path = f"/tmp/{file.filename}"
-    with open(image_path, "wb") as f:
-        f.write(await file.read())
+    content = await file.read()
 
-    img = read_image(image_path, max_dim=1024)
+    async def analyse():
+        async with pipeline.admit():
+            # Decode the image once; OCR, segmentation and rendering share the array
+            img = await decode_content(content)
 
-    # OCR
-    print("Running OCR...")
-    boxes, text, confidences = ocr_from_array(img)
+            # OCR and segmentation run concurrently, then text is grouped by segment
+            segments, segment_texts = await extract_spine_texts(content, img, min_size_factor=0.05)
 
-    # Initialize segmenter and segment image
-    print("Segmenting image...")
-    segmenter = SimpleSegmenter(image_path, min_size_factor=0.05)
-    segments = segmenter.segment()
+        # Format text
+        segment_texts_prompt, _ = await spine_prompt(segment_texts)
+        logger.debug("Spine text prompt", extra={"prompt": segment_texts_prompt})
 
-    # Group text by segments
-    print("Assigning text to segments...")
-    segment_texts = assign_text_to_segments(
-        img,
-        segments,
-        [boxes, text, confidences],
-    )
+        # Analyse the bookshelf
+        analysis = await analyse_bookshelf_async(segment_texts_prompt, mode='analysis')
+        return bookshelf_response(analysis)
 
-    # Format text
-    print("Formatting segmented text...")
-    segment_texts_prompt = ocr_text_prompt(segment_texts)
-
-    print(segment_texts_prompt)
-    
-    # Analyse the bookshelf
-    print("Asking AI to analyse...")
-    analysis = analyse_bookshelf(segment_texts_prompt, mode='analysis')
-    age = analysis.age
-    intensity = analysis.intensity
-    mood = analysis.mood
-    popularity = analysis.popularity
-    focus = analysis.focus
-    realism = analysis.realism
-    word_one = analysis.word_one
-    word_two = analysis.word_two
-    word_three = analysis.word_three
-    recommended_book = analysis.recommended_book
-    explanation = analysis.explanation
-
-    return JSONResponse(
-        {
-            "recommendation": {
-                "recommended_book": recommended_book,
-                "explanation": explanation
-            },
-            "three_words": {
-                "word_one": word_one,
-                "word_two": word_two,
-                "word_three": word_three
-            },
-            "scores": {
-                "age": age,
-                "intensity": intensity,
-                "mood": mood,
-                "popularity": popularity,
-                "focus": focus,
-                "realism": realism
-            }
-        }
+    body = await single_flight.run(request_key("mybookshelf", content), analyse)
+    return JSONResponse(body)
+
+
+@router.post("/mybookshelf/stream")
+async def stream_bookshelf(file: UploadFile = File(...)):
+    """
+    Streaming version of /mybookshelf. Sends server-sent events as each stage
+    finishes:
+
+        decoded:      {"width", "height"} of the decoded image
+        segments:     {"segments": [[x1, y1, x2, y2], ...]} spine boxes
+        spine_texts:  {"spine_texts": [{"text", "segment"}, ...]} OCR text per spine
+        token:        {"text"} chunk of the LLM response as it arrives
+        analysis:     the /mybookshelf response body
+        error:        {"detail"} if the analysis failed, with "retry_after"
+                      (seconds) if the pipeline was busy or a worker crashed
+
+    A busy pipeline or an undecodable image is still reported with a 503 or
+    400 status, before the stream starts.
+    """
+    stack = AsyncExitStack()
+    await stack.enter_async_context(pipeline.admit())
+    try:
+        content, img = await decode_upload(file)
+    except BaseException:
+        await stack.aclose()
+        raise
+
+    async def events():
+        stage_results = asyncio.Queue()
+        extraction = None
+        try:
+            async with stack:
+                h, w = img.shape[:2]
+                yield sse_event("decoded", {"width": w, "height": h})
+
+                # Report segments and texts as their stages finish; None marks the end
+                extraction = asyncio.ensure_future(extract_spine_texts(
+                    content, img, min_size_factor=0.05,
+                    on_stage=lambda name, result: stage_results.put_nowait((name, result)),
+                ))
+                extraction.add_done_callback(lambda _: stage_results.put_nowait(None))
+                while (item := await stage_results.get()) is not None:
+                    name, result = item
+                    if name == "segments":
+                        yield sse_event("segments", {"segments": result[0]})
+                    elif name == "segment_texts":
+                        yield sse_event("spine_texts", {
+                            "spine_texts": [{"text": text, "segment": seg} for text, seg, _ in result]
+                        })
+                segments, segment_texts = await extraction
+
+            segment_texts_prompt, _ = await spine_prompt(segment_texts)
+            async for kind, value in analyse_bookshelf_stream(segment_texts_prompt, mode='analysis'):
+                if kind == 'token':
+                    yield sse_event("token", {"text": value})
+                else:
+                    yield sse_event("analysis", bookshelf_response(value))
+        except LLMError as e:
+            logger.warning("Error calling Gemini API: %s", e)
+            yield sse_event("error", {"detail": "Book analysis is temporarily unavailable, please try again."})
+        except PipelineBusy as e:
+            # Includes PipelineWorkerError
+            logger.warning("Pipeline error during stream: %s", e)
+            yield sse_event("error", {"detail": "Server is busy, please retry shortly.", "retry_after": e.retry_after})
+        except Exception:
+            # The 200 status has been sent, so the client can only be told here
+            logger.exception("Error during stream")
+            yield sse_event("error", {"detail": "Book analysis failed, please try again."})
+        finally:
+            # The client may disconnect mid-stream
+            if extraction is not None:
+                extraction.cancel()
+
+    return StreamingResponse(
+        events(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
     )
 
 
+@router.post("/mybookcase")
+async def upload_bookcase(files: list[UploadFile] = File(...)):
+    """
+    Upload several images of one bookcase (e.g. one per shelf) and analyse
+    them together. Each image is decoded, segmented and OCR'd in parallel,
+    then the spine texts of all shelves go to the LLM in a single call.
+
+    Returns the same body as /mybookshelf.
+    """
+    if len(files) > MAX_BATCH_IMAGES:
+        raise HTTPException(status_code=400, detail=f"At most {MAX_BATCH_IMAGES} images can be uploaded at once")
+
+    async def shelf_texts(file):
+        content, img = await decode_upload(file)
+        _, segment_texts = await extract_spine_texts(content, img, min_size_factor=0.05)
+        return segment_texts
+
+    async with pipeline.admit():
+        tasks = [asyncio.ensure_future(shelf_texts(file)) for file in files]
+        try:
+            shelves = await asyncio.gather(*tasks)
+        except BaseException:
+            # Stop the other shelves before the slot and its shared memory are released
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            raise
+
+    # One prompt for the whole bookcase, shelf by shelf
+    shelf_prompts = await asyncio.gather(*(spine_prompt(segment_texts) for segment_texts in shelves))
+    segment_texts_prompt = "".join(f" Shelf {i + 1}:" + prompt for i, (prompt, _) in enumerate(shelf_prompts))
+    logger.debug("Spine text prompt", extra={"prompt": segment_texts_prompt})
+
+    analysis = await analyse_bookshelf_async(segment_texts_prompt, mode='analysis')
+    return JSONResponse(bookshelf_response(analysis))
+
+
 @router.post("/library")
 async def upload_library(
     file: UploadFile = File(...),
@@ -96,91 +357,98 @@ async def upload_library(
 ):
     """
     Upload an image of a library shelf, segment it, run OCR, prompt LLM.
+
+    The response includes a session_id for /highlight/{session_id}, so the
+    image doesn't have to be uploaded again (null if it couldn't be kept).
+    Identical uploads with the same description in flight at the same time
+    share one run of the pipeline, and its session.
     """
-    # Save the image
-    image_path = f"/tmp/{file.filename}"
-    with open(image_path, "wb") as f:
-        f.write(await file.read())
+    content = await file.read()
 
-    img = read_image(image_path, max_dim=1024)
+    async def recommend():
+        async with pipeline.admit():
+            # Decode the image once; OCR, segmentation and rendering share the array
+            img = await decode_content(content)
 
-    # OCR
-    print("Running OCR...")
-    boxes, text, confidences = ocr_from_array(img)
+            # OCR and segmentation run concurrently, then text is grouped by segment
+            segments, segment_texts = await extract_spine_texts(content, img, min_size_factor=0.05)
 
-    # Initialize segmenter and segment image
-    print("Segmenting image...")
-    segmenter = SimpleSegmenter(image_path, min_size_factor=0.05)
-    segments = segmenter.segment()
+        # Keep the decoded image and spines for /highlight/{session_id}
+        session_id = session_store.create(img, segments)
 
-    # Group text by segments
-    print("Assigning text to segments...")
-    segment_texts = assign_text_to_segments(
-        img,
-        segments,
-        [boxes, text, confidences],
-    )
+        # Format text
+        segment_texts_prompt, spine_indices = await spine_prompt(segment_texts)
+        logger.debug("Spine text prompt", extra={"prompt": segment_texts_prompt})
+
+        # Ask AI for a recommendation, which must be one of the spines sent
+        library_analysis = await analyse_library_async(segment_texts_prompt, description, spine_indices)
+        recommended_idx = library_analysis.recommended_idx
+        chosen_segment = segment_texts[recommended_idx][1]
+        recommended_book = library_analysis.recommended_book
+        explanation = library_analysis.explanation
+        logger.info("Recommended book", extra={"recommended_book": recommended_book, "recommended_idx": recommended_idx})
 
-    # Format text
-    print("Formatting segmented text...")
-    segment_texts_prompt = ocr_text_prompt(segment_texts)
-    print(segment_texts_prompt)
-
-    # Ask AI for a recommendation
-    print("Asking AI to analyse...")
-    library_analysis = analyse_library(segment_texts_prompt, description)
-    recommended_idx = library_analysis.recommended_idx
-    chosen_segment = segment_texts[recommended_idx][1]
-    recommended_book = library_analysis.recommended_book
-    explanation = library_analysis.explanation
-    print(f"Recommended: {recommended_book}")
-    print(f"Explanation: {explanation}")
-
-    return JSONResponse(
-        {
+        return {
             "recommended_book": recommended_book,
             "explanation": explanation,
             "chosen_segment": chosen_segment,
-            "segments": segments
+            "segments": segments,
+            "session_id": session_id
         }
-    )
+
+    body = await single_flight.run(request_key("library", content, description=description), recommend)
+    return JSONResponse(body)
 
 @router.post("/highlight")
 async def highlight_segment(
     file: UploadFile = File(...),
     segment: str = Form(...),   # segment arrives as a JSON string "[x1, y1, x2, y2]"
+    format: str = Form("png"),  # 'png', 'jpeg' or 'webp'
+    quality: int = Form(None),  # JPEG/WebP quality, 1-100
+    max_dim: int = Form(None),  # downscale so the longest side is at most this
 ):
     """
     Accept an image + a selected segment, return highlighted image.
     """
-    # Parse segment JSON
-    chosen_segment = json.loads(segment)  # -> [x1, y1, x2, y2]
-    print(type(file))
-    print(chosen_segment)
+    media_type = check_highlight_options(format, quality, max_dim)
+
+    chosen_segment = parse_segment(segment)
 
-    # Save uploaded image
-    image_path = f"/tmp/{file.filename}"
-    with open(image_path, "wb") as f:
-        f.write(await file.read())
+    async with pipeline.admit():
+        # Decode uploaded image
+        content, img = await decode_upload(file)
 
-    img = read_image(image_path, max_dim=1024)
+        # Spines for this image, normally cached by /library
+        segments, _ = await segment_cached(content, img, min_size_factor=0.05)
 
-    # Recompute spines for correctness
-    segmenter = SimpleSegmenter(image_path, min_size_factor=0.05)
-    segments = segmenter.segment()
+        # Render flat spine image with the segment highlighted
+        encoded = await render_highlight(img, segments, chosen_segment, format, quality, max_dim)
 
-    # Create flat spine image
-    img_spines = mean_value_spine_image(img, segments)
+    return Response(content=encoded, media_type=media_type)
 
-    # Highlight segment
-    img_vis = visualize_selected_segments(img_spines, [("", chosen_segment)])
 
-    # Ensure colours correct
-    img_rgb = cv2.cvtColor(img_vis, cv2.COLOR_RGB2BGR)
+@router.post("/highlight/{session_id}")
+async def highlight_session_segment(
+    session_id: str,
+    segment: str = Form(...),   # segment arrives as a JSON string "[x1, y1, x2, y2]"
+    format: str = Form("png"),
+    quality: int = Form(None),
+    max_dim: int = Form(None),
+):
+    """
+    Like /highlight, but for the image of a /library session, so only the
+    segment is sent. Returns 404 once the session has expired; the client
+    should then fall back to /highlight.
+    """
+    media_type = check_highlight_options(format, quality, max_dim)
+    chosen_segment = parse_segment(segment)
+
+    session = session_store.get(session_id)
+    if session is None:
+        raise HTTPException(status_code=404, detail="Session expired, please upload the image again")
+    img, segments = session
 
-    # Encode as PNG
-    success, encoded_image = cv2.imencode('.png', img_rgb)
-    if not success:
-        raise RuntimeError("Failed to encode image")
+    async with pipeline.admit():
+        encoded = await render_highlight(img, segments, chosen_segment, format, quality, max_dim)
 
-    return Response(content=encoded_image.tobytes(), media_type="image/png")
\ No newline at end of file
+    return Response(content=encoded, media_type=media_type)
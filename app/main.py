@@ -1,9 +1,28 @@
+import logging
 import os
-from fastapi import FastAPI
+from contextlib import asynccontextmanager
+from fastapi import FastAPI, Request
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import JSONResponse
 from app.api import endpoints
+from app.services.executor import PipelineBusy, pipeline
+from app.services.llm_client import LLMError
+from app.services.telemetry import RequestTelemetryMiddleware, configure_logging
+from app.services.warmup import start_warm_up
 
-app = FastAPI(title="Bookshelf OCR & Recommendation API")
+configure_logging()
+logger = logging.getLogger(__name__)
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Load OCR models etc. in the background; /readyz reports when done
+    start_warm_up()
+    yield
+    pipeline.shutdown()
+
+
+app = FastAPI(title="Bookshelf OCR & Recommendation API", lifespan=lifespan)
 
 frontend_origins = os.environ.get("FRONTEND_ORIGINS", "http://localhost:5173")
 
@@ -15,7 +34,35 @@ app.add_middleware(
     allow_origins=origins,  # or ["*"] for testing only
     allow_credentials=True,
     allow_methods=["*"],
-    allow_headers=["*"]
+    allow_headers=["*"],
+    expose_headers=["X-Request-ID", "Server-Timing"],
 )
 
+# Request ids, Server-Timing headers and request metrics
+app.add_middleware(RequestTelemetryMiddleware)
+
 app.include_router(endpoints.router)
+
+
+@app.exception_handler(PipelineBusy)
+async def pipeline_busy_handler(request: Request, exc: PipelineBusy):
+    """
+    Fail fast when the pipeline is saturated, telling the client when to retry.
+    """
+    return JSONResponse(
+        status_code=503,
+        content={"detail": "Server is busy, please retry shortly."},
+        headers={"Retry-After": str(exc.retry_after)},
+    )
+
+
+@app.exception_handler(LLMError)
+async def llm_error_handler(request: Request, exc: LLMError):
+    """
+    Report LLM failures as a temporary outage rather than a server error.
+    """
+    logger.warning("Error calling Gemini API: %s", exc)
+    return JSONResponse(
+        status_code=503,
+        content={"detail": "Book analysis is temporarily unavailable, please try again."},
+    )
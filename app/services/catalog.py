@@ -0,0 +1,311 @@
+"""
+Local catalog of known books, to resolve spine text without asking Gemini.
+
+Usage (importing a dump of known books, CSV with title and author columns,
+or JSON lines as returned by get_books_from_ocr):
+    python -m app.services.catalog --db catalog.sqlite import books.csv
+    python -m app.services.catalog --db catalog.sqlite lookup "PETER MAY A WINTER GRAVE"
+"""
+import argparse
+import csv
+import json
+import logging
+import os
+import re
+import sqlite3
+import sys
+import threading
+import time
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+# SQLite file of known books; an empty in-memory catalog if unset
+CATALOG_DB = os.getenv("CATALOG_DB")
+# Share of a book's title trigrams that must appear in the spine text
+CATALOG_MIN_SCORE = float(os.getenv("CATALOG_MIN_SCORE", "0.7"))
+# Share of the spine text's trigrams the book must account for
+CATALOG_MIN_COVERAGE = float(os.getenv("CATALOG_MIN_COVERAGE", "0.5"))
+# Books added since the index was built are searched linearly up to this many
+CATALOG_REBUILD_AFTER = int(os.getenv("CATALOG_REBUILD_AFTER", "2000"))
+
+# Titles need this many trigrams (6 letters or digits) to be matched; shorter
+# ones are too easily found by chance in noisy spine text
+MIN_TITLE_GRAMS = 4
+# Per lookup: the query's rarest trigrams are looked up until this many
+# postings have been read (but at least MIN_QUERY_GRAMS of them), and the
+# documents sharing the most are verified
+MAX_POSTINGS = 20000
+MIN_QUERY_GRAMS = 4
+CANDIDATES = 32
+# Lookups where two books score within this of each other are left unresolved
+AMBIGUITY_MARGIN = 0.05
+
+NON_ALNUM_RE = re.compile(r"[\W_]+")
+
+
+def normalise(text):
+    """
+    Case-fold and keep only letters and digits, since OCR often merges or
+    splits words.
+    """
+    return NON_ALNUM_RE.sub("", text.casefold())
+
+
+def trigrams(text):
+    """
+    Set of byte trigrams of normalised text, as ints (the same values as the
+    index uses).
+    """
+    data = normalise(text).encode()
+    return {data[i] << 16 | data[i + 1] << 8 | data[i + 2] for i in range(len(data) - 2)}
+
+
+class NgramIndex:
+    """
+    Character trigram inverted index over a list of documents, stored as
+    NumPy arrays (sorted trigrams, offsets, and document ids) so that a
+    million titles fit in a few hundred MB and build in seconds.
+
+    Arguments:
+        docs: list of str, indexed by position.
+    """
+    def __init__(self, docs):
+        keys = [normalise(doc).encode() for doc in docs]
+        self.size = len(keys)
+        buf = np.frombuffer(b"\0".join(keys) + b"\0\0", dtype=np.uint8).astype(np.uint32)
+        grams = buf[:-2] << 16 | buf[1:-1] << 8 | buf[2:]
+        valid = (buf[:-2] != 0) & (buf[1:-1] != 0) & (buf[2:] != 0)
+        lengths = np.fromiter((len(key) + 1 for key in keys), dtype=np.int64, count=len(keys))
+        doc_ids = np.repeat(np.arange(len(keys), dtype=np.uint64), lengths)[:len(grams)]
+
+        # Unique (trigram, doc) pairs, sorted by trigram then doc
+        pairs = grams[valid].astype(np.uint64) << np.uint64(32) | doc_ids[valid]
+        pairs.sort()
+        pairs = pairs[np.append(True, pairs[1:] != pairs[:-1])[:len(pairs)]]
+        pair_grams = (pairs >> np.uint64(32)).astype(np.uint32)
+        self.docs = (pairs & np.uint64(0xFFFFFFFF)).astype(np.uint32)
+        starts = np.flatnonzero(np.append(True, pair_grams[1:] != pair_grams[:-1])[:len(pair_grams)])
+        self.grams = pair_grams[starts]
+        self.offsets = np.append(starts, len(pair_grams)).astype(np.int64)
+
+    def search(self, query_grams, limit=CANDIDATES):
+        """
+        Find the documents sharing the most trigrams with the query. Only
+        its rarest trigrams are used, up to MAX_POSTINGS postings, since
+        common ones barely narrow the search.
+
+        Returns:
+            array of document ids, best first
+        """
+        if not query_grams or not len(self.grams):
+            return np.empty(0, dtype=np.uint32)
+        query = np.fromiter(query_grams, dtype=np.uint32)
+        pos = np.searchsorted(self.grams, query)
+        found = pos < len(self.grams)
+        found[found] = self.grams[pos[found]] == query[found]
+        pos = pos[found]
+        if not len(pos):
+            return np.empty(0, dtype=np.uint32)
+        df = self.offsets[pos + 1] - self.offsets[pos]
+        order = np.argsort(df, kind="stable")
+        used = max(MIN_QUERY_GRAMS, int(np.searchsorted(np.cumsum(df[order]), MAX_POSTINGS, side="right")))
+        pos = pos[order[:used]]
+        hits = np.concatenate([self.docs[self.offsets[p]:self.offsets[p + 1]] for p in pos])
+        docs, counts = np.unique(hits, return_counts=True)
+        if len(docs) > limit:
+            best = np.argpartition(-counts, limit)[:limit]
+            docs, counts = docs[best], counts[best]
+        return docs[np.argsort(-counts, kind="stable")]
+
+
+class BookCatalog:
+    """
+    Title/author store in SQLite, with an in-memory NgramIndex for fuzzy
+    lookup of spine text.
+
+    The index is built on first use (or by load()). Books added afterwards
+    are searched linearly until CATALOG_REBUILD_AFTER of them have been
+    added, and then the index is rebuilt.
+
+    Arguments:
+        path: Path to the SQLite database (created if missing), or None for
+              an in-memory catalog.
+        min_score: Share of a title's trigrams that must be in the spine text.
+        min_coverage: Share of the spine text's trigrams the book must explain.
+    """
+    def __init__(self, path=CATALOG_DB, min_score=CATALOG_MIN_SCORE, min_coverage=CATALOG_MIN_COVERAGE):
+        self.path = path
+        self.min_score = min_score
+        self.min_coverage = min_coverage
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path or ":memory:", check_same_thread=False)
+        with self._lock:
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS books "
+                "(key TEXT PRIMARY KEY, title TEXT NOT NULL, author TEXT NOT NULL, seen INTEGER NOT NULL DEFAULT 1)"
+            )
+            self._conn.commit()
+        self._books = None
+        self._index = None
+        self._pending = []
+        self._lookups = 0
+        self._resolved = 0
+        self._build_seconds = 0.0
+
+    def load(self):
+        """
+        Read the catalog and build the index, if not done yet.
+        """
+        with self._lock:
+            if self._books is None:
+                self._rebuild()
+
+    def _rebuild(self):
+        start = time.perf_counter()
+        rows = self._conn.execute("SELECT title, author FROM books ORDER BY rowid").fetchall()
+        self._books = rows
+        self._index = NgramIndex([title + " " + author for title, author in rows])
+        self._pending = []
+        self._build_seconds = time.perf_counter() - start
+        logger.info("Built book catalog index", extra={"books": len(rows), "seconds": round(self._build_seconds, 3)})
+
+    def add(self, books):
+        """
+        Add (title, author) pairs. Books already in the catalog (ignoring case
+        and punctuation) are counted as seen again.
+
+        Returns:
+            int number of new books
+        """
+        rows = []
+        for title, author in books:
+            title, author = (title or "").strip(), (author or "").strip()
+            if len(trigrams(title)) >= MIN_TITLE_GRAMS:
+                rows.append((normalise(title) + "|" + normalise(author), title, author))
+        new = []
+        with self._lock:
+            for key, title, author in rows:
+                cursor = self._conn.execute(
+                    "INSERT OR IGNORE INTO books (key, title, author) VALUES (?, ?, ?)", (key, title, author))
+                if cursor.rowcount:
+                    new.append((title, author))
+                else:
+                    self._conn.execute("UPDATE books SET seen = seen + 1 WHERE key = ?", (key,))
+            self._conn.commit()
+            if self._books is not None:
+                self._pending.extend(new)
+                if len(self._pending) > CATALOG_REBUILD_AFTER:
+                    self._rebuild()
+        return len(new)
+
+    def resolve(self, text):
+        """
+        Match spine text to a known book.
+
+        A book matches if at least min_score of its title's trigrams are in
+        the text, and its title and author account for at least min_coverage
+        of the text's trigrams. Matches are scored by the mean of the shares
+        of title and author found and the coverage; if the runner-up scores
+        within AMBIGUITY_MARGIN of the best, the text is left unresolved.
+
+        Returns:
+            (title, author, score) or None
+        """
+        query = trigrams(text)
+        if not query:
+            return None
+        if self._books is None:
+            self.load()
+        with self._lock:
+            self._lookups += 1
+            candidates = [self._books[i] for i in self._index.search(query)] + self._pending
+        matches = {}
+        for title, author in candidates:
+            title_grams, author_grams = trigrams(title), trigrams(author)
+            if len(title_grams) < MIN_TITLE_GRAMS:
+                continue
+            title_score = len(title_grams & query) / len(title_grams)
+            if title_score < self.min_score:
+                continue
+            author_score = len(author_grams & query) / len(author_grams) if author_grams else 0.0
+            matched = title_grams | (author_grams if author_score >= self.min_score else set())
+            coverage = len(matched & query) / len(query)
+            if coverage < self.min_coverage:
+                continue
+            score = (title_score + author_score + coverage) / 3
+            key = normalise(title) + "|" + normalise(author)
+            if score > matches.get(key, (0.0,))[0]:
+                matches[key] = (score, title, author)
+        if not matches:
+            return None
+        ranked = sorted(matches.values(), reverse=True)
+        if len(ranked) > 1 and ranked[1][0] > ranked[0][0] - AMBIGUITY_MARGIN:
+            return None
+        score, title, author = ranked[0]
+        with self._lock:
+            self._resolved += 1
+        return title, author, score
+
+    def stats(self):
+        """
+        Return catalog size, lookups and how many were resolved.
+        """
+        with self._lock:
+            return {
+                "books": (len(self._books) if self._books is not None else 0) + len(self._pending),
+                "lookups": self._lookups,
+                "resolved": self._resolved,
+                "build_seconds": self._build_seconds,
+            }
+
+
+def read_dump(path):
+    """
+    Read (title, author) pairs from a CSV file with title and author columns,
+    or from JSON lines with title and author fields.
+    """
+    with open(path, newline="", encoding="utf-8") as f:
+        if path.endswith((".jsonl", ".json")):
+            for line in f:
+                if line.strip():
+                    item = json.loads(line)
+                    yield item.get("title", ""), item.get("author", "")
+        else:
+            for row in csv.DictReader(f):
+                yield row.get("title", ""), row.get("author", "")
+
+
+book_catalog = BookCatalog()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--db", default=CATALOG_DB, required=CATALOG_DB is None, help="Catalog SQLite file")
+    commands = parser.add_subparsers(dest="command", required=True)
+    import_parser = commands.add_parser("import", help="Add books from CSV or JSON lines files")
+    import_parser.add_argument("files", nargs="+")
+    lookup_parser = commands.add_parser("lookup", help="Resolve spine text")
+    lookup_parser.add_argument("text")
+    args = parser.parse_args()
+
+    catalog = BookCatalog(args.db)
+    if args.command == "import":
+        for path in args.files:
+            added = catalog.add(read_dump(path))
+            print(f"{path}: {added} new books")
+        catalog.load()
+        print(f"{catalog.stats()['books']} books in {args.db}")
+    else:
+        start = time.perf_counter()
+        catalog.load()
+        loaded = time.perf_counter()
+        match = catalog.resolve(args.text)
+        print(f"loaded in {loaded - start:.2f}s, lookup in {(time.perf_counter() - loaded) * 1000:.2f}ms")
+        print(match if match is not None else "no match")
+        sys.exit(0 if match is not None else 1)
+
+
+if __name__ == "__main__":
+    main()
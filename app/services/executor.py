@@ -0,0 +1,464 @@
+import asyncio
+import contextvars
+import functools
+import logging
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from contextlib import asynccontextmanager
+from multiprocessing import get_context, resource_tracker, shared_memory
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+PIPELINE_EXECUTOR = os.getenv("PIPELINE_EXECUTOR", "thread")
+PIPELINE_WORKERS = int(os.getenv("PIPELINE_WORKERS", str(os.cpu_count() or 1)))
+PIPELINE_MAX_INFLIGHT = int(os.getenv("PIPELINE_MAX_INFLIGHT", str(PIPELINE_WORKERS)))
+PIPELINE_MAX_QUEUE = int(os.getenv("PIPELINE_MAX_QUEUE", str(2 * PIPELINE_MAX_INFLIGHT)))
+PIPELINE_QUEUE_TIMEOUT = float(os.getenv("PIPELINE_QUEUE_TIMEOUT", "30"))
+PIPELINE_RETRY_AFTER = int(os.getenv("PIPELINE_RETRY_AFTER", "5"))
+
+# Process pool only: how workers are started ('spawn' or 'forkserver'; 'fork'
+# is unsafe once ONNX Runtime threads exist), the ONNX Runtime threads of each
+# worker's OCR engine, and the size from which arrays go through shared memory
+PIPELINE_START_METHOD = os.getenv("PIPELINE_START_METHOD", "spawn")
+PIPELINE_OCR_THREADS = int(os.getenv("PIPELINE_OCR_THREADS", str(max(1, (os.cpu_count() or 1) // PIPELINE_WORKERS))))
+SHARED_MEMORY_MIN_BYTES = int(os.getenv("SHARED_MEMORY_MIN_BYTES", str(64 * 1024)))
+
+# Shared memory blocks kept for the request being handled, if any (see
+# PipelineExecutor.admit). Tasks started while handling it inherit them.
+request_blocks_var = contextvars.ContextVar("request_blocks", default=None)
+
+
+class PipelineBusy(Exception):
+    """
+    Raised when a request cannot be admitted to the pipeline.
+    """
+    def __init__(self, retry_after=PIPELINE_RETRY_AFTER):
+        super().__init__("Pipeline is at capacity")
+        self.retry_after = retry_after
+
+
+class PipelineWorkerError(PipelineBusy):
+    """
+    Raised when a process pool worker died during a call. The pool has been
+    replaced, so the request can be retried.
+    """
+    def __init__(self, retry_after=PIPELINE_RETRY_AFTER):
+        super().__init__(retry_after)
+        self.args = ("Pipeline worker crashed",)
+
+
+class SharedArray:
+    """
+    Picklable reference to a NumPy array held in a shared memory block.
+    """
+    __slots__ = ("name", "shape", "dtype")
+
+    def __init__(self, name, shape, dtype):
+        self.name = name
+        self.shape = shape
+        self.dtype = dtype
+
+    def __getstate__(self):
+        return self.name, self.shape, self.dtype
+
+    def __setstate__(self, state):
+        self.name, self.shape, self.dtype = state
+
+
+def _to_shared(value, blocks, depth=2, kept=None):
+    """
+    Copy large arrays in `value` (or in lists and tuples in it, up to `depth`
+    levels) into new shared memory blocks, appended to `blocks`, and replace
+    them with SharedArray references. Arrays already in a block of `kept`
+    (a RequestBlocks) are referred to without a copy.
+    """
+    if isinstance(value, np.ndarray):
+        ref = kept.get(value) if kept is not None else None
+        if ref is not None:
+            return ref
+        if value.nbytes < SHARED_MEMORY_MIN_BYTES or value.dtype.hasobject:
+            return value
+        shm = shared_memory.SharedMemory(create=True, size=value.nbytes)
+        blocks.append(shm)
+        np.ndarray(value.shape, value.dtype, buffer=shm.buf)[...] = value
+        return SharedArray(shm.name, value.shape, value.dtype.str)
+    if depth and type(value) in (list, tuple):
+        return type(value)(_to_shared(item, blocks, depth - 1, kept) for item in value)
+    return value
+
+
+class _Mapping:
+    """
+    Owner of an attached shared memory block, exposed to NumPy as an array.
+
+    NumPy keeps a reference to the block's mmap but no buffer export, so
+    closing the handle would unmap memory that arrays still point at. Arrays
+    made from a _Mapping (and views of them) keep it, and so the handle,
+    alive instead; the block is unmapped once the last of them is freed.
+    """
+    def __init__(self, ref, readonly):
+        self.shm = shared_memory.SharedMemory(name=ref.name)
+        interface = np.ndarray(ref.shape, np.dtype(ref.dtype), buffer=self.shm.buf).__array_interface__
+        interface["data"] = (interface["data"][0], readonly)
+        self.__array_interface__ = interface
+
+
+def _from_shared(value, depth=2):
+    """
+    Inverse of _to_shared: replace SharedArray references with arrays backed
+    by their blocks. The arrays are read-only, since later stages of the
+    request may share the block.
+    """
+    if isinstance(value, SharedArray):
+        return np.asarray(_Mapping(value, readonly=True))
+    if depth and type(value) in (list, tuple):
+        return type(value)(_from_shared(item, depth - 1) for item in value)
+    return value
+
+
+def _close(blocks, unlink=False):
+    for shm in blocks:
+        shm.close()
+        if unlink:
+            shm.unlink()
+
+
+class RequestBlocks:
+    """
+    Shared memory blocks holding arrays of one request, e.g. its decoded
+    image, so that each stage it runs on the process pool is handed the same
+    block instead of a new copy. Blocks are unlinked by release(); the
+    arrays stay valid in this process for as long as they are referenced.
+    """
+    def __init__(self):
+        # id(array) -> (array, SharedArray)
+        self._arrays = {}
+        self.closed = False
+
+    def get(self, array):
+        """
+        Return the SharedArray reference of `array`, or None if it isn't held.
+        """
+        entry = self._arrays.get(id(array))
+        return entry[1] if entry is not None and entry[0] is array else None
+
+    def attach(self, ref):
+        """
+        Take over the block of an array result of _run_shared, without
+        copying it out.
+
+        Returns:
+            the array, backed by the block
+        """
+        array = np.asarray(_Mapping(ref, readonly=False))
+        self._arrays[id(array)] = (array, ref)
+        return array
+
+    def release(self):
+        """
+        Unlink all blocks. Later calls copy the arrays again, as before.
+        """
+        self.closed = True
+        for array, _ in self._arrays.values():
+            array.base.shm.unlink()
+        self._arrays.clear()
+
+
+def _run_shared(fn, args, kwargs):
+    """
+    Run `fn` in a pool worker on arguments from _to_shared. An array result is
+    returned through a new shared memory block, which the caller unlinks.
+
+    Returns:
+        (result, pid, stats of the worker's OCR engine pool)
+    """
+    from . import ocr
+
+    args = _from_shared(args)
+    kwargs = {key: _from_shared(value) for key, value in kwargs.items()}
+    result = fn(*args, **kwargs)
+    del args, kwargs
+    if isinstance(result, np.ndarray):
+        out = []
+        result = _to_shared(result, out, depth=0)
+        _close(out)
+    return result, os.getpid(), ocr.engine_pool.stats()
+
+
+def _collect(result):
+    """
+    Copy an array result of _run_shared out of its shared memory block and
+    free the block.
+    """
+    if not isinstance(result, SharedArray):
+        return result
+    shm = shared_memory.SharedMemory(name=result.name)
+    view = np.ndarray(result.shape, np.dtype(result.dtype), buffer=shm.buf)
+    array = view.copy()
+    del view
+    _close([shm], unlink=True)
+    return array
+
+
+def _discard(future):
+    """
+    Free the shared memory result of a call nobody is waiting for any more.
+    """
+    if not future.cancelled() and future.exception() is None:
+        _collect(future.result()[0])
+
+
+def _init_worker(ocr_threads):
+    """
+    Process pool worker initializer: give the worker one OCR engine of its
+    own, and run a dummy image through OCR and segmentation so that the first
+    real call doesn't pay for loading models.
+    """
+    from . import ocr
+    from .image_processing import segment_image
+    from .telemetry import configure_logging
+    from .warmup import warm_up_image
+
+    configure_logging()
+    ocr.engine_pool = ocr.OCREnginePool(size=1, intra_op_num_threads=ocr_threads)
+    try:
+        image = warm_up_image()
+        ocr.engine_pool.warm_up(image)
+        segment_image(image)
+    except Exception as e:
+        logger.exception("Pipeline worker warm-up failed: %s", e)
+
+
+class PipelineExecutor:
+    """
+    Runs CPU-bound pipeline stages off the event loop, with a bounded number of
+    requests in flight and a bounded queue of requests waiting for a slot.
+
+    With a process pool, stages run in worker processes, so pure-Python
+    stages scale past the GIL. Arrays of SHARED_MEMORY_MIN_BYTES or more
+    (e.g. decoded images), passed directly or in lists/tuples, are handed to
+    workers through shared memory rather than pickled, and array results
+    come back the same way. Within admit(), array results (e.g. the decoded
+    image) stay in their block until the request ends, and later stages of
+    the request are handed that block rather than a copy. Each worker has
+    its own warm OCR engine, whose pool stats it reports with every result.
+    If a worker dies, the pool is replaced and the call raises
+    PipelineWorkerError.
+
+    Arguments:
+        kind: 'thread' or 'process' pool.
+        workers: Number of pool workers.
+        max_inflight: Maximum number of requests admitted at once.
+        max_queue: Maximum number of requests waiting for admission; beyond
+                   this, admit() fails fast with PipelineBusy.
+        queue_timeout: Maximum time (in seconds) a request may wait for admission.
+
+    Methods:
+        admit(): Async context manager holding a pipeline slot for a request.
+        run(fn, *args, **kwargs): Run a stage on the pool and await its result.
+        start_workers(): Start (and warm up) every process pool worker.
+        stats(): Queue depth, in-flight count and wait times.
+        worker_ocr_stats(): OCR engine pool stats summed over process pool workers.
+    """
+    def __init__(self, kind=PIPELINE_EXECUTOR, workers=PIPELINE_WORKERS,
+                 max_inflight=PIPELINE_MAX_INFLIGHT, max_queue=PIPELINE_MAX_QUEUE,
+                 queue_timeout=PIPELINE_QUEUE_TIMEOUT):
+        if kind not in ('thread', 'process'):
+            raise ValueError("Invalid kind for PipelineExecutor")
+        self.kind = kind
+        self.workers = workers
+        # Created on first use: spawned workers import this module too, and
+        # must not each set up a pool of their own
+        self._pool = None
+        self._pool_lock = threading.Lock()
+        self._restarts = 0
+        self.max_inflight = max_inflight
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self._slots = asyncio.Semaphore(max_inflight)
+
+        # Counters, only touched from the event loop
+        self._inflight = 0
+        self._waiting = 0
+        self._admitted = 0
+        self._rejected = 0
+        self._wait_total = 0.0
+        self._wait_max = 0.0
+        # Latest OCR engine pool stats of each process pool worker, by pid
+        self._worker_ocr = {}
+
+    def _create_pool(self):
+        if self.kind == 'thread':
+            return ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="pipeline")
+        # Start the resource tracker first, so workers share it and shared
+        # memory blocks are tracked once across processes
+        resource_tracker.ensure_running()
+        return ProcessPoolExecutor(
+            max_workers=self.workers,
+            mp_context=get_context(PIPELINE_START_METHOD),
+            initializer=_init_worker,
+            initargs=(PIPELINE_OCR_THREADS,),
+        )
+
+    def _get_pool(self):
+        with self._pool_lock:
+            if self._pool is None:
+                self._pool = self._create_pool()
+            return self._pool
+
+    def _replace_pool(self, broken):
+        """
+        Replace a broken process pool, unless another call already has.
+        """
+        with self._pool_lock:
+            if self._pool is not broken:
+                return
+            logger.warning("Pipeline worker died, restarting the process pool")
+            self._pool = self._create_pool()
+            self._restarts += 1
+            self._worker_ocr.clear()
+        broken.shutdown(wait=False, cancel_futures=True)
+
+    def start_workers(self):
+        """
+        Start every process pool worker, running its initializer, and wait
+        until all are up.
+
+        Returns:
+            list of worker pids (empty for a thread pool)
+        """
+        if self.kind != 'process':
+            return []
+        pool = self._get_pool()
+        futures = [pool.submit(os.getpid) for _ in range(self.workers)]
+        return sorted({future.result() for future in futures})
+
+    @asynccontextmanager
+    async def admit(self):
+        """
+        Hold a pipeline slot for the duration of the block. With a process
+        pool, shared memory blocks kept for the request are freed at its end.
+
+        Raises:
+            PipelineBusy: if the queue is full or the wait exceeds queue_timeout
+        """
+        if self._inflight + self._waiting >= self.max_inflight + self.max_queue:
+            self._rejected += 1
+            raise PipelineBusy()
+
+        self._waiting += 1
+        start = time.monotonic()
+        try:
+            await asyncio.wait_for(self._slots.acquire(), timeout=self.queue_timeout)
+        except asyncio.TimeoutError:
+            self._rejected += 1
+            raise PipelineBusy()
+        finally:
+            self._waiting -= 1
+
+        wait = time.monotonic() - start
+        self._admitted += 1
+        self._wait_total += wait
+        self._wait_max = max(self._wait_max, wait)
+        self._inflight += 1
+        blocks = None
+        if self.kind == 'process':
+            blocks = RequestBlocks()
+            request_blocks_var.set(blocks)
+        try:
+            yield
+        finally:
+            self._inflight -= 1
+            self._slots.release()
+            if blocks is not None:
+                blocks.release()
+
+    async def run(self, fn, *args, **kwargs):
+        """
+        Run `fn(*args, **kwargs)` on the pool without blocking the event loop.
+        With a process pool, `fn` and its arguments must be picklable, and
+        arrays passed through shared memory must not be changed meanwhile.
+        """
+        if self.kind == "thread":
+            # Keep context variables such as the request id in worker threads
+            call = functools.partial(contextvars.copy_context().run, fn, *args, **kwargs)
+            return await asyncio.get_running_loop().run_in_executor(self._get_pool(), call)
+
+        kept = request_blocks_var.get()
+        if kept is not None and kept.closed:
+            kept = None
+        blocks = []
+        try:
+            shared_args = _to_shared(args, blocks, kept=kept)
+            shared_kwargs = {key: _to_shared(value, blocks, kept=kept) for key, value in kwargs.items()}
+            pool = self._get_pool()
+            try:
+                future = pool.submit(_run_shared, fn, shared_args, shared_kwargs)
+            except BrokenProcessPool:
+                self._replace_pool(pool)
+                raise PipelineWorkerError() from None
+            try:
+                result, pid, ocr_stats = await asyncio.wrap_future(future)
+            except asyncio.CancelledError:
+                future.add_done_callback(_discard)
+                raise
+            except BrokenProcessPool:
+                self._replace_pool(pool)
+                raise PipelineWorkerError() from None
+            self._worker_ocr[pid] = ocr_stats
+            if isinstance(result, SharedArray) and kept is not None and not kept.closed:
+                return kept.attach(result)
+            return _collect(result)
+        finally:
+            _close(blocks, unlink=True)
+
+    def stats(self):
+        """
+        Return a snapshot of the executor's queue and wait statistics.
+        """
+        return {
+            "kind": self.kind,
+            "workers": self.workers,
+            "max_inflight": self.max_inflight,
+            "max_queue": self.max_queue,
+            "inflight": self._inflight,
+            "queue_depth": self._waiting,
+            "admitted": self._admitted,
+            "rejected": self._rejected,
+            "mean_wait_seconds": self._wait_total / self._admitted if self._admitted else 0.0,
+            "max_wait_seconds": self._wait_max,
+            "restarts": self._restarts,
+        }
+
+    def worker_ocr_stats(self):
+        """
+        Return the OCR engine pool stats of the process pool workers, summed
+        (waits averaged over checkouts), as last reported by each worker.
+        """
+        reports = list(self._worker_ocr.values())
+        checkouts = sum(report["checkouts"] for report in reports)
+        return {
+            "workers": len(reports),
+            "size": sum(report["size"] for report in reports),
+            "created": sum(report["created"] for report in reports),
+            "idle": sum(report["idle"] for report in reports),
+            "checkouts": checkouts,
+            "mean_wait_seconds": (sum(report["mean_wait_seconds"] * report["checkouts"] for report in reports)
+                                  / checkouts if checkouts else 0.0),
+            "max_wait_seconds": max((report["max_wait_seconds"] for report in reports), default=0.0),
+        }
+
+    def shutdown(self):
+        """
+        Stop the pool, cancelling stages that have not started. Process pool
+        workers are waited for, so their queues and semaphores are released.
+        """
+        if self._pool is not None:
+            self._pool.shutdown(wait=self.kind == 'process', cancel_futures=True)
+
+
+pipeline = PipelineExecutor()
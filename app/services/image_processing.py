@@ -1,13 +1,36 @@
+import functools
+import heapq
+import logging
+import time
 import cv2
 import numpy as np
-import matplotlib.pyplot as plt
 
+logger = logging.getLogger(__name__)
 
-def read_image(image_path, max_dim):
-    image = cv2.imread(image_path)
-    if image.shape[2] == 3:
-        # Convert BGR → RGB if it looks like BGR (OpenCV default)
-        image = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
+
+def read_image(image, max_dim):
+    """
+    Load an image as RGB, downscaled so that neither side exceeds max_dim.
+
+    Args:
+        image: path to an image file, encoded image bytes (e.g. an upload),
+               or an already-decoded RGB array
+        max_dim: maximum height/width in pixels
+
+    Returns:
+        image: RGB image (H,W,3). Arrays that are already small enough are
+               returned as they are, without a copy.
+    """
+    if not isinstance(image, np.ndarray):
+        if isinstance(image, (bytes, bytearray, memoryview)):
+            image = cv2.imdecode(np.frombuffer(image, np.uint8), cv2.IMREAD_COLOR)
+        else:
+            image = cv2.imread(image)
+        if image is None:
+            raise ValueError("Could not decode image")
+        if image.shape[2] == 3:
+            # Convert BGR → RGB if it looks like BGR (OpenCV default)
+            image = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
     h, w = image.shape[:2]
     scale = min(max_dim / h, max_dim / w, 1.0)
     if scale < 1.0:
@@ -19,29 +42,42 @@ class SimpleSegmenter:
     A simple image segmenter that recursively splits an image into segments
 
     Arguments:
-        image_path: Path to the input image.
+        image: Path to the input image, encoded image bytes, or a decoded RGB array (see read_image).
         min_size: Minimum size (in pixels) for a segment to be considered for splitting.
         center_penalty: Penalty factor for splits near the center.
         soft_aspect_threshold: Aspect ratio threshold for applying center penalty softly.
         hard_aspect_threshold: Aspect ratio threshold beyond which splits are not allowed.
         score_threshold: Minimum score required to accept a split.
         min_child_ratio: Minimum ratio of child segment size to original image size to keep a segment.
+        grad_dtype: dtype of the precomputed gradient tables (np.float64, or np.float32 to halve memory).
+        stride: Step (in pixels) between candidate split positions.
+        batched: Score all candidate positions of a segment in one NumPy pass instead of one by one.
+        max_leaves: Optional cap on the number of leaf segments.
+        time_budget: Optional time limit (in seconds) for segment().
+        pyramid_levels: Number of times to halve the image for a coarse-to-fine search (0 searches
+                        at full resolution only).
+        pyramid_candidates: Coarse splits per direction that are refined at full resolution.
+        refine_window: Distance (in full-resolution pixels) around a coarse split to refine over;
+                       defaults to 2 * 2**pyramid_levels + stride.
     
     Methods:
         segment(): Perform segmentation and return list of segments.
         try_split(seg): Attempt to split a segment and return children if successful.
         score_split(seg, pos, direction, center_penalty): Score a potential split.
+        score_splits(seg, positions, direction, center_penalty): Score many potential splits at once.
         visualize_segments(segments, max_show=10): Visualize the segments.
         get_crops(segments): Return cropped images and their confidence scores.
     """
-    def __init__(self, image_path, min_size_factor=None,
+    def __init__(self, image, min_size_factor=None,
                  center_penalty=0.2, soft_aspect_threshold=3.0,
                  hard_aspect_threshold=5.0, score_threshold=0.2,
-                 min_child_ratio=0.3, max_dim=1024):
+                 min_child_ratio=0.3, max_dim=1024, grad_dtype=np.float64,
+                 stride=5, batched=True, max_leaves=None, time_budget=None,
+                 pyramid_levels=0, pyramid_candidates=5, refine_window=None):
         """
         Initialize the SimpleSegmenter with the given parameters.
         """
-        self.image = read_image(image_path, max_dim=max_dim)
+        self.image = read_image(image, max_dim=max_dim)
         self.gray = cv2.cvtColor(self.image, cv2.COLOR_BGR2GRAY)
         if min_size_factor is None:
             self.min_size = min(self.image.shape[:2]) // 20
@@ -52,45 +88,239 @@ class SimpleSegmenter:
         self.hard_aspect_threshold = hard_aspect_threshold
         self.score_threshold = score_threshold
         self.min_child_ratio = min_child_ratio
+        self.stride = stride
+        self.batched = batched
+        self.max_leaves = max_leaves
+        self.time_budget = time_budget
+        self.pyramid_levels = pyramid_levels
+        self.pyramid_candidates = pyramid_candidates
+        self.pyramid_factor = 2 ** pyramid_levels
+        self.refine_window = 2 * self.pyramid_factor + stride if refine_window is None else refine_window
+
+        # Gradient tables used to score splits in constant time, by pyramid level.
+        # With a pyramid, only the coarse level gets tables; the few full
+        # resolution splits refined per segment are scored from their bands.
+        self._tables = {}
+        if pyramid_levels:
+            coarse = self.gray
+            for _ in range(pyramid_levels):
+                coarse = cv2.pyrDown(coarse)
+            self._tables[pyramid_levels] = self._build_gradient_tables(coarse, grad_dtype)
+        else:
+            self._tables[0] = self._build_gradient_tables(self.gray, grad_dtype)
 
         # Confidence dictionary
         self.segment_confidence = {}
 
+    @staticmethod
+    def _build_gradient_tables(gray, dtype):
+        """
+        Precompute the |dx| and |dy| Sobel maps of a grayscale image, and
+        cumulative sums of them along the long axis of the bands they are
+        summed over.
+
+        The cumulative tables hold integer-valued sums well below 2**24 for any
+        realistic image, so float32 tables give the same scores as float64.
+
+        Args:
+            gray: grayscale image
+            dtype: np.float64 or np.float32
+
+        Returns:
+            (dx_table, dx, dy_table, dy)
+        """
+        ddepth = cv2.CV_32F if np.dtype(dtype) == np.float32 else cv2.CV_64F
+        h, w = gray.shape
+
+        # Vertical splits sum |dx| down columns
+        abs_dx = np.abs(cv2.Sobel(gray, ddepth, 1, 0, ksize=3))
+        dx_table = np.zeros((h + 1, w), dtype=dtype)
+        np.cumsum(abs_dx, axis=0, out=dx_table[1:])
+
+        # Horizontal splits sum |dy| along rows
+        abs_dy = np.abs(cv2.Sobel(gray, ddepth, 0, 1, ksize=3))
+        dy_table = np.zeros((h, w + 1), dtype=dtype)
+        np.cumsum(abs_dy, axis=1, out=dy_table[:, 1:])
+
+        # Raw central differences, needed to correct the rows at band ends
+        gray = gray.astype(np.int16)
+        dx = np.zeros_like(gray)
+        dx[:, 1:-1] = gray[:, 2:] - gray[:, :-2]
+        dy = np.zeros_like(gray)
+        dy[1:-1, :] = gray[2:, :] - gray[:-2, :]
+        return dx_table, dx, dy_table, dy
+
+    @staticmethod
+    def _band_profile(table, diff, lo, hi, a, b):
+        """
+        Per-column sums of |Sobel| over rows lo:hi for columns a:b, matching a
+        Sobel run on the band on its own.
+
+        Such a Sobel reflects at the band's borders, so its first and last
+        columns are zero (callers pass only the columns one in from each side)
+        and its first and last rows differ from the full-image map. The interior
+        rows come straight from the cumulative table; the two end rows are
+        rebuilt from the raw differences.
+
+        Args:
+            table: cumulative |Sobel| along axis 0, with a leading zero row
+            diff: raw central differences across axis 1
+            lo, hi: row range of the band
+            a, b: column range to profile
+
+        Returns:
+            np.ndarray: Sum of absolute gradients for each column in a:b
+        """
+        if b <= a or hi <= lo:
+            return np.zeros(max(b - a, 0))
+        if hi - lo == 1:
+            return np.abs(4.0 * diff[lo, a:b])
+
+        inner = table[hi - 1, a:b] - table[lo + 1, a:b]
+        top = np.abs(diff[lo, a:b] + diff[lo + 1, a:b])
+        bottom = np.abs(diff[hi - 1, a:b] + diff[hi - 2, a:b])
+        return inner + 2.0 * (top + bottom)
+
+    def _band_tables(self, seg, direction, level=0):
+        """
+        Return the gradient tables of pyramid `level` for `direction`, oriented
+        so that bands run down axis 0, along with the segment's extent in that
+        orientation.
+
+        Returns:
+            (table, diff, (lo, hi), (start, stop)) where lo:hi is the extent
+            along the band and start:stop the extent across split positions.
+        """
+        x1, y1, x2, y2 = seg
+        dx_table, dx, dy_table, dy = self._tables[level]
+        if direction == 'vertical':
+            return dx_table, dx, (y1, y2), (x1, x2)
+        return dy_table.T, dy.T, (x1, x2), (y1, y2)
+
+    def _coarse_candidates(self, seg, direction, positions):
+        """
+        Narrow the full-resolution split positions of a segment down to those
+        near the best splits found on the coarse pyramid level.
+
+        The coarse scores are only used to rank splits; the positions returned
+        are scored again at full resolution, so thresholds keep their meaning.
+
+        Args:
+            seg: (x1, y1, x2, y2) defining the segment
+            direction: 'vertical' or 'horizontal'
+            positions: range of full-resolution positions to split at
+
+        Returns:
+            List of windows, each the `positions` within refine_window of one
+            coarse split, or [positions] if the segment is too small to search
+            coarsely.
+        """
+        f = self.pyramid_factor
+        x1, y1, x2, y2 = seg
+        coarse_h, coarse_w = self._tables[self.pyramid_levels][1].shape
+        coarse_seg = (x1 // f, y1 // f, min(-(-x2 // f), coarse_w), min(-(-y2 // f), coarse_h))
+        cx1, cy1, cx2, cy2 = coarse_seg
+        start, stop = (cx1, cx2) if direction == 'vertical' else (cy1, cy2)
+        min_size = self.min_size // f
+        coarse_positions = np.arange(start + min_size, stop - min_size)
+        if min(cx2 - cx1, cy2 - cy1) < 2 or coarse_positions.size == 0:
+            return [positions]
+
+        scores = self.score_splits(coarse_seg, coarse_positions, direction, self.center_penalty,
+                                   level=self.pyramid_levels)
+
+        # Best peaks, suppressing neighbours that would refine to the same splits
+        suppress = max(1, self.refine_window // f)
+        peaks = []
+        for i in np.argsort(scores)[::-1]:
+            pos = int(coarse_positions[i]) * f
+            if all(abs(pos - p) > suppress * f for p in peaks):
+                peaks.append(pos)
+                if len(peaks) == self.pyramid_candidates:
+                    break
+
+        step = positions.step
+        windows = [
+            positions[max(0, -(-(p - self.refine_window - positions.start) // step)):
+                      max(0, (p + self.refine_window - positions.start) // step + 1)]
+            for p in peaks
+        ]
+        return [window for window in windows if window]
+
+    def _local_profile(self, seg, direction, a, b):
+        """
+        Per-position sums of |Sobel| across segment `seg` for positions a:b,
+        computed from the image directly rather than from gradient tables.
+
+        The Sobel runs on the band a-1:b+1 on its own, which reflects at the
+        segment's ends just as the band of a single split does, so the result
+        equals the profile _band_profile gives from the tables.
+        """
+        x1, y1, x2, y2 = seg
+        if b <= a:
+            return np.zeros(0)
+        if direction == 'vertical':
+            grad = cv2.Sobel(self.gray[y1:y2, a - 1:b + 1], cv2.CV_64F, 1, 0, ksize=3)
+        else:
+            grad = cv2.Sobel(self.gray[a - 1:b + 1, x1:x2], cv2.CV_64F, 0, 1, ksize=3).T
+        return np.abs(grad[:, 1:-1]).sum(axis=0)
+
     def segment(self):
         """
         Perform segmentation on the image and return list of segments.
         Each segment is represented as (x1, y1, x2, y2).
 
+        Every segment is tried exactly once. Pending splits sit in a priority
+        queue keyed on their score, so if max_leaves or time_budget cuts the
+        search short, the highest-scoring splits are the ones that were made.
+
         Returns:
             List of segments.
         """
         h, w = self.image.shape[:2]
-        segments = [(0, 0, w, h)]
-        self.segment_confidence[(0, 0, w, h)] = 1.0
-
-        changed = True
-        while changed:
-            changed = False
-            new_segments = []
-
-            for seg in segments:
-                split_result = self.try_split(seg)
-                if split_result:
-                    children, confidence = split_result
-                    for child in children:
-                        child_w = child[2] - child[0]
-                        child_h = child[3] - child[1]
-                        # only include if above min_child_ratio threshold
-                        if (child_w >= w * self.min_child_ratio or
-                            child_h >= h * self.min_child_ratio):
-                            self.segment_confidence[child] = confidence
-                    new_segments.extend(children)
-                    changed = True
-                else:
-                    new_segments.append(seg)
-
-            segments = new_segments
-            print(f"Now have {len(segments)} segments")
+        root = (0, 0, w, h)
+        confidence = {root: 1.0}
+        deadline = None if self.time_budget is None else time.monotonic() + self.time_budget
+
+        # Paths record each segment's position in the split tree (0 = first child),
+        # which gives leaves the same order as splitting every leaf pass by pass
+        pending = []
+        leaves = []
+
+        def visit(seg, path):
+            split_result = self.try_split(seg)
+            if split_result:
+                children, score = split_result
+                heapq.heappush(pending, (-score, path, seg, children))
+            else:
+                leaves.append((path, seg))
+
+        visit(root, ())
+        while pending:
+            if self.max_leaves is not None and len(leaves) + len(pending) >= self.max_leaves:
+                logger.info("Stopping segmentation at max_leaves=%d", self.max_leaves)
+                break
+            if deadline is not None and time.monotonic() >= deadline:
+                logger.info("Stopping segmentation after time_budget=%.3fs", self.time_budget)
+                break
+
+            neg_score, path, seg, children = heapq.heappop(pending)
+            for i, child in enumerate(children):
+                child_w = child[2] - child[0]
+                child_h = child[3] - child[1]
+                # only include if above min_child_ratio threshold
+                if (child_w >= w * self.min_child_ratio or
+                    child_h >= h * self.min_child_ratio):
+                    confidence[child] = -neg_score
+                visit(child, path + (i,))
+
+        # Anything still queued was not split
+        leaves.extend((path, seg) for _, path, seg, _ in pending)
+        leaves.sort(key=lambda leaf: leaf[0])
+        segments = [seg for _, seg in leaves]
+
+        # Keep confidences for leaves only
+        self.segment_confidence = {seg: confidence[seg] for seg in segments if seg in confidence}
 
         # Sort leaves by area
         sorted_segments = sorted(
@@ -99,7 +329,7 @@ class SimpleSegmenter:
             reverse=True
         )
 
-        print(f"\nFound {len(sorted_segments)} leaf segments.")
+        logger.info("Found %d leaf segments.", len(sorted_segments))
         return sorted_segments
 
     def try_split(self, seg):
@@ -123,21 +353,30 @@ class SimpleSegmenter:
         best_split = None
         best_score = self.score_threshold
 
-        # Vertical
-        if width >= self.min_size * 2:
-            for x in range(x1 + self.min_size, x2 - self.min_size, 5):
-                score = self.score_split(seg, x, 'vertical', self.center_penalty)
-                if score > best_score:
-                    best_score = score
-                    best_split = ('vertical', x)
-
-        # Horizontal
-        if height >= self.min_size * 2:
-            for y in range(y1 + self.min_size, y2 - self.min_size, 5):
-                score = self.score_split(seg, y, 'horizontal', self.center_penalty)
-                if score > best_score:
-                    best_score = score
-                    best_split = ('horizontal', y)
+        candidates = [
+            ('vertical', range(x1 + self.min_size, x2 - self.min_size, self.stride)),
+            ('horizontal', range(y1 + self.min_size, y2 - self.min_size, self.stride)),
+        ]
+        for direction, positions in candidates:
+            if not positions:
+                continue
+            # With a pyramid, only windows around the best coarse splits are scored
+            windows = self._coarse_candidates(seg, direction, positions) if self.pyramid_levels else [positions]
+            for window in windows:
+                if self.batched:
+                    scores = self.score_splits(seg, np.asarray(window), direction, self.center_penalty)
+                    pos = window[int(np.argmax(scores))]
+                    # Re-score the winner so confidences match the scalar path exactly
+                    score = self.score_split(seg, pos, direction, self.center_penalty)
+                    if score > best_score:
+                        best_score = score
+                        best_split = (direction, pos)
+                else:
+                    for pos in window:
+                        score = self.score_split(seg, pos, direction, self.center_penalty)
+                        if score > best_score:
+                            best_score = score
+                            best_split = (direction, pos)
 
         if best_split:
             direction, pos = best_split
@@ -168,23 +407,31 @@ class SimpleSegmenter:
         height = y2 - y1
 
         if direction == 'vertical':
-            split_band = self.gray[y1:y2, max(x1, pos - band_width):min(x2, pos + band_width)]
-            grad = cv2.Sobel(split_band, cv2.CV_64F, 1, 0, ksize=3)
+            band_lo, band_hi = max(x1, pos - band_width), min(x2, pos + band_width)
+            if 0 in self._tables:
+                dx_table, dx, _, _ = self._tables[0]
+                grad_sum = self._band_profile(dx_table, dx, y1, y2, band_lo + 1, band_hi - 1).sum()
+            else:
+                grad_sum = self._local_profile(seg, direction, band_lo + 1, band_hi - 1).sum()
             total_len = x2 - x1
             rel_pos = (pos - x1) / total_len
             cuts_shorter_side = width < height
 
             # Edge score
-            edge_score = np.sum(np.abs(grad)) / ((y2 - y1)**2)
+            edge_score = grad_sum / ((y2 - y1)**2)
         else:
-            split_band = self.gray[max(y1, pos - band_width):min(y2, pos + band_width), x1:x2]
-            grad = cv2.Sobel(split_band, cv2.CV_64F, 0, 1, ksize=3)
+            band_lo, band_hi = max(y1, pos - band_width), min(y2, pos + band_width)
+            if 0 in self._tables:
+                _, _, dy_table, dy = self._tables[0]
+                grad_sum = self._band_profile(dy_table.T, dy.T, x1, x2, band_lo + 1, band_hi - 1).sum()
+            else:
+                grad_sum = self._local_profile(seg, direction, band_lo + 1, band_hi - 1).sum()
             total_len = y2 - y1
             rel_pos = (pos - y1) / total_len
             cuts_shorter_side = height < width
 
             # Edge score
-            edge_score = np.sum(np.abs(grad)) / ((x2 - x1)**2)
+            edge_score = grad_sum / ((x2 - x1)**2)
 
         # Center penalty
         if cuts_shorter_side and max(width / height, height / width) > self.soft_aspect_threshold:
@@ -195,6 +442,48 @@ class SimpleSegmenter:
 
         return penalty * edge_score
 
+    def score_splits(self, seg, positions, direction, center_penalty, level=0):
+        """
+        Score every split in `positions` for segment `seg` in one pass; the
+        vectorised equivalent of calling score_split for each position.
+
+        Args:
+            seg: (x1, y1, x2, y2) defining the segment
+            positions: 1D integer array of positions to split at
+            direction: 'vertical' or 'horizontal'
+            center_penalty: Penalty factor for center splits
+            level: Pyramid level that `seg` and `positions` are given at
+
+        Returns:
+            np.ndarray: Score of each split
+        """
+        x1, y1, x2, y2 = seg
+        band_width = 3
+        width = x2 - x1
+        height = y2 - y1
+        if level in self._tables:
+            table, diff, (lo, hi), (start, stop) = self._band_tables(seg, direction, level)
+            # Gradient profile across the segment, then band sums from its cumulative sum
+            profile = self._band_profile(table, diff, lo, hi, start, stop)
+        else:
+            # No tables at this level: profile just the positions' bands from the image
+            (lo, hi), (start, stop) = ((y1, y2), (x1, x2)) if direction == 'vertical' else ((x1, x2), (y1, y2))
+            a = max(start, int(positions.min()) - band_width) + 1
+            b = min(stop, int(positions.max()) + band_width) - 1
+            profile = np.zeros(stop - start)
+            profile[a - start:max(a, b) - start] = self._local_profile(seg, direction, a, b)
+        cum_profile = np.concatenate(([0.0], np.cumsum(profile)))
+        band_lo = np.maximum(start, positions - band_width) + 1 - start
+        band_hi = np.maximum(np.minimum(stop, positions + band_width) - 1 - start, band_lo)
+        edge_scores = (cum_profile[band_hi] - cum_profile[band_lo]) / ((hi - lo)**2)
+
+        # Center penalty
+        cuts_shorter_side = width < height if direction == 'vertical' else height < width
+        if cuts_shorter_side and max(width / height, height / width) > self.soft_aspect_threshold:
+            return edge_scores
+        dist_from_center = np.abs((positions - start) / (stop - start) - 0.5) * 2
+        return (dist_from_center ** (1 + center_penalty)) * edge_scores
+
     def visualize_segments(self, segments, max_show=10):
         """
         Visualize the segments on the image.
@@ -203,6 +492,9 @@ class SimpleSegmenter:
             segments: List of segments to visualize.
             max_show: Maximum number of segments to show.
         """
+        # Imported here as matplotlib is slow to load and only needed for notebooks
+        import matplotlib.pyplot as plt
+
         n = min(len(segments), max_show)
         plt.figure(figsize=(12, 3 * n))
         for i, seg in enumerate(segments[:n]):
@@ -234,10 +526,39 @@ class SimpleSegmenter:
         return crops
 
 
+def segment_image(image, **params):
+    """
+    Segment an image with SimpleSegmenter.
+
+    Args:
+        image: image accepted by SimpleSegmenter (path, bytes or RGB array)
+        **params: keyword arguments for SimpleSegmenter
+
+    Returns:
+        (segments, confidences): leaf segments sorted by area, and the
+                                 confidence of each (0 if it has none)
+    """
+    segmenter = SimpleSegmenter(image, **params)
+    segments = segmenter.segment()
+    confidences = [segmenter.segment_confidence.get(seg, 0) for seg in segments]
+    return segments, confidences
+
+
+# Encoded output formats for encode_image: (extension, media type, quality flag)
+HIGHLIGHT_FORMATS = {
+    "png": (".png", "image/png", None),
+    "jpeg": (".jpg", "image/jpeg", cv2.IMWRITE_JPEG_QUALITY),
+    "webp": (".webp", "image/webp", cv2.IMWRITE_WEBP_QUALITY),
+}
+
+
 def mean_value_spine_image(img, spines):
     """
     Produce a mean-valued version of the image based on spine bounding boxes.
 
+    Means are taken with cv2.mean, which reduces each uint8 region in place
+    rather than through a float64 copy as ndarray.mean does.
+
     Args:
         img: Original image (H,W,3)
         spines: list of 4-tuples [(x1,y1,x2,y2), ...]
@@ -245,16 +566,50 @@ def mean_value_spine_image(img, spines):
     Returns:
         mean_img: Image where each spine segment is filled with its mean color
     """
+    channels = img.shape[2] if img.ndim == 3 else 1
+    means = [cv2.mean(img[y1:y2, x1:x2])[:channels] for x1, y1, x2, y2 in spines]
     mean_img = img.copy()
 
-    for x1, y1, x2, y2 in spines:
-        seg = img[y1:y2, x1:x2]
-        mean_val = seg.mean(axis=(0,1)).astype(np.uint8)
+    for (x1, y1, x2, y2), mean_val in zip(spines, np.array(means, dtype=np.float64).astype(np.uint8)):
         mean_img[y1:y2, x1:x2] = mean_val
 
     return mean_img
 
 
+@functools.lru_cache(maxsize=256)
+def dash_segments(x1, y1, x2, y2, dash_length):
+    """
+    Endpoints of the dashes of a dashed box, as an (N, 2, 2) int32 array ready
+    for cv2.polylines. Cached, since the same boxes are highlighted repeatedly.
+    """
+    step = dash_length * 2
+    xs = np.arange(x1, x2, step)
+    ys = np.arange(y1, y2, step)
+    xe = np.minimum(xs + dash_length, x2)
+    ye = np.minimum(ys + dash_length, y2)
+    dashes = np.concatenate([
+        np.stack([np.stack([xs, np.full_like(xs, y1)], 1), np.stack([xe, np.full_like(xs, y1)], 1)], 1),
+        np.stack([np.stack([xs, np.full_like(xs, y2)], 1), np.stack([xe, np.full_like(xs, y2)], 1)], 1),
+        np.stack([np.stack([np.full_like(ys, x1), ys], 1), np.stack([np.full_like(ys, x1), ye], 1)], 1),
+        np.stack([np.stack([np.full_like(ys, x2), ys], 1), np.stack([np.full_like(ys, x2), ye], 1)], 1),
+    ]).astype(np.int32)
+    dashes.setflags(write=False)
+    return dashes
+
+
+def _clip_dashed_span(start, stop, size, dash_length, thickness):
+    """
+    Clip one side of a dashed box to just outside an image of `size` pixels,
+    keeping the dash pattern in phase, so that a box far larger than the
+    image draws the same pixels without generating millions of dashes.
+    """
+    step = dash_length * 2
+    margin = step + thickness
+    if start < -margin:
+        start += (-margin - start) // step * step
+    return start, min(stop, size + margin)
+
+
 def visualize_selected_segments(img, selected_segments, color = (255, 165, 0), thickness = 4, dash_length = 5):
     """
     Create mean-valued segmentation image and highlight selected segments.
@@ -266,15 +621,88 @@ def visualize_selected_segments(img, selected_segments, color = (255, 165, 0), t
     Returns:
         vis_img: mean-valued image with orange dashed boxes around selected segments
     """
+    h, w = img.shape[:2]
     for string, (x1, y1, x2, y2) in selected_segments:
-        seg = img[y1:y2, x1:x2]
-
-        # Draw orange dashed box
-        for i in range(x1, x2, dash_length*2):
-            cv2.line(img, (i, y1), (min(i+dash_length, x2), y1), color, thickness)
-            cv2.line(img, (i, y2), (min(i+dash_length, x2), y2), color, thickness)
-        for i in range(y1, y2, dash_length*2):
-            cv2.line(img, (x1, i), (x1, min(i+dash_length, y2)), color, thickness)
-            cv2.line(img, (x2, i), (x2, min(i+dash_length, y2)), color, thickness)
+        # Draw orange dashed box, all dashes in one call
+        x1, x2 = _clip_dashed_span(int(x1), int(x2), w, dash_length, thickness)
+        y1, y2 = _clip_dashed_span(int(y1), int(y2), h, dash_length, thickness)
+        dashes = dash_segments(x1, y1, x2, y2, dash_length)
+        if len(dashes):
+            cv2.polylines(img, list(dashes), False, color, thickness)
 
     return img
+
+
+def scale_segments(segments, scale):
+    """
+    Scale (x1,y1,x2,y2) segments, rounding shared edges to the same pixel so
+    that neighbouring segments still tile the image.
+    """
+    return [tuple(int(round(v * scale)) for v in seg) for seg in segments]
+
+
+def draw_highlight(img, spines, selected_segment, max_dim=None):
+    """
+    Draw the mean-valued spine image with one segment highlighted.
+
+    Args:
+        img: Original image (H,W,3), RGB
+        spines: list of 4-tuples [(x1,y1,x2,y2), ...]
+        selected_segment: [x1,y1,x2,y2] to highlight
+        max_dim: If set, downscale so that the longest side is at most this
+                 before drawing, which shrinks drawing, encoding and output
+
+    Returns:
+        RGB image
+    """
+    if max_dim and max(img.shape[:2]) > max_dim:
+        scale = max_dim / max(img.shape[:2])
+        h, w = img.shape[:2]
+        img = cv2.resize(img, (max(1, round(w * scale)), max(1, round(h * scale))), interpolation=cv2.INTER_AREA)
+        spines = scale_segments(spines, scale)
+        selected_segment = scale_segments([selected_segment], scale)[0]
+
+    # Create flat spine image
+    img_spines = mean_value_spine_image(img, spines)
+
+    # Highlight segment
+    return visualize_selected_segments(img_spines, [("", selected_segment)])
+
+
+def encode_image(img, format="png", quality=None):
+    """
+    Encode an RGB image.
+
+    Args:
+        img: RGB image
+        format: 'png', 'jpeg' or 'webp' (see HIGHLIGHT_FORMATS)
+        quality: JPEG/WebP quality from 1 to 100, or None for OpenCV's default
+
+    Returns:
+        bytes: encoded image
+    """
+    if format not in HIGHLIGHT_FORMATS:
+        raise ValueError(f"Unsupported format {format!r}, expected one of {sorted(HIGHLIGHT_FORMATS)}")
+    extension, _, quality_flag = HIGHLIGHT_FORMATS[format]
+
+    # Ensure colours correct
+    img_bgr = cv2.cvtColor(img, cv2.COLOR_RGB2BGR)
+
+    params = [quality_flag, int(quality)] if quality_flag is not None and quality is not None else []
+    success, encoded_image = cv2.imencode(extension, img_bgr, params)
+    if not success:
+        raise RuntimeError("Failed to encode image")
+    return encoded_image.tobytes()
+
+
+def render_highlight(img, spines, selected_segment, format="png", quality=None, max_dim=None):
+    """
+    Render the mean-valued spine image with one segment highlighted, and
+    encode it (see draw_highlight and encode_image).
+
+    Returns:
+        bytes: encoded image
+    """
+    if format not in HIGHLIGHT_FORMATS:
+        raise ValueError(f"Unsupported format {format!r}, expected one of {sorted(HIGHLIGHT_FORMATS)}")
+    return encode_image(draw_highlight(img, spines, selected_segment, max_dim), format, quality)
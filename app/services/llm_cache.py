@@ -0,0 +1,219 @@
+import hashlib
+import json
+import logging
+import os
+import re
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from pydantic import TypeAdapter
+
+logger = logging.getLogger(__name__)
+
+LLM_CACHE_SIZE = int(os.getenv("LLM_CACHE_SIZE", "256"))
+LLM_CACHE_TTL = float(os.getenv("LLM_CACHE_TTL", "86400"))
+LLM_CACHE_DB = os.getenv("LLM_CACHE_DB")
+# SQLite backend only: seconds between purges of expired entries
+LLM_CACHE_PURGE_INTERVAL = float(os.getenv("LLM_CACHE_PURGE_INTERVAL", "3600"))
+
+
+def normalize_prompt(text):
+    """
+    Normalise prompt text so trivially different OCR output shares a cache entry:
+    case-folded, with runs of whitespace collapsed.
+    """
+    return re.sub(r"\s+", " ", text).strip().casefold()
+
+
+class SQLiteLLMBackend:
+    """
+    Persistent store of LLM responses in a SQLite file, with TTL expiry.
+
+    At most every `purge_interval` seconds, a write also deletes all expired
+    entries, so keys that are never read again don't pile up.
+
+    Arguments:
+        path: Path to the SQLite database (created if missing).
+        ttl: Time-to-live (in seconds) of an entry.
+        purge_interval: Minimum time (in seconds) between purges.
+    """
+    def __init__(self, path, ttl=LLM_CACHE_TTL, purge_interval=LLM_CACHE_PURGE_INTERVAL):
+        self.path = path
+        self.ttl = ttl
+        self.purge_interval = purge_interval
+        self._last_purge = time.monotonic()
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        with self._lock:
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS llm_cache "
+                "(key TEXT PRIMARY KEY, value TEXT NOT NULL, created REAL NOT NULL)"
+            )
+            self._conn.commit()
+
+    def get(self, key):
+        """
+        Return the stored JSON string for `key`, or None if missing or expired.
+        """
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT value, created FROM llm_cache WHERE key = ?", (key,)
+            ).fetchone()
+            if row is None:
+                return None
+            value, created = row
+            if time.time() - created > self.ttl:
+                self._conn.execute("DELETE FROM llm_cache WHERE key = ?", (key,))
+                self._conn.commit()
+                return None
+            return value
+
+    def set(self, key, value):
+        """
+        Store a JSON string under `key`.
+        """
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO llm_cache (key, value, created) VALUES (?, ?, ?)",
+                (key, value, time.time()),
+            )
+            self._conn.commit()
+
+        now = time.monotonic()
+        if now - self._last_purge >= self.purge_interval:
+            self._last_purge = now
+            self.purge_expired()
+
+    def purge_expired(self):
+        """
+        Delete all expired entries.
+
+        Returns:
+            int number of entries deleted
+        """
+        with self._lock:
+            removed = self._conn.execute(
+                "DELETE FROM llm_cache WHERE created < ?", (time.time() - self.ttl,)
+            ).rowcount
+            self._conn.commit()
+        if removed:
+            logger.info("Purged LLM cache", extra={"removed": removed})
+        return removed
+
+
+class LLMResponseCache:
+    """
+    Cache of parsed LLM responses: an in-memory LRU tier in front of an
+    optional persistent backend such as SQLiteLLMBackend.
+
+    Arguments:
+        max_size: Maximum number of entries held in memory.
+        ttl: Time-to-live (in seconds) of an in-memory entry.
+        backend: Optional persistent store consulted on a memory miss.
+
+    Methods:
+        key(model, mode, prompt, description): Build a cache key.
+        get(key, schema): Return the cached response parsed as `schema`, or None.
+        set(key, value, schema): Store a parsed response.
+        stats(): Hit and miss counters.
+    """
+    def __init__(self, max_size=LLM_CACHE_SIZE, ttl=LLM_CACHE_TTL, backend=None):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.backend = backend
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._memory_hits = 0
+        self._backend_hits = 0
+        self._misses = 0
+
+    @staticmethod
+    def key(model, mode, prompt, description=""):
+        """
+        Build a cache key from the model, mode, normalised prompt and user description.
+        """
+        parts = [model, mode, normalize_prompt(prompt), normalize_prompt(description or "")]
+        return hashlib.sha256(json.dumps(parts).encode()).hexdigest()
+
+    def get(self, key, schema):
+        """
+        Look up a response.
+
+        Args:
+            key: from LLMResponseCache.key
+            schema: pydantic model (or list of one) the response was parsed into
+
+        Returns:
+            Parsed response, or None on a miss
+        """
+        now = time.monotonic()
+        with self._lock:
+            item = self._entries.get(key)
+            if item is not None:
+                stored_at, value = item
+                if now - stored_at <= self.ttl:
+                    self._entries.move_to_end(key)
+                    self._memory_hits += 1
+                    return value
+                del self._entries[key]
+
+        if self.backend is not None:
+            stored = self.backend.get(key)
+            if stored is not None:
+                try:
+                    value = TypeAdapter(schema).validate_json(stored)
+                except ValueError:
+                    value = None
+                if value is not None:
+                    self._store(key, value)
+                    with self._lock:
+                        self._backend_hits += 1
+                    return value
+
+        with self._lock:
+            self._misses += 1
+        return None
+
+    def set(self, key, value, schema):
+        """
+        Store a parsed response in memory and in the backend, if any.
+        """
+        self._store(key, value)
+        if self.backend is not None:
+            try:
+                self.backend.set(key, TypeAdapter(schema).dump_json(value).decode())
+            except sqlite3.Error as e:
+                logger.warning("Error writing LLM cache entry: %s", e)
+
+    def _store(self, key, value):
+        with self._lock:
+            self._entries[key] = (time.monotonic(), value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def stats(self):
+        """
+        Return hit and miss counters.
+        """
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "memory_hits": self._memory_hits,
+                "backend_hits": self._backend_hits,
+                "misses": self._misses,
+            }
+
+    def clear(self):
+        """
+        Drop all in-memory entries.
+        """
+        with self._lock:
+            self._entries.clear()
+
+
+llm_cache = LLMResponseCache(
+    backend=SQLiteLLMBackend(LLM_CACHE_DB) if LLM_CACHE_DB else None
+)
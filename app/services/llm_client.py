@@ -1,15 +1,217 @@
+import asyncio
+import logging
 import os
+import random
+import threading
+import time
+from collections import deque
 from dotenv import load_dotenv
-from google import genai
-from pydantic import BaseModel
+from pydantic import BaseModel, TypeAdapter
+from .llm_cache import llm_cache
+from .telemetry import span, LLM_CALLS, LLM_HEDGES
 
 load_dotenv()
 
+logger = logging.getLogger(__name__)
+
 GEMINI_API_KEY = os.getenv("GEMINI_API_KEY")
 DEFAULT_MODEL = os.getenv("GEMINI_MODEL", "gemini-2.5-flash")
 
-# Initialize Gemini client
-client = genai.Client(api_key=GEMINI_API_KEY)
+# Per-attempt timeout and overall deadline for a call, in seconds
+GEMINI_TIMEOUT = float(os.getenv("GEMINI_TIMEOUT", "30"))
+GEMINI_DEADLINE = float(os.getenv("GEMINI_DEADLINE", "60"))
+GEMINI_MAX_RETRIES = int(os.getenv("GEMINI_MAX_RETRIES", "2"))
+GEMINI_BACKOFF_BASE = float(os.getenv("GEMINI_BACKOFF_BASE", "0.5"))
+GEMINI_BACKOFF_MAX = float(os.getenv("GEMINI_BACKOFF_MAX", "8"))
+GEMINI_MAX_CONCURRENCY = int(os.getenv("GEMINI_MAX_CONCURRENCY", "8"))
+GEMINI_MAX_CONNECTIONS = int(os.getenv("GEMINI_MAX_CONNECTIONS", "20"))
+
+# Latency policy: a faster model to fall back on when the deadline is close,
+# and a duplicate ("hedged") request fired once a call has taken longer than
+# the given quantile of recent latencies (or GEMINI_HEDGE_DELAY, if set)
+GEMINI_FALLBACK_MODEL = os.getenv("GEMINI_FALLBACK_MODEL")
+GEMINI_HEDGE = os.getenv("GEMINI_HEDGE", "1") == "1"
+GEMINI_HEDGE_DELAY = float(os.getenv("GEMINI_HEDGE_DELAY", "0")) or None
+GEMINI_HEDGE_QUANTILE = float(os.getenv("GEMINI_HEDGE_QUANTILE", "0.95"))
+GEMINI_HEDGE_MIN_DELAY = float(os.getenv("GEMINI_HEDGE_MIN_DELAY", "1"))
+GEMINI_LATENCY_WINDOW = int(os.getenv("GEMINI_LATENCY_WINDOW", "200"))
+GEMINI_LATENCY_MIN_SAMPLES = int(os.getenv("GEMINI_LATENCY_MIN_SAMPLES", "20"))
+
+RETRYABLE_STATUS_CODES = {408, 429, 500, 502, 503, 504}
+
+# Gemini client, created on first use since the SDK is slow to import
+_client = None
+_client_lock = threading.Lock()
+
+
+def get_client():
+    """
+    Return the shared Gemini client, creating it on first use. Async calls
+    share one pooled HTTP client.
+    """
+    global _client
+    if _client is None:
+        with _client_lock:
+            if _client is None:
+                import httpx
+                from google import genai
+                from google.genai import types
+
+                _client = genai.Client(
+                    api_key=GEMINI_API_KEY,
+                    http_options=types.HttpOptions(
+                        timeout=int(GEMINI_TIMEOUT * 1000),
+                        httpx_async_client=httpx.AsyncClient(
+                            timeout=GEMINI_TIMEOUT,
+                            limits=httpx.Limits(
+                                max_connections=GEMINI_MAX_CONNECTIONS,
+                                max_keepalive_connections=GEMINI_MAX_CONNECTIONS,
+                            ),
+                        ),
+                    ),
+                )
+    return _client
+
+
+# Keeps concurrent async calls under quota
+_llm_slots = asyncio.Semaphore(GEMINI_MAX_CONCURRENCY)
+
+
+class LLMError(Exception):
+    """
+    Raised when the LLM could not produce a usable response.
+    """
+
+
+class LLMTimeoutError(LLMError):
+    """
+    Raised when a call ran out of time, including retries.
+    """
+
+
+class LLMUnavailableError(LLMError):
+    """
+    Raised when the LLM kept failing with retryable errors (rate limits, server errors, network).
+    """
+
+
+class LLMResponseError(LLMError):
+    """
+    Raised when the LLM response could not be parsed into the expected schema.
+    """
+
+
+class LatencyTracker:
+    """
+    Recent latencies of successful calls to one model.
+
+    Arguments:
+        window: Number of latencies kept.
+        min_samples: Latencies needed before quantile() gives an estimate.
+    """
+    def __init__(self, window=GEMINI_LATENCY_WINDOW, min_samples=GEMINI_LATENCY_MIN_SAMPLES):
+        self.min_samples = min_samples
+        self._samples = deque(maxlen=window)
+        self._lock = threading.Lock()
+
+    def record(self, seconds):
+        with self._lock:
+            self._samples.append(seconds)
+
+    def quantile(self, q):
+        """
+        Return the q-quantile of recent latencies, or None without enough samples.
+        """
+        with self._lock:
+            if len(self._samples) < self.min_samples:
+                return None
+            samples = sorted(self._samples)
+        return samples[min(len(samples) - 1, int(q * len(samples)))]
+
+
+class GeminiBackend:
+    """
+    Backend that calls Gemini through the shared client.
+
+    Methods:
+        generate(prompt, response_schema, model): Return the parsed response, or None.
+        stream(prompt, response_schema, model): Yield the JSON response text in chunks.
+    """
+    async def generate(self, prompt, response_schema, model):
+        response = await get_client().aio.models.generate_content(
+            model=model,
+            contents=prompt,
+            config={
+                "response_mime_type": "application/json",
+                "response_schema": response_schema,
+            }
+        )
+        return response.parsed
+
+    async def stream(self, prompt, response_schema, model):
+        stream = await get_client().aio.models.generate_content_stream(
+            model=model,
+            contents=prompt,
+            config={
+                "response_mime_type": "application/json",
+                "response_schema": response_schema,
+            }
+        )
+        async for chunk in stream:
+            if chunk.text:
+                yield chunk.text
+
+
+class FakeLLMBackend:
+    """
+    Local stand-in for GeminiBackend, for trying out the latency policy
+    without calling Gemini.
+
+    Arguments:
+        respond: Callable (prompt, response_schema, model) -> parsed response.
+        latency: Seconds to wait before responding, or a callable
+                 (model) -> seconds, e.g. to make one model slow.
+        chunk_size: Characters per chunk of a streamed response.
+    """
+    def __init__(self, respond, latency=0.0, chunk_size=16):
+        self.respond = respond
+        self.latency = latency
+        self.chunk_size = chunk_size
+        self.calls = []
+
+    async def generate(self, prompt, response_schema, model):
+        self.calls.append(model)
+        delay = self.latency(model) if callable(self.latency) else self.latency
+        await asyncio.sleep(delay)
+        return self.respond(prompt, response_schema, model)
+
+    async def stream(self, prompt, response_schema, model):
+        parsed = await self.generate(prompt, response_schema, model)
+        text = TypeAdapter(response_schema).dump_json(parsed).decode()
+        for i in range(0, len(text), self.chunk_size):
+            yield text[i:i + self.chunk_size]
+
+
+llm_backend = GeminiBackend()
+_latencies = {}
+
+
+def set_llm_backend(backend):
+    """
+    Replace the backend used by generate_async and generate_stream_async
+    (e.g. with a FakeLLMBackend), and forget latencies observed with the
+    previous one.
+    """
+    global llm_backend
+    llm_backend = backend
+    _latencies.clear()
+
+
+def _latency_tracker(model):
+    tracker = _latencies.get(model)
+    if tracker is None:
+        tracker = _latencies.setdefault(model, LatencyTracker())
+    return tracker
 
 PROMPT_BOOKS = """
     You are an assistant that reads messy OCR text from books on a bookshelf.
@@ -167,7 +369,7 @@ def get_books_from_ocr(ocr_data):
 
     try:
         # Call Gemini API
-        response = client.models.generate_content(
+        response = get_client().models.generate_content(
             model=DEFAULT_MODEL,
             contents=PROMPT_BOOKS+ocr_data,
             config={
@@ -181,7 +383,7 @@ def get_books_from_ocr(ocr_data):
         return books
 
     except Exception as e:
-        print("Error calling Gemini API:", e)
+        logger.warning("Error calling Gemini API: %s", e)
         # fallback: return empty list
         return []
 
@@ -212,37 +414,59 @@ def format_books_for_prompt(books: list[BookInfo], confidence_threshold: float)
     return " // ".join(lines)
 
 
+def bookshelf_prompt(books_string, mode):
+    """
+    Build the prompt and response schema for analyse_bookshelf.
+
+    Args:
+        books_string: str describing the books (OCR text or formatted BookInfo)
+        mode: str, one of 'three_words', 'recommendation', 'scores', 'analysis'
+
+    Returns:
+        (prompt, response_schema)
+    """
+    if mode == 'three_words':
+        return PROMPT_THREE_WORDS + books_string, ThreeWords
+    elif mode == 'recommendation':
+        return PROMPT_RECOMMEND_BOOK + books_string, Recommendation
+    elif mode == 'scores':
+        return PROMPT_BOOKSHELF_SCORES + books_string, BookshelfScores
+    elif mode == 'analysis':
+        return PROMPT_ANALYSE_SHELF + books_string, BookshelfAnalysis
+    else:
+        raise ValueError("Invalid mode for analyse_bookshelf")
+
+
+def library_prompt(books_string, user_string):
+    """
+    Build the prompt for analyse_library.
+    """
+    return PROMPT_LIBRARY_SHELF + "BOOKS: " + books_string + "\nUSER INFO: " + user_string
+
+
 def analyse_bookshelf(books_string, mode):
     """
     Analyse the bookshelf based on identified books.
     
     Args:
         books: List of BookInfo objects
-        mode: str, one of 'three_words', 'recommendation', 'scores'
+        mode: str, one of 'three_words', 'recommendation', 'scores', 'analysis'
         
     Returns:
         Depending on mode:
         - 'three_words': str of three words
         - 'recommendation': Recommendation object
         - 'scores': BookshelfScores object
+        - 'analysis': BookshelfAnalysis object
     """
-    if mode == 'three_words':
-        prompt = PROMPT_THREE_WORDS + books_string
-        response_schema = ThreeWords
-    elif mode == 'recommendation':
-        prompt = PROMPT_RECOMMEND_BOOK + books_string
-        response_schema = Recommendation
-    elif mode == 'scores':
-        prompt = PROMPT_BOOKSHELF_SCORES + books_string
-        response_schema = BookshelfScores
-    elif mode == 'analysis':
-        prompt = PROMPT_ANALYSE_SHELF + books_string
-        response_schema = BookshelfAnalysis
-    else:
-        raise ValueError("Invalid mode for analyse_bookshelf")
+    prompt, response_schema = bookshelf_prompt(books_string, mode)
+    cache_key = llm_cache.key(DEFAULT_MODEL, mode, books_string)
+    cached = llm_cache.get(cache_key, response_schema)
+    if cached is not None:
+        return cached
 
     try:
-        response = client.models.generate_content(
+        response = get_client().models.generate_content(
             model=DEFAULT_MODEL,
             contents=prompt,
             config={
@@ -251,10 +475,12 @@ def analyse_bookshelf(books_string, mode):
             }
         )
 
+        if response.parsed is not None:
+            llm_cache.set(cache_key, response.parsed, response_schema)
         return response.parsed
 
     except Exception as e:
-        print("Error calling Gemini API:", e)
+        logger.warning("Error calling Gemini API: %s", e)
         return None
 
 
@@ -266,10 +492,14 @@ def analyse_library(books_string, user_string):
         books_string: Book spines scanned
         user_string: User tastes info
     """
-    prompt = PROMPT_LIBRARY_SHELF + "BOOKS: " + books_string + "\nUSER INFO: " + user_string
+    prompt = library_prompt(books_string, user_string)
+    cache_key = llm_cache.key(DEFAULT_MODEL, 'library', books_string, user_string)
+    cached = llm_cache.get(cache_key, LibraryAnalysis)
+    if cached is not None:
+        return cached
 
     try:
-        response = client.models.generate_content(
+        response = get_client().models.generate_content(
             model=DEFAULT_MODEL,
             contents=prompt,
             config={
@@ -278,8 +508,348 @@ def analyse_library(books_string, user_string):
             }
         )
 
+        if response.parsed is not None:
+            llm_cache.set(cache_key, response.parsed, LibraryAnalysis)
         return response.parsed
 
     except Exception as e:
-        print("Error calling Gemini API:", e)
-        return None
\ No newline at end of file
+        logger.warning("Error calling Gemini API: %s", e)
+        return None
+
+
+def _is_retryable(error):
+    """
+    Whether a failed call is worth retrying: timeouts, network errors, rate
+    limits and server errors.
+    """
+    import httpx
+    from google.genai import errors
+
+    if isinstance(error, (asyncio.TimeoutError, httpx.TransportError)):
+        return True
+    if isinstance(error, errors.APIError):
+        return error.code in RETRYABLE_STATUS_CODES
+    return False
+
+
+def _retry_delay(attempt):
+    """
+    Backoff before retry number `attempt` (from 0): exponential with full jitter.
+    """
+    return random.uniform(0, min(GEMINI_BACKOFF_MAX, GEMINI_BACKOFF_BASE * 2 ** attempt))
+
+
+def _hedge_delay(model):
+    """
+    How long to wait on a call to `model` before hedging it, or None to not hedge.
+    """
+    if not GEMINI_HEDGE:
+        return None
+    if GEMINI_HEDGE_DELAY is not None:
+        return GEMINI_HEDGE_DELAY
+    expected = _latency_tracker(model).quantile(GEMINI_HEDGE_QUANTILE)
+    return None if expected is None else max(GEMINI_HEDGE_MIN_DELAY, expected)
+
+
+def _choose_model(model, remaining):
+    """
+    Use GEMINI_FALLBACK_MODEL instead of `model` when the time remaining is
+    less than `model` usually takes.
+    """
+    if not GEMINI_FALLBACK_MODEL or model == GEMINI_FALLBACK_MODEL:
+        return model
+    expected = _latency_tracker(model).quantile(GEMINI_HEDGE_QUANTILE)
+    if expected is not None and remaining < expected:
+        return GEMINI_FALLBACK_MODEL
+    return model
+
+
+async def _call_model(prompt, response_schema, model):
+    """
+    Make one call through the backend, recording its latency if it succeeds.
+
+    Returns:
+        (parsed response, model)
+
+    Raises:
+        LLMResponseError if the response doesn't match the schema
+    """
+    async with _llm_slots:
+        with span("gemini"):
+            start = time.monotonic()
+            parsed = await llm_backend.generate(prompt, response_schema, model)
+            elapsed = time.monotonic() - start
+    if parsed is None:
+        raise LLMResponseError("Gemini response did not match the expected schema")
+    _latency_tracker(model).record(elapsed)
+    return parsed, model
+
+
+async def _hedged_call(prompt, response_schema, model, end):
+    """
+    Call `model`, and if it hasn't answered within its hedge delay, fire a
+    second request (to the fallback model if the deadline `end` is close).
+    The first valid response wins and the other request is cancelled.
+
+    Returns:
+        (parsed response, model that gave it)
+
+    Raises:
+        The error of the last request to fail, if none succeed
+    """
+    loop = asyncio.get_running_loop()
+    pending = {asyncio.ensure_future(_call_model(prompt, response_schema, model))}
+    delay = _hedge_delay(model)
+    hedge_at = None if delay is None else loop.time() + delay
+    hedge = None
+    error = None
+    try:
+        while pending:
+            timeout = None if hedge_at is None else max(0.0, hedge_at - loop.time())
+            done, pending = await asyncio.wait(pending, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+            if not done:
+                hedge_at = None
+                # Hedging a saturated client would only add to the queue
+                if _llm_slots.locked():
+                    continue
+                hedge_model = _choose_model(model, end - loop.time())
+                hedge = asyncio.ensure_future(_call_model(prompt, response_schema, hedge_model))
+                pending.add(hedge)
+                LLM_HEDGES.inc(model=hedge_model, result="fired")
+                continue
+            for task in done:
+                if task.exception() is None:
+                    if task is hedge:
+                        LLM_HEDGES.inc(model=hedge_model, result="won")
+                    return task.result()
+                error = task.exception()
+        raise error
+    finally:
+        for task in pending:
+            task.cancel()
+
+
+async def generate_async(prompt, response_schema, model=DEFAULT_MODEL, deadline=GEMINI_DEADLINE):
+    """
+    Call Gemini asynchronously and return the parsed response (see
+    _generate).
+    """
+    parsed, _ = await _generate(prompt, response_schema, model, deadline)
+    return parsed
+
+
+async def _generate(prompt, response_schema, model=DEFAULT_MODEL, deadline=GEMINI_DEADLINE):
+    """
+    Call Gemini asynchronously and return the parsed response, along with the
+    model that answered.
+
+    Each attempt is limited to GEMINI_TIMEOUT and the whole call, including
+    retries and waiting for a concurrency slot, to `deadline` seconds.
+    Retryable errors are retried up to GEMINI_MAX_RETRIES times with
+    exponential backoff and full jitter.
+
+    Attempts are hedged (see _hedged_call), and switch to
+    GEMINI_FALLBACK_MODEL when less time is left than `model` usually takes.
+
+    Args:
+        prompt: str prompt
+        response_schema: pydantic model (or list of one) to parse into
+        model: Gemini model name
+        deadline: overall time budget in seconds
+
+    Returns:
+        (parsed response, model): an instance of response_schema, and
+        `model` or GEMINI_FALLBACK_MODEL
+
+    Raises:
+        LLMTimeoutError, LLMUnavailableError, LLMResponseError or LLMError
+    """
+    loop = asyncio.get_running_loop()
+    end = loop.time() + deadline
+
+    attempt = 0
+    while True:
+        remaining = end - loop.time()
+        if remaining <= 0:
+            raise LLMTimeoutError(f"Gemini call exceeded its {deadline:.0f}s deadline")
+        try:
+            parsed, answered_by = await asyncio.wait_for(
+                _hedged_call(prompt, response_schema, _choose_model(model, remaining), end),
+                timeout=min(GEMINI_TIMEOUT, remaining),
+            )
+        except LLMResponseError:
+            LLM_CALLS.inc(outcome="invalid")
+            raise
+        except Exception as e:
+            if not _is_retryable(e):
+                LLM_CALLS.inc(outcome="error")
+                raise LLMError(f"Gemini call failed: {e}") from e
+            delay = _retry_delay(attempt)
+            if attempt >= GEMINI_MAX_RETRIES or loop.time() + delay >= end:
+                LLM_CALLS.inc(outcome="timeout" if isinstance(e, asyncio.TimeoutError) else "unavailable")
+                if isinstance(e, asyncio.TimeoutError):
+                    raise LLMTimeoutError("Gemini call timed out") from e
+                raise LLMUnavailableError(f"Gemini call failed after {attempt + 1} attempts: {e}") from e
+            LLM_CALLS.inc(outcome="retry")
+            logger.warning("Retrying Gemini call in %.2fs after error: %r", delay, e)
+            await asyncio.sleep(delay)
+            attempt += 1
+            continue
+
+        LLM_CALLS.inc(outcome="ok")
+        return parsed, answered_by
+
+
+async def generate_stream_async(prompt, response_schema, model=DEFAULT_MODEL, deadline=GEMINI_DEADLINE):
+    """
+    Call Gemini with a streamed response, yielding the text as it arrives.
+
+    Failures before any text has been yielded are retried as in
+    generate_async. Once text has been yielded the caller has already used
+    it, so later failures are raised instead. GEMINI_TIMEOUT limits the wait
+    for each chunk and `deadline` the whole call.
+
+    Args:
+        prompt: str prompt
+        response_schema: pydantic model (or list of one) the JSON response follows
+        model: Gemini model name
+        deadline: overall time budget in seconds
+
+    Yields:
+        str chunks of the JSON response text
+
+    Raises:
+        LLMTimeoutError, LLMUnavailableError or LLMError
+    """
+    loop = asyncio.get_running_loop()
+    end = loop.time() + deadline
+
+    def time_left():
+        remaining = end - loop.time()
+        if remaining <= 0:
+            raise asyncio.TimeoutError()
+        return min(GEMINI_TIMEOUT, remaining)
+
+    async def attempt_stream():
+        stream = llm_backend.stream(prompt, response_schema, model)
+        try:
+            while True:
+                try:
+                    yield await asyncio.wait_for(anext(stream), timeout=time_left())
+                except StopAsyncIteration:
+                    return
+        finally:
+            await stream.aclose()
+
+    attempt = 0
+    started = False
+    async with _llm_slots:
+        while True:
+            try:
+                with span("gemini_stream"):
+                    async for text in attempt_stream():
+                        started = True
+                        yield text
+                LLM_CALLS.inc(outcome="ok")
+                return
+            except Exception as e:
+                if not _is_retryable(e):
+                    LLM_CALLS.inc(outcome="error")
+                    raise LLMError(f"Gemini stream failed: {e}") from e
+                delay = _retry_delay(attempt)
+                if started or attempt >= GEMINI_MAX_RETRIES or loop.time() + delay >= end:
+                    LLM_CALLS.inc(outcome="timeout" if isinstance(e, asyncio.TimeoutError) else "unavailable")
+                    if isinstance(e, asyncio.TimeoutError):
+                        raise LLMTimeoutError("Gemini stream timed out") from e
+                    raise LLMUnavailableError(f"Gemini stream failed after {attempt + 1} attempts: {e}") from e
+                LLM_CALLS.inc(outcome="retry")
+                logger.warning("Retrying Gemini stream in %.2fs after error: %r", delay, e)
+                await asyncio.sleep(delay)
+                attempt += 1
+
+
+async def get_books_from_ocr_async(ocr_data):
+    """
+    Async version of get_books_from_ocr that raises LLMError on failure.
+    """
+    return await generate_async(PROMPT_BOOKS + ocr_data, list[BookInfo])
+
+
+async def _cache_answer(cache_key, result, response_schema, answered_by):
+    """
+    Cache a response keyed on DEFAULT_MODEL, unless GEMINI_FALLBACK_MODEL gave
+    it: that answer shouldn't be served as the default model's for the
+    whole cache TTL.
+    """
+    if answered_by != DEFAULT_MODEL:
+        logger.info("Not caching response from fallback model", extra={"model": answered_by})
+        return
+    # The cache's SQLite backend commits on every write
+    await asyncio.to_thread(llm_cache.set, cache_key, result, response_schema)
+
+
+async def analyse_bookshelf_async(books_string, mode):
+    """
+    Async version of analyse_bookshelf that raises LLMError on failure.
+    """
+    prompt, response_schema = bookshelf_prompt(books_string, mode)
+    cache_key = llm_cache.key(DEFAULT_MODEL, mode, books_string)
+    cached = await asyncio.to_thread(llm_cache.get, cache_key, response_schema)
+    if cached is not None:
+        return cached
+
+    result, answered_by = await _generate(prompt, response_schema)
+    await _cache_answer(cache_key, result, response_schema, answered_by)
+    return result
+
+
+async def analyse_bookshelf_stream(books_string, mode):
+    """
+    Streaming version of analyse_bookshelf_async.
+
+    Yields:
+        ('token', str) for each chunk of response text as it arrives, then
+        ('result', parsed response). A cached response is yielded as the
+        result straight away.
+    """
+    prompt, response_schema = bookshelf_prompt(books_string, mode)
+    cache_key = llm_cache.key(DEFAULT_MODEL, mode, books_string)
+    cached = await asyncio.to_thread(llm_cache.get, cache_key, response_schema)
+    if cached is not None:
+        yield 'result', cached
+        return
+
+    chunks = []
+    async for text in generate_stream_async(prompt, response_schema):
+        chunks.append(text)
+        yield 'token', text
+
+    try:
+        result = TypeAdapter(response_schema).validate_json("".join(chunks))
+    except ValueError as e:
+        raise LLMResponseError("Gemini response did not match the expected schema") from e
+    await asyncio.to_thread(llm_cache.set, cache_key, result, response_schema)
+    yield 'result', result
+
+
+async def analyse_library_async(books_string, user_string, spine_indices=None):
+    """
+    Async version of analyse_library that raises LLMError on failure.
+
+    If `spine_indices` (the spine numbers in books_string) is given, a
+    recommended_idx that isn't one of them raises LLMResponseError, and the
+    response is not cached.
+    """
+    def valid(analysis):
+        return spine_indices is None or analysis.recommended_idx in spine_indices
+
+    cache_key = llm_cache.key(DEFAULT_MODEL, 'library', books_string, user_string)
+    cached = await asyncio.to_thread(llm_cache.get, cache_key, LibraryAnalysis)
+    if cached is not None and valid(cached):
+        return cached
+
+    result, answered_by = await _generate(library_prompt(books_string, user_string), LibraryAnalysis)
+    if not valid(result):
+        raise LLMResponseError(f"Gemini recommended spine {result.recommended_idx}, which was not in the prompt")
+    await _cache_answer(cache_key, result, LibraryAnalysis, answered_by)
+    return result
@@ -1,20 +1,129 @@
 import re
 import os
-from rapidocr_onnxruntime import RapidOCR
+import queue
+import threading
+import time
+from contextlib import contextmanager, ExitStack
 import numpy as np
 from PIL import Image
 import cv2
 
-engine = RapidOCR()
+CPU_COUNT = os.cpu_count() or 1
+OCR_POOL_SIZE = int(os.getenv("OCR_POOL_SIZE", str(max(1, CPU_COUNT // 2))))
+OCR_INTRA_OP_THREADS = int(os.getenv("OCR_INTRA_OP_THREADS", str(max(1, CPU_COUNT // OCR_POOL_SIZE))))
+OCR_INTER_OP_THREADS = int(os.getenv("OCR_INTER_OP_THREADS", "1"))
+
+# 'full' runs detection over the whole image; 'spines' recognises spine crops directly
+OCR_MODE = os.getenv("OCR_MODE", "full")
+
+
+class OCREnginePool:
+    """
+    Pool of RapidOCR engines that are checked out for one call at a time, so
+    concurrent requests never share an engine. Engines are created on demand,
+    up to `size`; once all exist, callers wait for one to be checked back in.
+
+    ONNX Runtime threads are capped per engine so that size * intra_op_num_threads
+    roughly matches the cores available, instead of every session using them all.
+
+    Arguments:
+        size: Maximum number of engines.
+        intra_op_num_threads: ONNX Runtime threads used within an operator.
+        inter_op_num_threads: ONNX Runtime threads used across operators.
+    """
+    def __init__(self, size=OCR_POOL_SIZE, intra_op_num_threads=OCR_INTRA_OP_THREADS,
+                 inter_op_num_threads=OCR_INTER_OP_THREADS):
+        self.size = size
+        self.intra_op_num_threads = intra_op_num_threads
+        self.inter_op_num_threads = inter_op_num_threads
+        self._idle = queue.LifoQueue()
+        self._lock = threading.Lock()
+        self._created = 0
+        self._checkouts = 0
+        self._wait_total = 0.0
+        self._wait_max = 0.0
+
+    def _create_engine(self):
+        # Imported here so that loading the app doesn't wait on ONNX Runtime
+        from rapidocr_onnxruntime import RapidOCR
+
+        return RapidOCR(
+            intra_op_num_threads=self.intra_op_num_threads,
+            inter_op_num_threads=self.inter_op_num_threads,
+        )
+
+    @contextmanager
+    def engine(self):
+        """
+        Check out an engine for the duration of the block.
+        """
+        start = time.monotonic()
+        try:
+            engine = self._idle.get_nowait()
+        except queue.Empty:
+            with self._lock:
+                create = self._created < self.size
+                if create:
+                    self._created += 1
+            if create:
+                try:
+                    engine = self._create_engine()
+                except Exception:
+                    with self._lock:
+                        self._created -= 1
+                    raise
+            else:
+                engine = self._idle.get()
+
+        wait = time.monotonic() - start
+        with self._lock:
+            self._checkouts += 1
+            self._wait_total += wait
+            self._wait_max = max(self._wait_max, wait)
+        try:
+            yield engine
+        finally:
+            self._idle.put(engine)
+
+    def warm_up(self, image):
+        """
+        Create every engine in the pool and run `image` through each once, so
+        that the first requests don't pay for loading ONNX sessions.
+        """
+        with ExitStack() as stack:
+            engines = [stack.enter_context(self.engine()) for _ in range(self.size)]
+            for engine in engines:
+                engine(image)
+
+    def stats(self):
+        """
+        Return pool size and checkout wait statistics.
+        """
+        with self._lock:
+            return {
+                "size": self.size,
+                "created": self._created,
+                "idle": self._idle.qsize(),
+                "checkouts": self._checkouts,
+                "mean_wait_seconds": self._wait_total / self._checkouts if self._checkouts else 0.0,
+                "max_wait_seconds": self._wait_max,
+            }
+
+
+engine_pool = OCREnginePool()
 
 def ocr_from_array(image_array):
     """
     image_array: numpy array of shape (H, W, 3) or (H, W)
+
+    Returns:
+        (boxes, texts, confidences), three empty lists if no text was detected
     """
-    result, elapse = engine(image_array)
+    with engine_pool.engine() as engine:
+        result, elapse = engine(image_array)
     
     if result is None:
-        return "No text detected"
+        return [], [], []
     
     # Extract text from results
     # result format: list of [bbox, text, confidence]
@@ -25,6 +134,53 @@ def ocr_from_array(image_array):
     return boxes, texts, confidences
 
 
+def ocr_from_crops(crops):
+    """
+    Spine-guided OCR: recognise text in segment crops without a detection pass
+    over the whole image.
+
+    Each crop is treated as one line of text. Tall crops are rotated 90° so the
+    text runs horizontally, the angle classifier flips any that are upside down,
+    and all crops go through the recogniser in batched calls.
+
+    Args:
+        crops: list of tuples (crop, confidence, (x1, y1, x2, y2)), as returned
+               by SimpleSegmenter.get_crops
+
+    Returns:
+        (boxes, texts, confidences) in the same form as ocr_from_array, with
+        each box covering its segment in full-image coordinates
+    """
+    boxes, texts, confidences = [], [], []
+    spine_images, spine_segs = [], []
+    for crop, _, seg in crops:
+        h, w = crop.shape[:2]
+        if h == 0 or w == 0:
+            continue
+        if h > w:
+            crop = cv2.rotate(crop, cv2.ROTATE_90_COUNTERCLOCKWISE)
+        spine_images.append(crop)
+        spine_segs.append(seg)
+
+    if not spine_images:
+        return boxes, texts, confidences
+
+    with engine_pool.engine() as engine:
+        spine_images, _, _ = engine.text_cls(spine_images)
+        rec_res, _ = engine.text_rec(spine_images)
+        text_score = engine.text_score
+
+    for (x1, y1, x2, y2), res in zip(spine_segs, rec_res):
+        text, conf = res[0], float(res[1])
+        if not text.strip() or conf < text_score:
+            continue
+        boxes.append([[x1, y1], [x2, y1], [x2, y2], [x1, y2]])
+        texts.append(text)
+        confidences.append(conf)
+
+    return boxes, texts, confidences
+
+
 def assign_text_to_segments(img, spines, ocr_data):
     """
     Assign OCR text to spine segments.
@@ -38,37 +194,37 @@ def assign_text_to_segments(img, spines, ocr_data):
                   confidences: list of floats
 
     Returns:
-        segment_texts: list of tuples [(concatenated_string, [x1,y1,x2,y2]), ...]
-                       ordered by string length descending
+        segment_texts: list of tuples [(concatenated_string, [x1,y1,x2,y2], fragments), ...]
+                       ordered by string length descending, where fragments
+                       is the list of (text, confidence) OCR results joined
+                       into the string
     """
     ocr_boxes, ocr_texts, ocr_confs = ocr_data
     segment_texts = []
+    if len(spines) == 0 or len(ocr_boxes) == 0:
+        return segment_texts
+
+    # Bounding rects of all OCR boxes, computed once: (B, 4) as x1, y1, x2, y2
+    points = np.asarray(ocr_boxes, dtype=np.float64)
+    rects = np.concatenate([points.min(axis=1), points.max(axis=1)], axis=1)
+    box_area = (rects[:, 2] - rects[:, 0]) * (rects[:, 3] - rects[:, 1])
+    usable = (np.asarray(ocr_confs, dtype=np.float64) > 0) & (box_area > 0)
+
+    # Intersection of every spine with every box: (S, B)
+    spine_rects = np.asarray(spines, dtype=np.float64)
+    inter_w = np.minimum(spine_rects[:, None, 2], rects[None, :, 2]) - np.maximum(spine_rects[:, None, 0], rects[None, :, 0])
+    inter_h = np.minimum(spine_rects[:, None, 3], rects[None, :, 3]) - np.maximum(spine_rects[:, None, 1], rects[None, :, 1])
+    inter_area = np.maximum(inter_w, 0) * np.maximum(inter_h, 0)
+
+    # A box belongs to a spine if at least half of it is inside the spine
+    with np.errstate(divide="ignore", invalid="ignore"):
+        inside = usable[None, :] & (inter_area / box_area[None, :] >= 0.5)
 
-    for x1, y1, x2, y2 in spines:
-        spine_texts = []
-        for box, text, conf in zip(ocr_boxes, ocr_texts, ocr_confs):
-            if conf <= 0:
-                continue
-            # Convert OCR box to bounding rect
-            xs = [pt[0] for pt in box]
-            ys = [pt[1] for pt in box]
-            ox1, oy1, ox2, oy2 = min(xs), min(ys), max(xs), max(ys)
-
-            # Check how much of OCR box is inside the spine
-            inter_x1 = max(x1, ox1)
-            inter_y1 = max(y1, oy1)
-            inter_x2 = min(x2, ox2)
-            inter_y2 = min(y2, oy2)
-            inter_area = max(0, inter_x2 - inter_x1) * max(0, inter_y2 - inter_y1)
-            box_area = (ox2 - ox1) * (oy2 - oy1)
-
-            if box_area > 0 and inter_area / box_area >= 0.5:
-                # Consider this text part of the spine
-                spine_texts.append(text.strip())
-
-        if spine_texts:
-            combined_text = " ".join(spine_texts)
-            segment_texts.append((combined_text, [x1, y1, x2, y2]))
+    for (x1, y1, x2, y2), box_mask in zip(spines, inside):
+        fragments = [(ocr_texts[i].strip(), float(ocr_confs[i])) for i in np.flatnonzero(box_mask)]
+        if fragments:
+            combined_text = " ".join(text for text, _ in fragments)
+            segment_texts.append((combined_text, [x1, y1, x2, y2], fragments))
 
     # Sort by string length descending
     segment_texts.sort(key=lambda x: len(x[0]), reverse=True)
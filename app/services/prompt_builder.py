@@ -0,0 +1,190 @@
+import difflib
+import logging
+import math
+import os
+import re
+from .catalog import book_catalog
+from .ocr import ocr_text_prompt
+from .telemetry import PROMPT_TOKENS, PROMPT_TOKENS_SAVED
+
+logger = logging.getLogger(__name__)
+
+# Spine text sent to Gemini per shelf image, in estimated tokens
+PROMPT_TOKEN_BUDGET = int(os.getenv("PROMPT_TOKEN_BUDGET", "600"))
+# OCR fragments below this confidence are dropped
+PROMPT_MIN_CONFIDENCE = float(os.getenv("PROMPT_MIN_CONFIDENCE", "0.6"))
+# Fragments of a spine at least this similar to a kept one are dropped
+PROMPT_NEAR_DUPLICATE = float(os.getenv("PROMPT_NEAR_DUPLICATE", "0.8"))
+# Fragments need this many letters or digits, at least one of them a letter
+PROMPT_MIN_CHARS = int(os.getenv("PROMPT_MIN_CHARS", "3"))
+
+# Rough size of a token for Latin text; Gemini's tokenizer isn't available offline
+CHARS_PER_TOKEN = 4
+
+NOISE_RE = re.compile(r"[^\w\s&'’:,.!?()-]|_")
+REPEATED_PUNCTUATION_RE = re.compile(r"([&'’:,.!?()-])[&'’:,.!?()-]+")
+SPACE_RE = re.compile(r"\s+")
+
+
+def estimate_tokens(text):
+    """
+    Estimate the number of tokens in `text`.
+    """
+    return math.ceil(len(text) / CHARS_PER_TOKEN)
+
+
+def clean_fragment(text, min_chars=PROMPT_MIN_CHARS):
+    """
+    Strip OCR noise (symbols, repeated punctuation, stray whitespace) from a
+    fragment.
+
+    Returns:
+        str, or None if too little text is left, e.g. for a barcode or a
+        shelf number
+    """
+    text = NOISE_RE.sub(" ", text)
+    text = REPEATED_PUNCTUATION_RE.sub(r"\1", text)
+    text = SPACE_RE.sub(" ", text).strip(" &'’:,.!?-")
+    alnum = sum(ch.isalnum() for ch in text)
+    if alnum < min_chars or not any(ch.isalpha() for ch in text):
+        return None
+    return text
+
+
+def _normalise(text):
+    return "".join(ch for ch in text.casefold() if ch.isalnum())
+
+
+def _is_near_duplicate(key, kept_keys, threshold):
+    for kept in kept_keys:
+        if key in kept or kept in key:
+            return True
+        if difflib.SequenceMatcher(None, key, kept).ratio() >= threshold:
+            return True
+    return False
+
+
+def compact_spine(fragments, min_confidence=PROMPT_MIN_CONFIDENCE, near_duplicate=PROMPT_NEAR_DUPLICATE):
+    """
+    Clean and filter the OCR fragments of one spine.
+
+    Fragments are dropped if below `min_confidence`, mostly noise, or an exact
+    or near duplicate of a more confident fragment (e.g. a title detected
+    twice, or once as part of a longer line).
+
+    Args:
+        fragments: list of (text, confidence)
+
+    Returns:
+        (text, value): the kept fragments joined in their original order,
+                       and the confidence-weighted number of characters kept
+    """
+    candidates = []
+    for order, (text, confidence) in enumerate(fragments):
+        if confidence < min_confidence:
+            continue
+        text = clean_fragment(text)
+        if text is not None:
+            candidates.append((order, text, confidence))
+
+    # Longest, most confident fragments first, so shorter copies are the ones dropped
+    candidates.sort(key=lambda c: (len(_normalise(c[1])), c[2]), reverse=True)
+    kept, kept_keys = [], []
+    for order, text, confidence in candidates:
+        key = _normalise(text)
+        if _is_near_duplicate(key, kept_keys, near_duplicate):
+            continue
+        kept.append((order, text, len(key) * confidence))
+        kept_keys.append(key)
+
+    kept.sort()
+    return " ".join(text for _, text, _ in kept), sum(value for _, _, value in kept)
+
+
+def compact_spine_texts(segment_texts, token_budget=PROMPT_TOKEN_BUDGET, catalog=book_catalog, **params):
+    """
+    Compact the output of assign_text_to_segments for the LLM.
+
+    Each spine's fragments are cleaned with compact_spine, and spines the
+    catalog recognises are replaced by their title and author. Then the
+    spines with the most text are kept while they fit in `token_budget`.
+
+    Args:
+        segment_texts: list of (text, segment, fragments)
+        token_budget: Maximum estimated tokens of the formatted spines
+        catalog: BookCatalog to resolve spines with, or None
+        **params: passed to compact_spine
+
+    Returns:
+        list of (index, text) in index order, where index is the position of
+        the spine in segment_texts, so LLM answers can still refer to it
+    """
+    spines = []
+    for i, (_, _, fragments) in enumerate(segment_texts):
+        text, value = compact_spine(fragments, **params)
+        if not text:
+            continue
+        match = catalog.resolve(text) if catalog is not None else None
+        if match is not None:
+            title, author, _ = match
+            text = f"{title} by {author}" if author else title
+        spines.append((value, i, text))
+
+    spines.sort(key=lambda s: (-s[0], s[1]))
+    kept, used = [], 0
+    for _, i, text in spines:
+        tokens = estimate_tokens(format_spine(i, text))
+        if used + tokens > token_budget:
+            continue
+        kept.append((i, text))
+        used += tokens
+    kept.sort()
+    return kept
+
+
+def format_spine(index, text):
+    """
+    Format one spine for the prompt, in the same form as ocr_text_prompt.
+    """
+    return f" | Spine {index}: {text} | "
+
+
+def build_spine_prompt(segment_texts, token_budget=PROMPT_TOKEN_BUDGET, catalog=book_catalog, **params):
+    """
+    Build the spine text prompt for the LLM from the output of
+    assign_text_to_segments (see build_indexed_spine_prompt).
+
+    Returns:
+        str
+    """
+    return build_indexed_spine_prompt(segment_texts, token_budget, catalog, **params)[0]
+
+
+def build_indexed_spine_prompt(segment_texts, token_budget=PROMPT_TOKEN_BUDGET, catalog=book_catalog, **params):
+    """
+    Build the spine text prompt for the LLM from the output of
+    assign_text_to_segments, compacted with compact_spine_texts (so spines
+    found in the book catalog are sent as their title and author).
+
+    Spines keep their index in segment_texts, so e.g. the recommended_idx of
+    a library analysis still selects the right segment. The estimated tokens
+    before and after compaction, and the tokens saved, are recorded on
+    /metrics and logged.
+
+    Returns:
+        (prompt, indices): the prompt, and the indices of the spines in it,
+                           the only valid answers for e.g. recommended_idx
+    """
+    spines = compact_spine_texts(segment_texts, token_budget, catalog, **params)
+    prompt = "".join(format_spine(i, text) for i, text in spines)
+
+    raw_tokens = estimate_tokens(ocr_text_prompt(segment_texts))
+    sent_tokens = estimate_tokens(prompt)
+    PROMPT_TOKENS.inc(raw_tokens, kind="raw")
+    PROMPT_TOKENS.inc(sent_tokens, kind="sent")
+    PROMPT_TOKENS_SAVED.observe(raw_tokens - sent_tokens)
+    logger.info(
+        "Compacted spine text prompt",
+        extra={"raw_tokens": raw_tokens, "sent_tokens": sent_tokens, "tokens_saved": raw_tokens - sent_tokens},
+    )
+    return prompt, [i for i, _ in spines]
@@ -0,0 +1,223 @@
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+SEGMENT_CACHE_SIZE = int(os.getenv("SEGMENT_CACHE_SIZE", "128"))
+SEGMENT_CACHE_TTL = float(os.getenv("SEGMENT_CACHE_TTL", "3600"))
+SEGMENT_CACHE_DIR = os.getenv("SEGMENT_CACHE_DIR")
+# Disk backend only: most files kept, and seconds between sweeps of expired files
+SEGMENT_CACHE_MAX_FILES = int(os.getenv("SEGMENT_CACHE_MAX_FILES", "10000"))
+SEGMENT_CACHE_SWEEP_INTERVAL = float(os.getenv("SEGMENT_CACHE_SWEEP_INTERVAL", "60"))
+
+
+def segment_cache_key(content, params):
+    """
+    Build a cache key from the raw image bytes and the segmenter parameters
+    (also used by single_flight.request_key, with the form parameters).
+
+    Args:
+        content: bytes of the uploaded image
+        params: dict of JSON-serialisable parameters, e.g. the keyword
+                arguments passed to SimpleSegmenter
+
+    Returns:
+        str: key of the form "<image sha256>:<params sha256 prefix>"
+    """
+    image_hash = hashlib.sha256(content).hexdigest()
+    params_json = json.dumps(params, sort_keys=True, default=str)
+    params_hash = hashlib.sha256(params_json.encode()).hexdigest()[:16]
+    return f"{image_hash}:{params_hash}"
+
+
+class DiskSegmentBackend:
+    """
+    Shared on-disk store for segmentation results, one JSON file per key.
+
+    Files are written atomically, so several workers can share a directory.
+    Any object with the same get/set methods can be used as a backend.
+
+    At most every `sweep_interval` seconds, a write also sweeps the directory:
+    expired entries are deleted, and then the oldest ones while more than
+    `max_files` are left.
+
+    Arguments:
+        directory: Directory to store entries in (created if missing).
+        ttl: Time-to-live (in seconds) of an entry, based on file mtime.
+        max_files: Maximum number of entries kept after a sweep.
+        sweep_interval: Minimum time (in seconds) between sweeps.
+    """
+    def __init__(self, directory, ttl=SEGMENT_CACHE_TTL, max_files=SEGMENT_CACHE_MAX_FILES,
+                 sweep_interval=SEGMENT_CACHE_SWEEP_INTERVAL):
+        self.directory = directory
+        self.ttl = ttl
+        self.max_files = max_files
+        self.sweep_interval = sweep_interval
+        self._last_sweep = time.monotonic()
+        self._sweep_lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, key):
+        return os.path.join(self.directory, hashlib.sha256(key.encode()).hexdigest() + ".json")
+
+    def get(self, key):
+        """
+        Return the stored entry for `key`, or None if missing or expired.
+        """
+        path = self._path(key)
+        try:
+            if time.time() - os.path.getmtime(path) > self.ttl:
+                os.remove(path)
+                return None
+            with open(path) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def set(self, key, entry):
+        """
+        Store `entry` (a JSON-serialisable dict) under `key`.
+        """
+        path = self._path(key)
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        try:
+            with open(tmp_path, "w") as f:
+                json.dump(entry, f)
+            os.replace(tmp_path, path)
+        except OSError as e:
+            logger.warning("Error writing segment cache entry: %s", e)
+
+        now = time.monotonic()
+        if now - self._last_sweep >= self.sweep_interval and self._sweep_lock.acquire(blocking=False):
+            try:
+                self._last_sweep = now
+                self.sweep()
+            finally:
+                self._sweep_lock.release()
+
+    def sweep(self):
+        """
+        Delete expired entries (and temporary files left by failed writes),
+        then the least recently written entries beyond max_files.
+
+        Returns:
+            int number of files deleted
+        """
+        now = time.time()
+        entries, removed = [], 0
+        try:
+            with os.scandir(self.directory) as it:
+                for item in it:
+                    if not item.name.endswith((".json", ".tmp")):
+                        continue
+                    try:
+                        mtime = item.stat().st_mtime
+                    except OSError:
+                        continue
+                    if now - mtime > self.ttl:
+                        removed += self._remove(item.path)
+                    elif item.name.endswith(".json"):
+                        entries.append((mtime, item.path))
+        except OSError as e:
+            logger.warning("Error sweeping segment cache: %s", e)
+            return removed
+
+        if len(entries) > self.max_files:
+            entries.sort()
+            for _, path in entries[:len(entries) - self.max_files]:
+                removed += self._remove(path)
+        if removed:
+            logger.info("Swept segment cache", extra={"removed": removed, "kept": min(len(entries), self.max_files)})
+        return removed
+
+    @staticmethod
+    def _remove(path):
+        # Another worker sharing the directory may have removed it first
+        try:
+            os.remove(path)
+            return 1
+        except OSError:
+            return 0
+
+
+class SegmentCache:
+    """
+    In-process LRU cache of segmentation results with size and TTL eviction,
+    optionally backed by a shared store such as DiskSegmentBackend.
+
+    Arguments:
+        max_size: Maximum number of entries held in memory.
+        ttl: Time-to-live (in seconds) of an in-memory entry.
+        backend: Optional shared store consulted on a memory miss.
+    """
+    def __init__(self, max_size=SEGMENT_CACHE_SIZE, ttl=SEGMENT_CACHE_TTL, backend=None):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.backend = backend
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """
+        Look up a segmentation result.
+
+        Returns:
+            (segments, confidences) or None on a miss. Segments are (x1, y1, x2, y2)
+            tuples; confidences is a list aligned with segments.
+        """
+        now = time.monotonic()
+        with self._lock:
+            item = self._entries.get(key)
+            if item is not None:
+                stored_at, entry = item
+                if now - stored_at <= self.ttl:
+                    self._entries.move_to_end(key)
+                    return entry
+                del self._entries[key]
+
+        if self.backend is None:
+            return None
+        stored = self.backend.get(key)
+        if stored is None:
+            return None
+        entry = ([tuple(seg) for seg in stored["segments"]], stored["confidences"])
+        self._store(key, entry)
+        return entry
+
+    def set(self, key, segments, confidences):
+        """
+        Store a segmentation result in memory and in the backend, if any.
+
+        Returns:
+            (segments, confidences) in the same form as get
+        """
+        entry = ([tuple(seg) for seg in segments], [float(c) for c in confidences])
+        self._store(key, entry)
+        if self.backend is not None:
+            self.backend.set(key, {"segments": entry[0], "confidences": entry[1]})
+        return entry
+
+    def _store(self, key, entry):
+        with self._lock:
+            self._entries[key] = (time.monotonic(), entry)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        """
+        Drop all in-memory entries.
+        """
+        with self._lock:
+            self._entries.clear()
+
+
+segment_cache = SegmentCache(
+    backend=DiskSegmentBackend(SEGMENT_CACHE_DIR) if SEGMENT_CACHE_DIR else None
+)
+
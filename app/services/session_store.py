@@ -0,0 +1,117 @@
+import os
+import secrets
+import threading
+import time
+from collections import OrderedDict
+
+SESSION_TTL = float(os.getenv("SESSION_TTL", "600"))
+SESSION_MAX_BYTES = int(os.getenv("SESSION_MAX_BYTES", str(256 * 1024 * 1024)))
+
+
+class SessionStore:
+    """
+    Short-lived, in-process store of decoded images and their segments, so
+    that follow-up requests (e.g. /highlight after /library) can refer to an
+    upload by id instead of sending it again.
+
+    Entries expire after `ttl` seconds, and are dropped on lookup or when a
+    new session is created. The least recently used are evicted when the
+    images held exceed `max_bytes`. Sessions live in one process, so with
+    several replicas a follow-up may land elsewhere and miss; callers should
+    then fall back to re-uploading.
+
+    Arguments:
+        ttl: Time-to-live (in seconds) of a session.
+        max_bytes: Memory cap on the images held.
+    """
+    def __init__(self, ttl=SESSION_TTL, max_bytes=SESSION_MAX_BYTES):
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self._hits = 0
+        self._misses = 0
+        self._evictions = 0
+
+    def create(self, img, segments):
+        """
+        Store a decoded image and its segments.
+
+        Returns:
+            str session id, or None if the image alone exceeds max_bytes
+        """
+        if img.nbytes > self.max_bytes:
+            return None
+        session_id = secrets.token_urlsafe(16)
+        now = time.monotonic()
+        with self._lock:
+            self._purge_expired(now)
+            self._entries[session_id] = (now, img, [tuple(seg) for seg in segments])
+            self._bytes += img.nbytes
+            while self._bytes > self.max_bytes:
+                self._evict_oldest()
+        return session_id
+
+    def get(self, session_id):
+        """
+        Look up a session.
+
+        Returns:
+            (img, segments) or None if unknown or expired
+        """
+        now = time.monotonic()
+        with self._lock:
+            item = self._entries.get(session_id)
+            if item is not None and now - item[0] > self.ttl:
+                self._remove(session_id)
+                item = None
+            if item is None:
+                self._misses += 1
+                return None
+            self._entries.move_to_end(session_id)
+            self._hits += 1
+            return item[1], item[2]
+
+    def purge_expired(self):
+        """
+        Drop all expired sessions.
+
+        Returns:
+            int number of sessions dropped
+        """
+        with self._lock:
+            return self._purge_expired(time.monotonic())
+
+    def _purge_expired(self, now):
+        # Entries are in order of use, not creation, so all are checked
+        expired = [key for key, (created, _, _) in self._entries.items() if now - created > self.ttl]
+        for key in expired:
+            self._remove(key)
+        return len(expired)
+
+    def _remove(self, session_id):
+        _, img, _ = self._entries.pop(session_id)
+        self._bytes -= img.nbytes
+
+    def _evict_oldest(self):
+        session_id = next(iter(self._entries))
+        self._remove(session_id)
+        self._evictions += 1
+
+    def stats(self):
+        """
+        Return session counts, memory use and hit rates.
+        """
+        with self._lock:
+            return {
+                "sessions": len(self._entries),
+                "bytes": self._bytes,
+                "max_bytes": self.max_bytes,
+                "hits": self._hits,
+                "misses": self._misses,
+                "evictions": self._evictions,
+            }
+
+
+session_store = SessionStore()
@@ -0,0 +1,83 @@
+import asyncio
+import logging
+from .segment_cache import segment_cache_key
+
+logger = logging.getLogger(__name__)
+
+
+def request_key(route, content, **params):
+    """
+    Build a single-flight key from the route, the uploaded bytes and the form
+    parameters, hashed as by segment_cache_key.
+
+    Returns:
+        str: "<route>:<image sha256>:<params sha256 prefix>"
+    """
+    return f"{route}:{segment_cache_key(content, params)}"
+
+
+class SingleFlight:
+    """
+    Coalesces identical concurrent requests: while a computation for a key is
+    in progress, further calls with that key wait for it and share its result
+    (or its error) instead of starting their own.
+
+    The computation runs as its own task, shielded from the callers, so a
+    caller that is cancelled (e.g. the client disconnected) does not cancel it
+    for the others. Only when every caller has gone is it cancelled.
+
+    Methods:
+        run(key, fn): Await fn(), or the call already in progress for key.
+        stats(): Calls started, coalesced and abandoned.
+    """
+    def __init__(self):
+        self._calls = {}
+        self._started = 0
+        self._coalesced = 0
+        self._abandoned = 0
+
+    async def run(self, key, fn):
+        """
+        Return the result of `fn()` (an async callable), sharing one call
+        among concurrent callers with the same key.
+        """
+        call = self._calls.get(key)
+        if call is None:
+            task = asyncio.ensure_future(fn())
+            call = self._calls[key] = {"task": task, "waiters": 0}
+            task.add_done_callback(lambda _: self._forget(key, call))
+            self._started += 1
+        else:
+            self._coalesced += 1
+            logger.info("Joined in-flight request", extra={"single_flight_key": key[:48]})
+
+        task = call["task"]
+        call["waiters"] += 1
+        try:
+            return await asyncio.shield(task)
+        finally:
+            call["waiters"] -= 1
+            if call["waiters"] == 0 and not task.done():
+                # Later callers start afresh rather than join a cancelled call
+                self._forget(key, call)
+                task.cancel()
+                self._abandoned += 1
+
+    def _forget(self, key, call):
+        if self._calls.get(key) is call:
+            del self._calls[key]
+
+    def stats(self):
+        """
+        Return the calls in flight, started, coalesced into another and
+        abandoned by all their callers.
+        """
+        return {
+            "in_flight": len(self._calls),
+            "started": self._started,
+            "coalesced": self._coalesced,
+            "abandoned": self._abandoned,
+        }
+
+
+single_flight = SingleFlight()
@@ -0,0 +1,149 @@
+import asyncio
+from .executor import pipeline
+from .image_processing import segment_image
+from .ocr import ocr_from_array, ocr_from_crops, assign_text_to_segments, OCR_MODE
+from .segment_cache import segment_cache, segment_cache_key
+from .telemetry import timed
+
+
+class StageGraph:
+    """
+    A small graph of async pipeline stages. Each stage starts as soon as the
+    stages it depends on have finished, so independent stages run concurrently.
+
+    Methods:
+        add(name, fn, *deps): Add a stage; fn is awaited with the results of deps.
+        run(on_stage=None): Run all stages and return their results by name.
+    """
+    def __init__(self):
+        self._stages = {}
+
+    def add(self, name, fn, *deps):
+        """
+        Add a stage.
+
+        Args:
+            name: Name of the stage, used to refer to its result.
+            fn: Async callable, called with the results of `deps` in order.
+            *deps: Names of previously added stages this stage needs.
+
+        Returns:
+            self, so calls can be chained.
+        """
+        if name in self._stages:
+            raise ValueError(f"Duplicate stage: {name}")
+        for dep in deps:
+            if dep not in self._stages:
+                raise ValueError(f"Unknown dependency for {name}: {dep}")
+        self._stages[name] = (fn, deps)
+        return self
+
+    async def run(self, on_stage=None):
+        """
+        Run the graph. If any stage fails, the others are cancelled and the
+        error is raised.
+
+        Args:
+            on_stage: Optional callable, called with (name, result) as each
+                      stage finishes.
+
+        Returns:
+            dict of stage name -> result
+        """
+        tasks = {}
+
+        async def run_stage(name):
+            fn, deps = self._stages[name]
+            args = [await tasks[dep] for dep in deps]
+            result = await fn(*args)
+            if on_stage is not None:
+                on_stage(name, result)
+            return result
+
+        for name in self._stages:
+            tasks[name] = asyncio.ensure_future(run_stage(name))
+        try:
+            await asyncio.gather(*tasks.values())
+        except BaseException:
+            for task in tasks.values():
+                task.cancel()
+            raise
+        return {name: task.result() for name, task in tasks.items()}
+
+
+async def segment_cached(content, img, **params):
+    """
+    Segment a decoded upload on the pipeline, reusing a cached result for the
+    same bytes and parameters (so /highlight can reuse /library's work). The
+    cache is read and written on a thread, as its disk backend does file I/O.
+
+    Returns:
+        (segments, confidences)
+    """
+    key = segment_cache_key(content, params)
+    cached = await asyncio.to_thread(segment_cache.get, key)
+    if cached is None:
+        segments, confidences = await timed("segment", pipeline.run(segment_image, img, **params))
+        cached = await asyncio.to_thread(segment_cache.set, key, segments, confidences)
+    return cached
+
+
+async def extract_spine_texts(content, img, min_size_factor=0.05, ocr_mode=OCR_MODE, on_stage=None):
+    """
+    Run OCR and segmentation on a decoded image, then assign the OCR text to
+    spine segments.
+
+    In 'full' OCR mode, OCR and segmentation run concurrently. In 'spines'
+    mode, OCR waits for segmentation and recognises the spine crops directly,
+    skipping full-image text detection.
+
+    Args:
+        content: bytes of the uploaded image (segmentation cache key)
+        img: decoded RGB image
+        min_size_factor: passed to SimpleSegmenter
+        ocr_mode: 'full' or 'spines'
+        on_stage: passed to StageGraph.run, to report the 'segments', 'ocr'
+                  and 'segment_texts' stages as they finish
+
+    Returns:
+        (segments, segment_texts): leaf segments, and the output of
+                                   assign_text_to_segments
+    """
+    graph = StageGraph()
+    graph.add("segments", lambda: segment_cached(content, img, min_size_factor=min_size_factor))
+    if ocr_mode == 'full':
+        graph.add("ocr", lambda: timed("ocr_from_array", pipeline.run(ocr_from_array, img)))
+    elif ocr_mode == 'spines':
+        graph.add("ocr", lambda segmented: timed(
+            "ocr_from_crops", pipeline.run(ocr_segments, img, *segmented)), "segments")
+    else:
+        raise ValueError("Invalid ocr_mode for extract_spine_texts")
+    graph.add(
+        "segment_texts",
+        lambda ocr_data, segmented: timed(
+            "assign_text_to_segments", pipeline.run(assign_text_to_segments, img, segmented[0], list(ocr_data))),
+        "ocr", "segments",
+    )
+    results = await graph.run(on_stage)
+    return results["segments"][0], results["segment_texts"]
+
+
+def ocr_segments(img, segments, confidences):
+    """
+    Spine-guided OCR of the segments of an image (see ocr_from_crops). The
+    crops are taken where this runs, so a process pool worker is handed the
+    image rather than a copy of every crop.
+    """
+    return ocr_from_crops(crop_segments(img, segments, confidences))
+
+
+def crop_segments(img, segments, confidences):
+    """
+    Crop segments out of an image, in the same form as SimpleSegmenter.get_crops
+    but as views rather than copies.
+
+    Returns:
+        List of tuples (crop, confidence, (x1, y1, x2, y2)).
+    """
+    return [(img[y1:y2, x1:x2], conf, (x1, y1, x2, y2))
+            for (x1, y1, x2, y2), conf in zip(segments, confidences)]
@@ -0,0 +1,280 @@
+import contextvars
+import json
+import logging
+import os
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO")
+LOG_FORMAT = os.getenv("LOG_FORMAT", "json")  # 'json' or 'text'
+
+# Latency buckets in seconds, from fast NumPy stages up to the Gemini deadline
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+# Token count buckets, for prompt sizes
+TOKEN_BUCKETS = (0, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000)
+
+# Id and stage timings of the request being handled, if any. Tasks started
+# while handling a request inherit both, so their spans are counted too.
+request_id_var = contextvars.ContextVar("request_id", default=None)
+request_timings_var = contextvars.ContextVar("request_timings", default=None)
+
+
+def _format_labels(labels):
+    """
+    Format sorted (name, value) label pairs in Prometheus text format.
+    """
+    if not labels:
+        return ""
+    pairs = []
+    for name, value in labels:
+        value = str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+        pairs.append(f'{name}="{value}"')
+    return "{" + ",".join(pairs) + "}"
+
+
+class Counter:
+    """
+    A Prometheus counter, with one value per combination of labels.
+
+    Arguments:
+        name: Metric name, ending in _total.
+        help: Description shown on /metrics.
+    """
+    def __init__(self, name, help):
+        self.name = name
+        self.help = help
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            for key, value in sorted(self._values.items()):
+                lines.append(f"{self.name}{_format_labels(key)} {value}")
+        return lines
+
+
+class Histogram:
+    """
+    A Prometheus histogram, with one set of buckets per combination of labels.
+
+    Arguments:
+        name: Metric name.
+        help: Description shown on /metrics.
+        buckets: Upper bounds of the buckets, ascending.
+    """
+    def __init__(self, name, help, buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.buckets = tuple(buckets)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            series = self._values.get(key)
+            if series is None:
+                series = self._values[key] = {"buckets": [0] * len(self.buckets), "sum": 0.0, "count": 0}
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series["buckets"][i] += 1
+            series["sum"] += value
+            series["count"] += 1
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            for key, series in sorted(self._values.items()):
+                for bound, count in zip(self.buckets, series["buckets"]):
+                    lines.append(f"{self.name}_bucket{_format_labels(key + (('le', bound),))} {count}")
+                lines.append(f"{self.name}_bucket{_format_labels(key + (('le', '+Inf'),))} {series['count']}")
+                lines.append(f"{self.name}_sum{_format_labels(key)} {series['sum']}")
+                lines.append(f"{self.name}_count{_format_labels(key)} {series['count']}")
+        return lines
+
+
+STAGE_SECONDS = Histogram("bookshelf_stage_duration_seconds", "Time spent in each pipeline stage.")
+STAGE_ERRORS = Counter("bookshelf_stage_errors_total", "Pipeline stages that raised an error.")
+REQUEST_SECONDS = Histogram("bookshelf_http_request_duration_seconds", "HTTP request latency.")
+REQUESTS = Counter("bookshelf_http_requests_total", "HTTP requests handled.")
+LLM_CALLS = Counter("bookshelf_llm_calls_total", "Gemini call attempts by outcome.")
+LLM_HEDGES = Counter("bookshelf_llm_hedges_total", "Hedged Gemini requests fired, and how many of them won.")
+
+PROMPT_TOKENS = Counter("bookshelf_prompt_tokens_total", "Estimated spine prompt tokens before (raw) and after (sent) compaction.")
+PROMPT_TOKENS_SAVED = Histogram(
+    "bookshelf_prompt_tokens_saved", "Estimated tokens removed from each spine prompt by compaction.", TOKEN_BUCKETS)
+
+METRICS = [STAGE_SECONDS, STAGE_ERRORS, REQUEST_SECONDS, REQUESTS, LLM_CALLS, LLM_HEDGES, PROMPT_TOKENS, PROMPT_TOKENS_SAVED]
+
+
+@contextmanager
+def span(name):
+    """
+    Time the block as pipeline stage `name`: recorded in the stage latency
+    histogram and, during a request, in its Server-Timing header.
+    """
+    start = time.perf_counter()
+    try:
+        yield
+    except Exception:
+        STAGE_ERRORS.inc(stage=name)
+        raise
+    finally:
+        elapsed = time.perf_counter() - start
+        STAGE_SECONDS.observe(elapsed, stage=name)
+        timings = request_timings_var.get()
+        if timings is not None:
+            timings.append((name, elapsed))
+
+
+async def timed(name, awaitable):
+    """
+    Await `awaitable` inside span(name).
+    """
+    with span(name):
+        return await awaitable
+
+
+def stage_totals(timings):
+    """
+    Sum (name, seconds) timings by stage, e.g. over Gemini retries.
+    """
+    totals = {}
+    for name, elapsed in timings:
+        totals[name] = totals.get(name, 0.0) + elapsed
+    return totals
+
+
+def server_timing(timings):
+    """
+    Format stage timings as a Server-Timing header value.
+    """
+    return ", ".join(f"{name};dur={elapsed * 1000:.1f}" for name, elapsed in stage_totals(timings).items())
+
+
+def render_metrics(gauges=()):
+    """
+    Render all metrics in the Prometheus text format.
+
+    Args:
+        gauges: (name, help, value) tuples of current values to include
+
+    Returns:
+        str
+    """
+    lines = []
+    for metric in METRICS:
+        lines.extend(metric.render())
+    for name, help, value in gauges:
+        lines.extend([f"# HELP {name} {help}", f"# TYPE {name} gauge", f"{name} {value}"])
+    return "\n".join(lines) + "\n"
+
+
+class RequestIdFilter(logging.Filter):
+    """
+    Add the current request id (or None) to every log record.
+    """
+    def filter(self, record):
+        record.request_id = request_id_var.get()
+        return True
+
+
+class JsonFormatter(logging.Formatter):
+    """
+    Format log records as one JSON object per line, including the request id
+    and any fields passed with `extra=`.
+    """
+    RESERVED = set(vars(logging.makeLogRecord({}))) | {"message", "asctime", "request_id"}
+
+    def format(self, record):
+        entry = {
+            "time": self.formatTime(record),
+            "level": record.levelname,
+            "logger": record.name,
+            "request_id": getattr(record, "request_id", None),
+            "message": record.getMessage(),
+        }
+        entry.update({k: v for k, v in vars(record).items() if k not in self.RESERVED})
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+
+def configure_logging(level=LOG_LEVEL, fmt=LOG_FORMAT):
+    """
+    Send the app's logs to stderr, as JSON lines or plain text, tagged with
+    the request id.
+    """
+    handler = logging.StreamHandler()
+    handler.addFilter(RequestIdFilter())
+    if fmt == "json":
+        handler.setFormatter(JsonFormatter())
+    else:
+        handler.setFormatter(logging.Formatter("%(asctime)s %(levelname)s %(name)s [%(request_id)s] %(message)s"))
+    app_logger = logging.getLogger("app")
+    app_logger.handlers[:] = [handler]
+    app_logger.setLevel(level)
+    app_logger.propagate = False
+
+
+class RequestTelemetryMiddleware:
+    """
+    ASGI middleware that gives each request an id (taken from an incoming
+    X-Request-ID header if present), collects its stage timings, and adds
+    X-Request-ID and Server-Timing headers to the response. Request latency
+    is recorded by route template, so paths don't create new series.
+    """
+    def __init__(self, app):
+        self.app = app
+        self.logger = logging.getLogger("app.requests")
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        headers = dict(scope.get("headers") or [])
+        request_id = headers.get(b"x-request-id", b"").decode("latin-1")[:64] or uuid.uuid4().hex
+        timings = []
+        id_token = request_id_var.set(request_id)
+        timings_token = request_timings_var.set(timings)
+        start = time.perf_counter()
+        status = 500
+
+        async def send_with_headers(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+                extra = [(b"x-request-id", request_id.encode("latin-1"))]
+                if timings:
+                    extra.append((b"server-timing", server_timing(timings).encode("latin-1")))
+                message = dict(message, headers=list(message.get("headers", [])) + extra)
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_headers)
+        finally:
+            elapsed = time.perf_counter() - start
+            route = getattr(scope.get("route"), "path", "unmatched")
+            REQUEST_SECONDS.observe(elapsed, method=scope["method"], route=route)
+            REQUESTS.inc(method=scope["method"], route=route, status=status)
+            self.logger.info(
+                "%s %s %d %.3fs", scope["method"], scope["path"], status, elapsed,
+                extra={
+                    "method": scope["method"],
+                    "path": scope["path"],
+                    "status": status,
+                    "duration_seconds": round(elapsed, 4),
+                    "stages": {name: round(t, 4) for name, t in stage_totals(timings).items()},
+                },
+            )
+            request_timings_var.reset(timings_token)
+            request_id_var.reset(id_token)
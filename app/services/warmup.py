@@ -0,0 +1,91 @@
+import logging
+import os
+import threading
+import time
+import cv2
+import numpy as np
+from .catalog import book_catalog
+from .executor import pipeline
+from .image_processing import segment_image
+from .llm_client import get_client
+from .ocr import engine_pool
+
+logger = logging.getLogger(__name__)
+
+WARM_UP = os.getenv("WARM_UP", "1") == "1"
+
+_ready = threading.Event()
+_status = {"state": "pending", "timings": {}, "error": None}
+
+
+def warm_up_image():
+    """
+    A small image with a line of text, to run through OCR and segmentation.
+    """
+    image = np.full((96, 320, 3), 255, dtype=np.uint8)
+    cv2.putText(image, "Warm up", (10, 60), cv2.FONT_HERSHEY_SIMPLEX, 1.5, (0, 0, 0), 3)
+    return image
+
+
+def warm_up():
+    """
+    Load the heavy parts of the pipeline and run one dummy inference through
+    each, then mark the app as ready. With a process pool, the workers warm
+    up their own OCR engines instead.
+    """
+    timings = _status["timings"]
+    try:
+        if pipeline.kind == "process":
+            start = time.perf_counter()
+            pipeline.start_workers()
+            timings["workers_seconds"] = time.perf_counter() - start
+        else:
+            dummy = warm_up_image()
+
+            start = time.perf_counter()
+            engine_pool.warm_up(dummy)
+            timings["ocr_seconds"] = time.perf_counter() - start
+
+            start = time.perf_counter()
+            segment_image(dummy)
+            timings["segmentation_seconds"] = time.perf_counter() - start
+
+        start = time.perf_counter()
+        get_client()
+        timings["llm_client_seconds"] = time.perf_counter() - start
+
+        start = time.perf_counter()
+        book_catalog.load()
+        timings["catalog_seconds"] = time.perf_counter() - start
+    except Exception as e:
+        logger.exception("Warm-up failed: %s", e)
+        _status["state"] = "failed"
+        _status["error"] = str(e)
+        return
+
+    _status["state"] = "ready"
+    _ready.set()
+    logger.info("Warm-up finished", extra={"timings": timings})
+
+
+def start_warm_up():
+    """
+    Run warm_up on a background thread, so the server can answer liveness
+    checks straight away. With WARM_UP=0 the app is ready immediately.
+    """
+    if not WARM_UP:
+        _status["state"] = "ready"
+        _ready.set()
+        return
+    threading.Thread(target=warm_up, name="warm-up", daemon=True).start()
+
+
+def is_ready():
+    return _ready.is_set()
+
+
+def warm_up_status():
+    """
+    Return the warm-up state ('pending', 'ready' or 'failed'), stage timings and any error.
+    """
+    return dict(_status)
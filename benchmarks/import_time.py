@@ -0,0 +1,94 @@
+"""
+Report how long it takes to import the app, using `python -X importtime`.
+
+Prints the total import time of the target module and the slowest modules by
+cumulative time. Use --max-seconds to fail (exit code 1) when the total
+exceeds a limit, e.g. in CI, so that cold-start regressions are visible.
+
+Usage:
+    python benchmarks/import_time.py
+    python benchmarks/import_time.py --top 15 --json import_time.json --max-seconds 1.0
+"""
+import argparse
+import json
+import os
+import re
+import subprocess
+import sys
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+LINE_RE = re.compile(r"import time:\s+(\d+)\s+\|\s+(\d+)\s+\|(\s*)(\S+)")
+
+
+def measure_imports(module="app.main"):
+    """
+    Import `module` in a fresh interpreter and parse the -X importtime output.
+
+    Returns:
+        List of dicts with name, depth, self_seconds and cumulative_seconds,
+        in import order.
+    """
+    env = dict(os.environ, WARM_UP="0")
+    env.setdefault("GEMINI_API_KEY", "unused")
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        cwd=REPO_ROOT, env=env, capture_output=True, text=True,
+    )
+    if result.returncode != 0:
+        raise RuntimeError(f"Importing {module} failed:\n{result.stderr}")
+
+    modules = []
+    for line in result.stderr.splitlines():
+        match = LINE_RE.match(line)
+        if match:
+            self_us, cumulative_us, indent, name = match.groups()
+            modules.append({
+                "name": name,
+                "depth": len(indent) // 2,
+                "self_seconds": int(self_us) / 1e6,
+                "cumulative_seconds": int(cumulative_us) / 1e6,
+            })
+    return modules
+
+
+def import_report(module="app.main", top=20):
+    """
+    Summarise the import of `module`.
+
+    Returns:
+        dict with total_seconds and the `top` slowest modules by cumulative time
+    """
+    modules = measure_imports(module)
+    total = next(m["cumulative_seconds"] for m in modules if m["name"] == module)
+    slowest = sorted(modules, key=lambda m: m["cumulative_seconds"], reverse=True)
+    return {
+        "module": module,
+        "total_seconds": total,
+        "slowest": [m for m in slowest if m["name"] != module][:top],
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--module", default="app.main")
+    parser.add_argument("--top", type=int, default=20)
+    parser.add_argument("--json", help="Write the report to this file")
+    parser.add_argument("--max-seconds", type=float, help="Fail if the import takes longer than this")
+    args = parser.parse_args()
+
+    report = import_report(args.module, args.top)
+    print(f"import {report['module']}: {report['total_seconds']:.3f}s")
+    for m in report["slowest"]:
+        print(f"  {m['cumulative_seconds']:8.3f}s  {'  ' * m['depth']}{m['name']}")
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(report, f, indent=2)
+
+    if args.max_seconds is not None and report["total_seconds"] > args.max_seconds:
+        print(f"Import time {report['total_seconds']:.3f}s exceeds limit of {args.max_seconds:.3f}s")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
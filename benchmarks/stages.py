@@ -0,0 +1,339 @@
+"""
+Time each stage of the bookshelf pipeline, on images/bookshelf3.png and on
+synthetic shelves, so that slowdowns in read_image, SimpleSegmenter,
+assign_text_to_segments etc. show up before they ship.
+
+Synthetic shelves are generated at each --resolutions x --spines setting, with
+--boxes-per-spine fake OCR boxes per spine, to show how the cost scales with
+the number of spines S and OCR boxes B. Gemini is replaced by a deterministic
+local stub, so the LLM stage measures only our side of the call.
+
+Results are written as JSON with --json. With --baseline, the fastest run of
+each stage (less noisy than the median) is compared against a stored run, and
+the script fails (exit code 1) if any stage is more than --tolerance and
+--min-delta-ms slower. Timings depend on the machine, so compare against a
+baseline saved on the same hardware (--save-baseline).
+
+Usage:
+    python benchmarks/stages.py
+    python benchmarks/stages.py --resolutions 1024x768,2048x1536 --spines 10,40 --boxes-per-spine 1,4
+    python benchmarks/stages.py --skip-ocr --baseline benchmarks/baseline.json --tolerance 0.25
+"""
+import argparse
+import asyncio
+import hashlib
+import json
+import os
+import platform
+import statistics
+import sys
+import time
+
+import cv2
+import numpy as np
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_ROOT)
+
+from app.services import llm_client  # noqa: E402
+from app.services.image_processing import SimpleSegmenter, read_image, render_highlight  # noqa: E402
+from app.services.llm_cache import llm_cache  # noqa: E402
+from app.services.ocr import ocr_from_array, ocr_from_crops, assign_text_to_segments  # noqa: E402
+from app.services.prompt_builder import build_spine_prompt  # noqa: E402
+
+SAMPLE_IMAGE = os.path.join(REPO_ROOT, "images", "bookshelf3.png")
+DEFAULT_BASELINE = os.path.join(REPO_ROOT, "benchmarks", "baseline.json")
+
+WORDS = ["THE", "OF", "NIGHT", "RIVER", "GARDEN", "HISTORY", "SECRET", "LIGHT", "WAR",
+         "HOUSE", "STONE", "SEA", "KING", "LAST", "WINTER", "CITY", "MOON", "ATLAS"]
+
+
+def synthetic_shelf(width, height, spines, seed=0):
+    """
+    Draw a bookshelf of `spines` vertical book spines with titles, spread over
+    as many shelves as needed to keep spines a plausible width.
+
+    Args:
+        width, height: image size in pixels
+        spines: number of spines
+        seed: random seed, so the same arguments always give the same image
+
+    Returns:
+        (image, boxes): RGB image, and the (x1, y1, x2, y2) box of each spine
+    """
+    rng = np.random.default_rng(seed)
+    image = np.full((height, width, 3), (90, 60, 40), dtype=np.uint8)
+    shelves = max(1, round(np.sqrt(spines * height / width / 4)))
+    per_shelf = np.diff(np.linspace(0, spines, shelves + 1).round().astype(int))
+    shelf_h = height // shelves
+    board = max(2, shelf_h // 20)
+
+    boxes = []
+    for row, count in enumerate(per_shelf):
+        top = row * shelf_h
+        image[top + shelf_h - board:top + shelf_h] = (60, 40, 25)
+        if count == 0:
+            continue
+        widths = rng.uniform(0.6, 1.4, count)
+        edges = np.concatenate(([0], np.cumsum(widths / widths.sum() * width))).astype(int)
+        for x1, x2 in zip(edges[:-1], edges[1:]):
+            spine_h = int(rng.uniform(0.7, 0.95) * (shelf_h - board))
+            y1, y2 = top + shelf_h - board - spine_h, top + shelf_h - board
+            color = tuple(int(c) for c in rng.integers(30, 226, 3))
+            image[y1:y2, x1:x2] = color
+
+            # Title written along the spine: draw it horizontally, then rotate
+            title = " ".join(rng.choice(WORDS, rng.integers(1, 4)))
+            label = np.zeros((x2 - x1, spine_h, 3), dtype=np.uint8)
+            label[:] = color
+            (text_w, _), _ = cv2.getTextSize(title, cv2.FONT_HERSHEY_SIMPLEX, 1.0, 2)
+            scale = max(0.3, min((x2 - x1) / 60, 0.8 * spine_h / text_w))
+            text_color = (255, 255, 255) if sum(color) < 380 else (0, 0, 0)
+            cv2.putText(label, title, (max(2, spine_h // 10), int((x2 - x1) * 0.65)),
+                        cv2.FONT_HERSHEY_SIMPLEX, scale, text_color, max(1, int(scale * 2)))
+            image[y1:y2, x1:x2] = cv2.rotate(label, cv2.ROTATE_90_CLOCKWISE)
+            boxes.append((int(x1), int(y1), int(x2), int(y2)))
+    return image, boxes
+
+
+def synthetic_ocr(boxes, boxes_per_spine, seed=0):
+    """
+    Make OCR output with `boxes_per_spine` text boxes stacked inside each spine,
+    in the form returned by ocr_from_array.
+
+    Returns:
+        (boxes, texts, confidences)
+    """
+    rng = np.random.default_rng(seed)
+    ocr_boxes, texts, confidences = [], [], []
+    for x1, y1, x2, y2 in boxes:
+        step = (y2 - y1) / boxes_per_spine
+        for i in range(boxes_per_spine):
+            top, bottom = int(y1 + i * step), int(y1 + (i + 1) * step)
+            ocr_boxes.append([[x1, top], [x2, top], [x2, bottom], [x1, bottom]])
+            texts.append(" ".join(rng.choice(WORDS, 2)))
+            confidences.append(float(rng.uniform(0.5, 1.0)))
+    return ocr_boxes, texts, confidences
+
+
+class StubModels:
+    """
+    Stand-in for client.aio.models that answers instantly and deterministically:
+    numbers and strings in the response are derived from a hash of the prompt.
+    """
+    async def generate_content(self, model, contents, config):
+        schema = config["response_schema"]
+        digest = hashlib.sha256(contents.encode()).digest()
+        values = {}
+        for i, (name, field) in enumerate(schema.model_fields.items()):
+            byte = digest[i % len(digest)]
+            if field.annotation is float:
+                values[name] = byte / 255
+            elif field.annotation is int:
+                values[name] = 0
+            else:
+                values[name] = f"{name}-{byte}"
+        return type("StubResponse", (), {"parsed": schema(**values)})()
+
+
+class StubClient:
+    def __init__(self):
+        self.aio = type("StubAio", (), {"models": StubModels()})()
+
+
+def time_stage(fn, repeat, warmup=1):
+    """
+    Call `fn` warmup + repeat times and summarise the timed calls.
+
+    Returns:
+        dict of timing statistics in seconds
+    """
+    for _ in range(warmup):
+        fn()
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - start)
+    times.sort()
+    return {
+        "repeat": repeat,
+        "min_seconds": times[0],
+        "median_seconds": statistics.median(times),
+        "mean_seconds": statistics.fmean(times),
+        "p95_seconds": times[min(len(times) - 1, int(0.95 * len(times)))],
+    }
+
+
+def stub_analyse(prompt):
+    """
+    Run analyse_bookshelf_async against the stub client, bypassing the cache.
+    """
+    llm_cache.clear()
+    return asyncio.run(llm_client.analyse_bookshelf_async(prompt, mode='analysis'))
+
+
+def bench_sample(repeat, skip_ocr=False):
+    """
+    Time every stage on images/bookshelf3.png.
+    """
+    with open(SAMPLE_IMAGE, "rb") as f:
+        content = f.read()
+    img = read_image(content, max_dim=1024)
+    segmenter = SimpleSegmenter(img, min_size_factor=0.05)
+    segments = segmenter.segment()
+    crops = segmenter.get_crops(segments)
+
+    results = {
+        "read_image": time_stage(lambda: read_image(content, max_dim=1024), repeat),
+        "segment": time_stage(lambda: SimpleSegmenter(img, min_size_factor=0.05).segment(), repeat),
+    }
+    if skip_ocr:
+        ocr_data = synthetic_ocr(segments, 1)
+    else:
+        results["ocr_from_array"] = time_stage(lambda: ocr_from_array(img), repeat)
+        results["ocr_from_crops"] = time_stage(lambda: ocr_from_crops(crops), repeat)
+        ocr_data = ocr_from_array(img)
+    results["assign_text_to_segments"] = time_stage(
+        lambda: assign_text_to_segments(img, segments, ocr_data), repeat)
+    segment_texts = assign_text_to_segments(img, segments, ocr_data)
+    results["build_spine_prompt"] = time_stage(lambda: build_spine_prompt(segment_texts), repeat)
+    prompt = build_spine_prompt(segment_texts)
+    results["llm_stub"] = time_stage(lambda: stub_analyse(prompt), repeat)
+    results["render_highlight"] = time_stage(lambda: render_highlight(img, segments, segments[0]), repeat)
+    return {"case": {"image": "bookshelf3.png"}, "stages": results}
+
+
+def bench_synthetic(width, height, spines, boxes_per_spine, repeat):
+    """
+    Time the image stages on a synthetic shelf, and assign_text_to_segments
+    for each number of OCR boxes per spine.
+    """
+    img, boxes = synthetic_shelf(width, height, spines)
+    ok, encoded = cv2.imencode(".png", cv2.cvtColor(img, cv2.COLOR_RGB2BGR))
+    content = encoded.tobytes()
+    max_dim = max(width, height)
+    segments = SimpleSegmenter(img, max_dim=max_dim, min_size_factor=0.05).segment()
+
+    results = {
+        "read_image": time_stage(lambda: read_image(content, max_dim=max_dim), repeat),
+        "segment": time_stage(
+            lambda: SimpleSegmenter(img, max_dim=max_dim, min_size_factor=0.05).segment(), repeat),
+        "render_highlight": time_stage(lambda: render_highlight(img, segments, segments[0]), repeat),
+    }
+    for b in boxes_per_spine:
+        # Assign against the true spines so S is exactly `spines`
+        ocr_data = synthetic_ocr(boxes, b)
+        results[f"assign_text_to_segments/b{b}"] = time_stage(
+            lambda: assign_text_to_segments(img, boxes, ocr_data), repeat)
+        segment_texts = assign_text_to_segments(img, boxes, ocr_data)
+        results[f"build_spine_prompt/b{b}"] = time_stage(lambda: build_spine_prompt(segment_texts), repeat)
+    return {
+        "case": {"width": width, "height": height, "spines": spines, "segments_found": len(segments)},
+        "stages": results,
+    }
+
+
+def run_benchmarks(resolutions, spines, boxes_per_spine, repeat, skip_ocr=False):
+    """
+    Run the whole suite.
+
+    Returns:
+        dict with machine metadata and a flat "results" dict of
+        "<case>/<stage>" -> timing statistics
+    """
+    llm_client._client = StubClient()
+    cases = {"bookshelf3": bench_sample(repeat, skip_ocr)}
+    for width, height in resolutions:
+        for s in spines:
+            cases[f"synthetic-{width}x{height}-s{s}"] = bench_synthetic(width, height, s, boxes_per_spine, repeat)
+
+    return {
+        "meta": {
+            "python": platform.python_version(),
+            "numpy": np.__version__,
+            "opencv": cv2.__version__,
+            "machine": platform.machine(),
+            "cpu_count": os.cpu_count(),
+        },
+        "cases": {name: case["case"] for name, case in cases.items()},
+        "results": {
+            f"{name}/{stage}": stats
+            for name, case in cases.items()
+            for stage, stats in case["stages"].items()
+        },
+    }
+
+
+def compare(report, baseline, tolerance, min_delta=0.001):
+    """
+    Compare the fastest run of each stage against a baseline report. A stage
+    has regressed if it is slower by more than `tolerance` (relative) and
+    `min_delta` seconds, so that jitter in sub-millisecond stages is ignored.
+
+    Returns:
+        List of (name, baseline_min, min, ratio, regressed) for stages
+        present in both reports.
+    """
+    rows = []
+    for name, stats in report["results"].items():
+        if name not in baseline["results"]:
+            continue
+        before = baseline["results"][name]["min_seconds"]
+        after = stats["min_seconds"]
+        ratio = after / before if before > 0 else float("inf")
+        rows.append((name, before, after, ratio, ratio > 1 + tolerance and after - before > min_delta))
+    return rows
+
+
+def parse_resolutions(text):
+    return [tuple(int(v) for v in r.split("x")) for r in text.split(",") if r]
+
+
+def parse_ints(text):
+    return [int(v) for v in text.split(",") if v]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--resolutions", type=parse_resolutions, default=parse_resolutions("1024x768,2048x1536"))
+    parser.add_argument("--spines", type=parse_ints, default=parse_ints("10,40"))
+    parser.add_argument("--boxes-per-spine", type=parse_ints, default=parse_ints("1,4"))
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--skip-ocr", action="store_true", help="Skip the (slow) RapidOCR stages")
+    parser.add_argument("--json", help="Write the report to this file")
+    parser.add_argument("--baseline", help="Compare against this report")
+    parser.add_argument("--save-baseline", action="store_true", help=f"Write the report to {DEFAULT_BASELINE}")
+    parser.add_argument("--tolerance", type=float, default=0.25,
+                        help="Allowed relative slowdown of a stage before it counts as a regression")
+    parser.add_argument("--min-delta-ms", type=float, default=1.0,
+                        help="Ignore slowdowns smaller than this, in milliseconds")
+    args = parser.parse_args()
+
+    report = run_benchmarks(args.resolutions, args.spines, args.boxes_per_spine, args.repeat, args.skip_ocr)
+    for name, stats in report["results"].items():
+        print(f"  {stats['median_seconds'] * 1000:10.2f}ms  {name}")
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(report, f, indent=2)
+    if args.save_baseline:
+        with open(DEFAULT_BASELINE, "w") as f:
+            json.dump(report, f, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        rows = compare(report, baseline, args.tolerance, args.min_delta_ms / 1000)
+        print(f"\nCompared with {args.baseline}:")
+        for name, before, after, ratio, regressed in rows:
+            flag = "  REGRESSION" if regressed else ""
+            print(f"  {before * 1000:10.2f}ms -> {after * 1000:10.2f}ms  x{ratio:5.2f}  {name}{flag}")
+        regressions = [row for row in rows if row[4]]
+        if regressions:
+            print(f"{len(regressions)} stage(s) slower than the baseline by more than {args.tolerance:.0%}")
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,37 @@
+import pytest
+
+from app.services import llm_client
+from app.services.llm_cache import llm_cache
+
+
+def fake_response(prompt, response_schema, model):
+    """
+    A fixed, valid response for each schema the app asks Gemini for.
+    """
+    if response_schema is llm_client.BookshelfAnalysis:
+        return llm_client.BookshelfAnalysis(
+            age=0.5, intensity=0.5, mood=0.5, popularity=0.5, focus=0.5, realism=0.5,
+            word_one="one", word_two="two", word_three="three",
+            recommended_book="Entry Island", explanation=f"answered by {model}",
+        )
+    if response_schema is llm_client.LibraryAnalysis:
+        return llm_client.LibraryAnalysis(
+            recommended_book="Entry Island", explanation=f"answered by {model}", recommended_idx=0,
+        )
+    if response_schema == list[llm_client.BookInfo]:
+        return [llm_client.BookInfo(idx=0, title="Entry Island", author="Peter May", confidence=0.9)]
+    raise AssertionError(f"Unexpected schema {response_schema}")
+
+
+@pytest.fixture
+def fake_llm():
+    """
+    Route LLM calls to a FakeLLMBackend with an empty response cache; the
+    test can change its latency and responses.
+    """
+    backend = llm_client.FakeLLMBackend(fake_response)
+    llm_client.set_llm_backend(backend)
+    llm_cache.clear()
+    yield backend
+    llm_client.set_llm_backend(llm_client.GeminiBackend())
+    llm_cache.clear()
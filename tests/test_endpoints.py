@@ -0,0 +1,107 @@
+import asyncio
+import json
+from pathlib import Path
+
+import pytest
+from fastapi.testclient import TestClient
+
+from app.main import app
+from app.services.executor import PipelineWorkerError
+
+IMAGE = Path(__file__).resolve().parent.parent / "images" / "bookshelf3.png"
+
+
+@pytest.fixture(scope="module")
+def client():
+    # Not entered as a context manager, so models aren't warmed up in the background
+    return TestClient(app)
+
+
+@pytest.fixture(scope="module")
+def image_bytes():
+    return IMAGE.read_bytes()
+
+
+def parse_sse(body):
+    """
+    Return the (event, data) pairs of a server-sent event stream.
+    """
+    events = []
+    for block in body.strip().split("\n\n"):
+        lines = dict(line.split(": ", 1) for line in block.splitlines())
+        events.append((lines["event"], json.loads(lines["data"])))
+    return events
+
+
+def test_stream_uses_llm_backend(client, image_bytes, fake_llm):
+    response = client.post("/mybookshelf/stream", files={"file": ("shelf.png", image_bytes, "image/png")})
+
+    assert response.status_code == 200
+    events = parse_sse(response.text)
+    names = [name for name, _ in events]
+    assert names[:3] == ["decoded", "segments", "spine_texts"]
+    assert "token" in names
+    assert names[-1] == "analysis"
+    assert events[-1][1]["recommendation"]["recommended_book"] == "Entry Island"
+    assert fake_llm.calls
+
+
+def test_bookcase_cancels_other_shelves_when_one_fails(client, image_bytes, fake_llm, monkeypatch):
+    from app.api import endpoints
+    from app.services.executor import pipeline
+
+    # Requests in flight when the good shelf was cancelled
+    cancelled = []
+
+    async def slow_extract(content, img, **params):
+        try:
+            await asyncio.sleep(30)
+        except asyncio.CancelledError:
+            cancelled.append(pipeline.stats()["inflight"])
+            raise
+
+    monkeypatch.setattr(endpoints, "extract_spine_texts", slow_extract)
+    response = client.post("/mybookcase", files=[
+        ("files", ("shelf1.png", image_bytes, "image/png")),
+        ("files", ("shelf2.png", b"not an image", "image/png")),
+    ])
+
+    assert response.status_code == 400
+    # Cancelled before the request gave up its pipeline slot
+    assert cancelled == [1]
+    assert not fake_llm.calls
+
+
+@pytest.mark.parametrize("error, retry_after", [
+    (PipelineWorkerError(), PipelineWorkerError().retry_after),
+    (RuntimeError("boom"), None),
+])
+def test_stream_reports_pipeline_errors(client, image_bytes, fake_llm, monkeypatch, error, retry_after):
+    from app.api import endpoints
+
+    async def failing_extract(content, img, **params):
+        raise error
+
+    monkeypatch.setattr(endpoints, "extract_spine_texts", failing_extract)
+    response = client.post("/mybookshelf/stream", files={"file": ("shelf.png", image_bytes, "image/png")})
+
+    assert response.status_code == 200
+    events = parse_sse(response.text)
+    assert [name for name, _ in events] == ["decoded", "error"]
+    assert events[-1][1].get("retry_after") == retry_after
+    assert not fake_llm.calls
+
+
+@pytest.mark.parametrize("format, magic", [("png", b"\x89PNG"), ("jpeg", b"\xff\xd8")])
+def test_highlight_times_rendering_and_encoding(client, image_bytes, format, magic):
+    response = client.post(
+        "/highlight",
+        files={"file": ("shelf.png", image_bytes, "image/png")},
+        data={"segment": "[0, 190, 601, 240]", "format": format},
+    )
+
+    assert response.status_code == 200
+    assert response.content.startswith(magic)
+    stages = [entry.split(";")[0] for entry in response.headers["Server-Timing"].split(", ")]
+    assert "render_highlight" in stages
+    assert "encode_image" in stages
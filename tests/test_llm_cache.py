@@ -0,0 +1,39 @@
+import time
+
+from app.services.llm_cache import SQLiteLLMBackend
+
+
+def row_count(backend):
+    return backend._conn.execute("SELECT COUNT(*) FROM llm_cache").fetchone()[0]
+
+
+def test_get_expires_entry(tmp_path):
+    backend = SQLiteLLMBackend(str(tmp_path / "cache.sqlite"), ttl=0, purge_interval=3600)
+    backend.set("key", "{}")
+    time.sleep(0.01)
+    assert backend.get("key") is None
+    assert row_count(backend) == 0
+
+
+def test_set_purges_expired_entries_after_interval(tmp_path):
+    backend = SQLiteLLMBackend(str(tmp_path / "cache.sqlite"), ttl=3600, purge_interval=0)
+    backend.set("old", "{}")
+    backend._conn.execute("UPDATE llm_cache SET created = ?", (time.time() - 7200,))
+    backend._conn.commit()
+
+    backend.set("new", "{}")
+
+    assert row_count(backend) == 1
+    assert backend.get("new") == "{}"
+
+
+def test_set_does_not_purge_before_interval(tmp_path):
+    backend = SQLiteLLMBackend(str(tmp_path / "cache.sqlite"), ttl=3600, purge_interval=3600)
+    backend.set("old", "{}")
+    backend._conn.execute("UPDATE llm_cache SET created = ?", (time.time() - 7200,))
+    backend._conn.commit()
+
+    backend.set("new", "{}")
+
+    assert row_count(backend) == 2
+    assert backend.purge_expired() == 1
@@ -0,0 +1,135 @@
+import asyncio
+import json
+import time
+
+import pytest
+
+from app.services import llm_client
+from app.services.llm_cache import llm_cache
+
+PROMPT = "Scan 0: PETER MAY ENTRY ISLAND"
+
+
+@pytest.fixture
+def policy(monkeypatch):
+    """
+    Latency policy settings, patched per test.
+    """
+    monkeypatch.setattr(llm_client, "GEMINI_HEDGE", True)
+    monkeypatch.setattr(llm_client, "GEMINI_HEDGE_DELAY", None)
+    monkeypatch.setattr(llm_client, "GEMINI_FALLBACK_MODEL", None)
+    return monkeypatch
+
+
+def slow_first_call(fake_llm, seconds):
+    """
+    Make the first call to the backend take `seconds`, and later ones none.
+    """
+    def latency(model):
+        return seconds if len(fake_llm.calls) == 1 else 0.0
+    fake_llm.latency = latency
+
+
+def record_latency(model, seconds, samples=llm_client.GEMINI_LATENCY_MIN_SAMPLES):
+    for _ in range(samples):
+        llm_client._latency_tracker(model).record(seconds)
+
+
+def test_hedge_answers_when_first_call_is_slow(fake_llm, policy):
+    policy.setattr(llm_client, "GEMINI_HEDGE_DELAY", 0.05)
+    slow_first_call(fake_llm, 5.0)
+
+    start = time.monotonic()
+    result = asyncio.run(llm_client.generate_async(PROMPT, llm_client.BookshelfAnalysis))
+
+    assert time.monotonic() - start < 1.0
+    assert result.recommended_book == "Entry Island"
+    assert fake_llm.calls == [llm_client.DEFAULT_MODEL, llm_client.DEFAULT_MODEL]
+
+
+def test_no_hedge_before_delay(fake_llm, policy):
+    policy.setattr(llm_client, "GEMINI_HEDGE_DELAY", 1.0)
+    fake_llm.latency = 0.01
+
+    asyncio.run(llm_client.generate_async(PROMPT, llm_client.BookshelfAnalysis))
+
+    assert fake_llm.calls == [llm_client.DEFAULT_MODEL]
+
+
+def test_no_hedge_without_latency_history(fake_llm, policy):
+    slow_first_call(fake_llm, 0.2)
+
+    asyncio.run(llm_client.generate_async(PROMPT, llm_client.BookshelfAnalysis))
+
+    assert fake_llm.calls == [llm_client.DEFAULT_MODEL]
+
+
+def test_hedge_delay_follows_observed_latency(fake_llm, policy):
+    policy.setattr(llm_client, "GEMINI_HEDGE_MIN_DELAY", 0.0)
+    record_latency(llm_client.DEFAULT_MODEL, 0.05)
+    slow_first_call(fake_llm, 5.0)
+
+    asyncio.run(llm_client.generate_async(PROMPT, llm_client.BookshelfAnalysis))
+
+    assert fake_llm.calls == [llm_client.DEFAULT_MODEL, llm_client.DEFAULT_MODEL]
+
+
+def test_fallback_model_near_deadline(fake_llm, policy):
+    policy.setattr(llm_client, "GEMINI_FALLBACK_MODEL", "fallback-model")
+    record_latency(llm_client.DEFAULT_MODEL, 30.0)
+
+    result = asyncio.run(llm_client.generate_async(PROMPT, llm_client.BookshelfAnalysis, deadline=5.0))
+
+    assert fake_llm.calls == ["fallback-model"]
+    assert result.explanation == "answered by fallback-model"
+
+
+def test_fallback_answer_is_not_cached(fake_llm, policy):
+    policy.setattr(llm_client, "GEMINI_FALLBACK_MODEL", "fallback-model")
+    # Longer than the whole deadline, so the fallback model is used
+    record_latency(llm_client.DEFAULT_MODEL, 2 * llm_client.GEMINI_DEADLINE)
+
+    async def analyse_twice():
+        await llm_client.analyse_bookshelf_async(PROMPT, mode='analysis')
+        await llm_client.analyse_bookshelf_async(PROMPT, mode='analysis')
+    asyncio.run(analyse_twice())
+
+    assert fake_llm.calls == ["fallback-model", "fallback-model"]
+    assert llm_cache.stats()["entries"] == 0
+
+
+def test_default_model_answer_is_cached(fake_llm, policy):
+    async def analyse_twice():
+        first = await llm_client.analyse_bookshelf_async(PROMPT, mode='analysis')
+        second = await llm_client.analyse_bookshelf_async(PROMPT, mode='analysis')
+        return first, second
+
+    first, second = asyncio.run(analyse_twice())
+
+    assert first == second
+    assert fake_llm.calls == [llm_client.DEFAULT_MODEL]
+
+
+def test_stream_goes_through_backend(fake_llm, policy):
+    async def collect():
+        return [item async for item in llm_client.analyse_bookshelf_stream(PROMPT, mode='analysis')]
+
+    items = asyncio.run(collect())
+
+    tokens = [value for kind, value in items if kind == 'token']
+    assert len(tokens) > 1
+    assert items[-1][0] == 'result'
+    assert json.loads("".join(tokens)) == items[-1][1].model_dump()
+    assert fake_llm.calls == [llm_client.DEFAULT_MODEL]
+
+
+def test_stream_times_out_on_slow_backend(fake_llm, policy):
+    policy.setattr(llm_client, "GEMINI_MAX_RETRIES", 0)
+    fake_llm.latency = 5.0
+
+    async def collect():
+        return [text async for text in llm_client.generate_stream_async(
+            PROMPT, llm_client.BookshelfAnalysis, deadline=0.05)]
+
+    with pytest.raises(llm_client.LLMTimeoutError):
+        asyncio.run(collect())
@@ -0,0 +1,92 @@
+import numpy as np
+import pytest
+from app.services.ocr import assign_text_to_segments
+
+
+def reference_assign(img, spines, ocr_data):
+    """
+    The original loop over every spine and every box, returning the same
+    (text, segment, fragments) tuples as assign_text_to_segments.
+    """
+    ocr_boxes, ocr_texts, ocr_confs = ocr_data
+    segment_texts = []
+
+    for x1, y1, x2, y2 in spines:
+        fragments = []
+        for box, text, conf in zip(ocr_boxes, ocr_texts, ocr_confs):
+            if conf <= 0:
+                continue
+            xs = [pt[0] for pt in box]
+            ys = [pt[1] for pt in box]
+            ox1, oy1, ox2, oy2 = min(xs), min(ys), max(xs), max(ys)
+
+            inter_x1 = max(x1, ox1)
+            inter_y1 = max(y1, oy1)
+            inter_x2 = min(x2, ox2)
+            inter_y2 = min(y2, oy2)
+            inter_area = max(0, inter_x2 - inter_x1) * max(0, inter_y2 - inter_y1)
+            box_area = (ox2 - ox1) * (oy2 - oy1)
+
+            if box_area > 0 and inter_area / box_area >= 0.5:
+                fragments.append((text.strip(), float(conf)))
+
+        if fragments:
+            combined_text = " ".join(text for text, _ in fragments)
+            segment_texts.append((combined_text, [x1, y1, x2, y2], fragments))
+
+    segment_texts.sort(key=lambda x: len(x[0]), reverse=True)
+    return segment_texts
+
+
+def random_case(rng, w=600, h=400):
+    """
+    Random spines and OCR results, including zero-area boxes, boxes without
+    confidence and boxes straddling spine edges.
+    """
+    spines = []
+    for _ in range(rng.integers(0, 15)):
+        x1, x2 = sorted(int(v) for v in rng.choice(w + 1, 2, replace=False))
+        y1, y2 = sorted(int(v) for v in rng.choice(h + 1, 2, replace=False))
+        spines.append((x1, y1, x2, y2))
+
+    boxes, texts, confs = [], [], []
+    for i in range(rng.integers(0, 40)):
+        cx, cy = rng.uniform(0, w), rng.uniform(0, h)
+        bw, bh = rng.choice([0.0, rng.uniform(1, 80)]), rng.uniform(0, 80)
+        angle = rng.uniform(-0.3, 0.3)
+        corners = [(-bw / 2, -bh / 2), (bw / 2, -bh / 2), (bw / 2, bh / 2), (-bw / 2, bh / 2)]
+        box = [[cx + dx * np.cos(angle) - dy * np.sin(angle), cy + dx * np.sin(angle) + dy * np.cos(angle)]
+               for dx, dy in corners]
+        if rng.random() < 0.3:
+            box = [[round(x), round(y)] for x, y in box]
+        boxes.append(box)
+        texts.append(rng.choice(["", " "]) + f"word{i}" * int(rng.integers(1, 4)) + rng.choice(["", "\n"]))
+        confs.append(float(rng.choice([0.0, -0.1, rng.uniform(0, 1)])))
+    return spines, [boxes, texts, confs]
+
+
+@pytest.mark.parametrize("seed", range(300))
+def test_assign_text_matches_reference(seed):
+    img = np.zeros((400, 600, 3), np.uint8)
+    spines, ocr_data = random_case(np.random.default_rng(seed))
+    assert assign_text_to_segments(img, spines, ocr_data) == reference_assign(img, spines, ocr_data)
+
+
+def test_assign_text_returns_fragments():
+    img = np.zeros((100, 100, 3), np.uint8)
+    spines = [(0, 0, 50, 100), (50, 0, 100, 100)]
+    boxes = [[[5, 10], [45, 10], [45, 20], [5, 20]],
+             [[5, 30], [45, 30], [45, 40], [5, 40]],
+             [[60, 10], [95, 10], [95, 20], [60, 20]]]
+    ocr_data = [boxes, [" PETER MAY ", "ENTRY ISLAND", "QUERCUS"], [0.9, 0.8, 0.7]]
+
+    assert assign_text_to_segments(img, spines, ocr_data) == [
+        ("PETER MAY ENTRY ISLAND", [0, 0, 50, 100], [("PETER MAY", 0.9), ("ENTRY ISLAND", 0.8)]),
+        ("QUERCUS", [50, 0, 100, 100], [("QUERCUS", 0.7)]),
+    ]
+
+
+def test_assign_text_without_boxes_or_spines():
+    img = np.zeros((100, 100, 3), np.uint8)
+    assert assign_text_to_segments(img, [(0, 0, 50, 100)], [[], [], []]) == []
+    assert assign_text_to_segments(img, [], [[[[0, 0], [1, 0], [1, 1], [0, 1]]], ["A"], [1.0]]) == []
@@ -0,0 +1,214 @@
+import cv2
+import numpy as np
+import pytest
+from app.services.image_processing import SimpleSegmenter
+
+IMAGE = "images/bookshelf3.png"
+
+
+def baseline_score_split(segmenter, seg, pos, direction, center_penalty):
+    """
+    The original scorer: a Sobel run on each candidate's band on its own.
+    """
+    x1, y1, x2, y2 = seg
+    band_width = 3
+    width = x2 - x1
+    height = y2 - y1
+
+    if direction == 'vertical':
+        split_band = segmenter.gray[y1:y2, max(x1, pos - band_width):min(x2, pos + band_width)]
+        grad = cv2.Sobel(split_band, cv2.CV_64F, 1, 0, ksize=3)
+        rel_pos = (pos - x1) / (x2 - x1)
+        cuts_shorter_side = width < height
+        edge_score = np.sum(np.abs(grad)) / ((y2 - y1)**2)
+    else:
+        split_band = segmenter.gray[max(y1, pos - band_width):min(y2, pos + band_width), x1:x2]
+        grad = cv2.Sobel(split_band, cv2.CV_64F, 0, 1, ksize=3)
+        rel_pos = (pos - y1) / (y2 - y1)
+        cuts_shorter_side = height < width
+        edge_score = np.sum(np.abs(grad)) / ((x2 - x1)**2)
+
+    if cuts_shorter_side and max(width / height, height / width) > segmenter.soft_aspect_threshold:
+        penalty = 1.0
+    else:
+        dist_from_center = abs(rel_pos - 0.5) * 2
+        penalty = (dist_from_center ** (1 + center_penalty))
+    return penalty * edge_score
+
+
+class BaselineSegmenter(SimpleSegmenter):
+    """
+    SimpleSegmenter scoring every candidate one by one with the original scorer.
+    """
+    def __init__(self, image, **params):
+        super().__init__(image, batched=False, stride=5, **params)
+
+    def score_split(self, seg, pos, direction, center_penalty):
+        return baseline_score_split(self, seg, pos, direction, center_penalty)
+
+
+def baseline_segment(segmenter):
+    """
+    The original segment(): split every leaf, pass by pass, until none splits.
+    """
+    h, w = segmenter.image.shape[:2]
+    segments = [(0, 0, w, h)]
+    confidence = {(0, 0, w, h): 1.0}
+    changed = True
+    while changed:
+        changed = False
+        new_segments = []
+        for seg in segments:
+            split_result = segmenter.try_split(seg)
+            if split_result:
+                children, score = split_result
+                for child in children:
+                    if (child[2] - child[0] >= w * segmenter.min_child_ratio or
+                            child[3] - child[1] >= h * segmenter.min_child_ratio):
+                        confidence[child] = score
+                new_segments.extend(children)
+                changed = True
+            else:
+                new_segments.append(seg)
+        segments = new_segments
+    segments = sorted(segments, key=lambda s: (s[2] - s[0]) * (s[3] - s[1]), reverse=True)
+    return segments, {seg: confidence[seg] for seg in segments if seg in confidence}
+
+
+@pytest.fixture(scope="module")
+def baseline():
+    return baseline_segment(BaselineSegmenter(IMAGE))
+
+
+def random_image(rng, h=240, w=320):
+    """
+    Noise over a few flat blocks, so bands see both strong and weak edges.
+    """
+    image = rng.integers(0, 256, (h, w, 3), dtype=np.uint8)
+    for _ in range(6):
+        x, y = rng.integers(0, w - 40), rng.integers(0, h - 40)
+        image[y:y + 40, x:x + 40] = rng.integers(0, 256, 3, dtype=np.uint8)
+    return image
+
+
+@pytest.mark.parametrize("grad_dtype", [np.float64, np.float32])
+def test_score_split_matches_baseline(grad_dtype):
+    rng = np.random.default_rng(0)
+    segmenter = SimpleSegmenter(random_image(rng), grad_dtype=grad_dtype)
+    h, w = segmenter.gray.shape
+    for _ in range(500):
+        x1, x2 = sorted(rng.choice(w + 1, 2, replace=False))
+        y1, y2 = sorted(rng.choice(h + 1, 2, replace=False))
+        seg = (int(x1), int(y1), int(x2), int(y2))
+        for direction, (lo, hi) in (('vertical', (x1, x2)), ('horizontal', (y1, y2))):
+            pos = int(rng.integers(lo, hi + 1))
+            expected = baseline_score_split(segmenter, seg, pos, direction, 0.2)
+            assert segmenter.score_split(seg, pos, direction, 0.2) == expected, (seg, pos, direction)
+
+
+@pytest.mark.parametrize("grad_dtype", [np.float64, np.float32])
+def test_segment_matches_baseline(baseline, grad_dtype):
+    segmenter = SimpleSegmenter(IMAGE, grad_dtype=grad_dtype, batched=False)
+    segments = segmenter.segment()
+    assert (segments, segmenter.segment_confidence) == baseline
+
+
+@pytest.mark.parametrize("seed", range(3))
+def test_batched_matches_unbatched(seed):
+    image = random_image(np.random.default_rng(seed), 360, 480)
+    results = []
+    for batched in (True, False):
+        segmenter = SimpleSegmenter(image, stride=5, batched=batched)
+        results.append((segmenter.segment(), segmenter.segment_confidence))
+    assert results[0] == results[1]
+
+
+def test_batched_segment_matches_baseline(baseline):
+    segmenter = SimpleSegmenter(IMAGE, stride=5, batched=True)
+    segments = segmenter.segment()
+    assert (segments, segmenter.segment_confidence) == baseline
+
+
+# Largest difference (in pixels) allowed between coordinates of matching segments
+PIXEL_TOLERANCE = 2
+
+
+def segments_close(segments, expected, tolerance=PIXEL_TOLERANCE):
+    if len(segments) != len(expected):
+        return False
+    diff = np.abs(np.array(sorted(segments)) - np.array(sorted(expected)))
+    return bool(diff.max(initial=0) <= tolerance)
+
+
+@pytest.fixture(scope="module")
+def single_scale():
+    return SimpleSegmenter(IMAGE, pyramid_levels=0).segment()
+
+
+@pytest.mark.parametrize("pyramid_levels", [1, 2])
+def test_pyramid_matches_single_scale(single_scale, pyramid_levels):
+    segments = SimpleSegmenter(IMAGE, pyramid_levels=pyramid_levels).segment()
+    assert segments_close(segments, single_scale)
+
+
+def test_pyramid_level_3_with_more_candidates(single_scale):
+    # At 1/8 scale the 1024px image is coarse, so more candidates are refined
+    segments = SimpleSegmenter(IMAGE, pyramid_levels=3, pyramid_candidates=8).segment()
+    assert segments_close(segments, single_scale)
+
+
+def greedy_leaves(segmenter, max_leaves):
+    """
+    Reference for a capped segment(): split the best-scoring leaf, found by
+    scanning all leaves, until max_leaves are reached or none splits.
+    """
+    h, w = segmenter.image.shape[:2]
+    splits = {}
+    leaves = [((), (0, 0, w, h))]
+    while len(leaves) < max_leaves:
+        candidates = []
+        for path, seg in leaves:
+            if seg not in splits:
+                splits[seg] = segmenter.try_split(seg)
+            if splits[seg]:
+                children, score = splits[seg]
+                candidates.append((-score, path, seg, children))
+        if not candidates:
+            break
+        _, path, seg, children = min(candidates)
+        leaves.remove((path, seg))
+        leaves.extend((path + (i,), child) for i, child in enumerate(children))
+    return sorted(seg for _, seg in leaves)
+
+
+@pytest.fixture(scope="module")
+def full_segments():
+    return SimpleSegmenter(IMAGE).segment()
+
+
+@pytest.mark.parametrize("max_leaves", [1, 2, 5, 10])
+def test_max_leaves_caps_leaves(full_segments, max_leaves):
+    segmenter = SimpleSegmenter(IMAGE, max_leaves=max_leaves)
+    segments = segmenter.segment()
+    assert len(segments) == max_leaves < len(full_segments)
+    # The leaves still tile the image
+    h, w = segmenter.image.shape[:2]
+    assert sum((x2 - x1) * (y2 - y1) for x1, y1, x2, y2 in segments) == w * h
+
+
+@pytest.mark.parametrize("max_leaves", [2, 5, 10])
+def test_max_leaves_splits_highest_scores_first(max_leaves):
+    segmenter = SimpleSegmenter(IMAGE, max_leaves=max_leaves)
+    assert sorted(segmenter.segment()) == greedy_leaves(segmenter, max_leaves)
+
+
+def test_max_leaves_above_leaf_count_changes_nothing(full_segments):
+    assert SimpleSegmenter(IMAGE, max_leaves=len(full_segments) + 1).segment() == full_segments
+
+
+def test_time_budget(full_segments):
+    # With no time left, the image isn't split at all
+    segmenter = SimpleSegmenter(IMAGE, time_budget=0)
+    h, w = segmenter.image.shape[:2]
+    assert segmenter.segment() == [(0, 0, w, h)]
+    assert SimpleSegmenter(IMAGE, time_budget=60).segment() == full_segments
@@ -0,0 +1,76 @@
+import time
+
+import numpy as np
+
+from app.services.session_store import SessionStore
+
+
+def image(nbytes=1000):
+    return np.zeros(nbytes, np.uint8)
+
+
+def test_get_returns_image_and_segments():
+    store = SessionStore(ttl=60, max_bytes=10_000)
+    img = image()
+    session_id = store.create(img, [[0, 0, 10, 10]])
+
+    stored_img, segments = store.get(session_id)
+    assert stored_img is img
+    assert segments == [(0, 0, 10, 10)]
+    assert store.get("unknown") is None
+    assert store.stats()["hits"] == 1 and store.stats()["misses"] == 1
+
+
+def test_session_expires_after_ttl():
+    store = SessionStore(ttl=0.05, max_bytes=10_000)
+    session_id = store.create(image(), [])
+    time.sleep(0.1)
+
+    assert store.get(session_id) is None
+    assert store.stats()["bytes"] == 0
+
+
+def test_create_drops_expired_sessions():
+    store = SessionStore(ttl=0.05, max_bytes=10_000)
+    store.create(image(), [])
+    store.create(image(), [])
+    time.sleep(0.1)
+
+    session_id = store.create(image(), [])
+
+    assert store.stats()["sessions"] == 1
+    assert store.stats()["bytes"] == 1000
+    assert store.stats()["evictions"] == 0
+    assert store.get(session_id) is not None
+
+
+def test_purge_expired():
+    store = SessionStore(ttl=0.05, max_bytes=10_000)
+    store.create(image(), [])
+    time.sleep(0.1)
+    kept = store.create(image(), [])
+
+    assert store.purge_expired() == 0
+    time.sleep(0.1)
+    assert store.purge_expired() == 1
+    assert store.get(kept) is None
+
+
+def test_least_recently_used_evicted_over_cap():
+    store = SessionStore(ttl=60, max_bytes=2500)
+    first = store.create(image(), [])
+    second = store.create(image(), [])
+    store.get(first)
+
+    third = store.create(image(), [])
+
+    assert store.get(second) is None
+    assert store.get(first) is not None and store.get(third) is not None
+    assert store.stats()["bytes"] == 2000
+    assert store.stats()["evictions"] == 1
+
+
+def test_image_over_cap_is_not_stored():
+    store = SessionStore(ttl=60, max_bytes=500)
+    assert store.create(image(), []) is None
+    assert store.stats()["sessions"] == 0
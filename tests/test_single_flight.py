@@ -0,0 +1,126 @@
+import asyncio
+
+import pytest
+
+from app.services.segment_cache import segment_cache_key
+from app.services.single_flight import SingleFlight, request_key
+
+
+class Computation:
+    """
+    An async callable that counts its calls and waits to be released.
+    """
+    def __init__(self, result="result", error=None):
+        self.result = result
+        self.error = error
+        self.calls = 0
+        self.cancelled = False
+        self.release = asyncio.Event()
+
+    async def __call__(self):
+        self.calls += 1
+        try:
+            await self.release.wait()
+        except asyncio.CancelledError:
+            self.cancelled = True
+            raise
+        if self.error is not None:
+            raise self.error
+        return self.result
+
+
+def test_request_key():
+    key = request_key("library", b"image", description="crime")
+    assert key == request_key("library", b"image", description="crime")
+    assert key == "library:" + segment_cache_key(b"image", {"description": "crime"})
+    assert key != request_key("mybookshelf", b"image", description="crime")
+    assert key != request_key("library", b"image", description="fantasy")
+    assert key != request_key("library", b"other image", description="crime")
+
+
+def test_concurrent_calls_are_coalesced():
+    async def main():
+        flight, fn = SingleFlight(), Computation()
+        callers = [asyncio.ensure_future(flight.run("key", fn)) for _ in range(3)]
+        await asyncio.sleep(0)
+        fn.release.set()
+        return flight, fn, await asyncio.gather(*callers)
+
+    flight, fn, results = asyncio.run(main())
+    assert results == ["result"] * 3
+    assert fn.calls == 1
+    assert flight.stats() == {"in_flight": 0, "started": 1, "coalesced": 2, "abandoned": 0}
+
+
+def test_different_keys_are_not_coalesced():
+    async def main():
+        flight, first, second = SingleFlight(), Computation("first"), Computation("second")
+        callers = [asyncio.ensure_future(flight.run("a", first)), asyncio.ensure_future(flight.run("b", second))]
+        await asyncio.sleep(0)
+        first.release.set()
+        second.release.set()
+        return await asyncio.gather(*callers)
+
+    assert asyncio.run(main()) == ["first", "second"]
+
+
+def test_error_reaches_every_waiter():
+    async def main():
+        flight, fn = SingleFlight(), Computation(error=ValueError("bad image"))
+        callers = [asyncio.ensure_future(flight.run("key", fn)) for _ in range(3)]
+        await asyncio.sleep(0)
+        fn.release.set()
+        results = await asyncio.gather(*callers, return_exceptions=True)
+
+        # A failed call isn't kept, so the next caller starts afresh
+        retry = Computation("retried")
+        retry.release.set()
+        return results, await flight.run("key", retry)
+
+    results, retried = asyncio.run(main())
+    assert all(isinstance(result, ValueError) for result in results)
+    assert len({id(result) for result in results}) == 1
+    assert retried == "retried"
+
+
+def test_cancelled_leader_does_not_cancel_followers():
+    async def main():
+        flight, fn = SingleFlight(), Computation()
+        leader = asyncio.ensure_future(flight.run("key", fn))
+        await asyncio.sleep(0)
+        follower = asyncio.ensure_future(flight.run("key", fn))
+        await asyncio.sleep(0)
+        leader.cancel()
+        await asyncio.sleep(0)
+        fn.release.set()
+        with pytest.raises(asyncio.CancelledError):
+            await leader
+        return flight, fn, await follower
+
+    flight, fn, result = asyncio.run(main())
+    assert result == "result"
+    assert fn.calls == 1
+    assert not fn.cancelled
+    assert flight.stats()["abandoned"] == 0
+
+
+def test_call_is_cancelled_once_every_waiter_has_gone():
+    async def main():
+        flight, fn = SingleFlight(), Computation()
+        callers = [asyncio.ensure_future(flight.run("key", fn)) for _ in range(2)]
+        await asyncio.sleep(0)
+        for caller in callers:
+            caller.cancel()
+        await asyncio.gather(*callers, return_exceptions=True)
+        await asyncio.sleep(0)
+        stats = flight.stats()
+
+        # The abandoned call isn't joined by later callers
+        fresh = Computation("fresh")
+        fresh.release.set()
+        return stats, fn, await flight.run("key", fresh)
+
+    stats, fn, result = asyncio.run(main())
+    assert fn.cancelled
+    assert stats == {"in_flight": 0, "started": 1, "coalesced": 1, "abandoned": 1}
+    assert result == "fresh"